@@ -0,0 +1,158 @@
+import random
+import socket
+import time
+import codec
+import config
+import lib
+
+ADDR_PREFIX = b"a"  # db key: "a" + ip(16) + port(2) -> services time attempts last_success
+ADDR_KEY_SIZE = 19  # block hashes are stored under raw 32 byte keys, skip those
+IPV4_PREFIX = bytes(10) + b"\xff\xff"
+
+def network_group(ip):
+    if ip[:12] == IPV4_PREFIX:
+        return ip[12:14] # /16
+    return ip[:4] # /32
+
+class AddrInfo:
+    __slots__ = ("ip", "port", "services", "time", "attempts", "last_try", "last_success")
+
+    def __init__(self, ip, port, services, time, attempts = 0, last_success = 0):
+        self.ip = ip # 16 bytes, ipv4 mapped into ipv6
+        self.port = port
+        self.services = services
+        self.time = time # last seen, as announced
+        self.attempts = attempts # failed connects since the last success
+        self.last_try = 0
+        self.last_success = last_success
+
+    def key(self):
+        return self.ip + codec.PORT.pack(self.port)
+
+    def group(self):
+        return network_group(self.ip)
+
+    # ret: (family, sockaddr) to connect to
+    def sockaddr(self):
+        if self.ip[:12] == IPV4_PREFIX:
+            return (socket.AF_INET, (socket.inet_ntop(socket.AF_INET, self.ip[12:]), self.port))
+        return (socket.AF_INET6, (socket.inet_ntop(socket.AF_INET6, self.ip), self.port))
+
+    def tobytes(self):
+        return codec.get("<QIII").pack(self.services, self.time, self.attempts, self.last_success)
+
+    def __str__(self):
+        return "{}:{}".format(self.sockaddr()[1][0], self.port)
+
+# Known peer addresses, bucketed by network group (/16 for ipv4) so one
+# operator announcing many addresses can't fill the book or get all of our
+# outbound slots. Persisted in the DataBase.
+class AddrMan:
+    def __init__(self, db):
+        self.db = db
+        self.addrs = {} # key -> AddrInfo
+        self.groups = {} # network group -> set of keys
+        for key, value in self.db.items(ADDR_PREFIX):
+            if len(key) != ADDR_KEY_SIZE:
+                continue
+            (services, t, attempts, last_success) = codec.get("<QIII").unpack_from(value, 0)
+            (port, ) = codec.PORT.unpack_from(key, 17)
+            self.insert(AddrInfo(bytes(key[1:17]), port, services, t, attempts, last_success))
+        lib.info("addrman: {} addresses in {} groups", len(self.addrs), len(self.groups))
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def insert(self, info):
+        key = info.key()
+        self.addrs[key] = info
+        self.groups.setdefault(info.group(), set()).add(key)
+
+    def remove(self, key, batch = None):
+        info = self.addrs.pop(key)
+        group = self.groups[info.group()]
+        group.discard(key)
+        if not group:
+            del self.groups[info.group()]
+        (batch if batch is not None else self.db).delete(ADDR_PREFIX + key)
+
+    def save(self, info, batch = None):
+        (batch if batch is not None else self.db).add(ADDR_PREFIX + info.key(), info.tobytes())
+
+    # config.seed_addr, used while the book is empty
+    def add_seed(self, host, port):
+        try:
+            ip = IPV4_PREFIX + socket.inet_pton(socket.AF_INET, host)
+        except OSError:
+            ip = socket.inet_pton(socket.AF_INET6, host)
+        info = self.addrs.get(ip + codec.PORT.pack(port))
+        if not info:
+            info = AddrInfo(ip, port, config.services, int(time.time()))
+            self.insert(info)
+        return info
+
+    # NetAddrs from an addr message, ret: number of new addresses
+    def add(self, addrs, batch = None):
+        now = int(time.time())
+        added = 0
+        for addr in addrs:
+            if addr.port == 0 or addr.ip == bytes(16):
+                continue
+            key = addr.ip + codec.PORT.pack(addr.port)
+            info = self.addrs.get(key)
+            # don't let peers claim addresses are from the future
+            t = min(addr.time, now)
+            if info:
+                if t > info.time:
+                    info.time = t
+                    info.services |= addr.services
+                    self.save(info, batch)
+                continue
+
+            info = AddrInfo(addr.ip, addr.port, addr.services, t)
+            group = self.groups.get(info.group(), ())
+            if len(group) >= config.addr_group_size:
+                worst = max(group, key = lambda k: self.rank(self.addrs[k]))
+                if self.rank(self.addrs[worst]) <= self.rank(info):
+                    continue
+                self.remove(worst, batch)
+            elif len(self.addrs) >= config.addr_book_size:
+                continue
+            self.insert(info)
+            self.save(info, batch)
+            added += 1
+        return added
+
+    # lower is better: fewer failed attempts, then more recently seen
+    def rank(self, info):
+        return (info.attempts, -info.time)
+
+    # random address outside the given network groups that wasn't tried
+    # lately, None if there is none
+    def select(self, exclude = ()):
+        now = time.time()
+        groups = [group for group in self.groups if group not in exclude]
+        random.shuffle(groups)
+        for group in groups:
+            keys = list(self.groups[group])
+            random.shuffle(keys)
+            for key in keys:
+                info = self.addrs[key]
+                if now - info.last_try >= config.addr_retry_interval * (1 << min(info.attempts, 6)):
+                    return info
+        return None
+
+    def attempt(self, info):
+        info.last_try = time.time()
+        info.attempts += 1
+        self.save(info)
+
+    def good(self, info):
+        info.attempts = 0
+        info.time = info.last_success = int(time.time())
+        self.save(info)
+
+    # up to count random addresses, for answering getaddr
+    def sample(self, count):
+        infos = list(self.addrs.values())
+        return random.sample(infos, min(count, len(infos)))
@@ -0,0 +1,185 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import codec
+import lib
+from structs import *
+from messages import *
+from bitcoin import BitCoin, Node, MALFORMED
+
+# BitCoin on an asyncio event loop, one task per peer.
+# Frames are read with readexactly (24 byte header, then the payload) and
+# dispatched to the same handle_* methods as the selectors engine. Large
+# messages are checksummed and decoded on a thread pool so the loop keeps
+# serving other peers meanwhile; handlers always run on the loop.
+class AsyncBitCoin(BitCoin):
+    def setup_network(self):
+        self.loop = None
+        self.servers = []
+        self.dialing = {} # key -> AddrInfo being connected
+        self.executor = ThreadPoolExecutor(config.offload_threads)
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.executor.shutdown()
+            self.validator.close()
+            self.coins.flush()
+            self.db.close()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        for port, debug in ((config.listen_port, False), (config.debug_port, True)):
+            server = await asyncio.start_server(
+                lambda reader, writer, debug = debug: self.accept(reader, writer, debug), "localhost", port)
+            self.servers.append(server)
+        self.maintain_outbound()
+
+        while True:
+            await asyncio.sleep(config.tick_interval)
+            start = time.perf_counter()
+            self.check_peers()
+            self.sync.tick()
+            self.db.tick()
+            if self.metrics:
+                # the loop's own work is in the handlers, lag shows it
+                self.metrics.tick(config.tick_interval, time.perf_counter() - start)
+
+    # run fn(*args) on the worker threads, for CPU heavy work that touches no shared state
+    def offload(self, fn, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def when_done(self, future, fn):
+        if future.done():
+            fn(future.result())
+            return
+        asyncio.wrap_future(future, loop = self.loop).add_done_callback(lambda future: fn(future.result()))
+
+    def outbound_addrs(self):
+        return BitCoin.outbound_addrs(self) + list(self.dialing.values())
+
+    def sock_connect(self, info):
+        self.dialing[info.key()] = info
+        self.loop.create_task(self.connect(info))
+
+    def add_node(self, writer, debug):
+        sock = writer.get_extra_info("socket")
+        node = Node(sock, debug)
+        node.writer = writer
+        writer.transport.set_write_buffer_limits(high = config.send_high_water)
+        fd = sock.fileno()
+        self.nodes[fd] = node
+        return fd
+
+    async def accept(self, reader, writer, debug):
+        fd = self.add_node(writer, debug)
+        lib.info("new connection: {}({}), debug: {}", writer.get_extra_info("peername"), fd, debug)
+        await self.serve(fd, reader)
+
+    async def connect(self, info):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*info.sockaddr()[1]), config.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            lib.err("connect to {} failed: {}", info, e)
+            return
+        finally:
+            self.dialing.pop(info.key(), None)
+        fd = self.add_node(writer, False)
+        node = self.nodes[fd]
+        node.outbound = True
+        node.addr = info
+        lib.info("connect to: {}({})", info, fd)
+        self.send_msg(fd, Message("version", Version(self.index.height()).tobytes()))
+        await self.serve(fd, reader)
+
+    async def serve(self, fd, reader):
+        node = self.nodes[fd]
+        try:
+            if node.debug:
+                await self.read_debug(fd, reader)
+            else:
+                await self.read_msgs(fd, reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if self.nodes.get(fd) is node:
+                self.close(fd)
+
+    async def read_msgs(self, fd, reader):
+        node = self.nodes[fd]
+        while self.nodes.get(fd) is node:
+            header = await reader.readexactly(24)
+            (magic, command, length, checksum) = codec.MSGHEADER.unpack(header)
+            if length > config.max_msg_size:
+                lib.err("message too large from {}: {}", fd, length)
+                return
+            payload = await reader.readexactly(length)
+            node.last_recv = time.time()
+
+            entry = self.dispatch.get(command)
+            if entry is None:
+                lib.err("unknown command from {}: {}", fd, command.rstrip(b"\x00"))
+                continue
+            if self.metrics:
+                self.metrics.recv(fd, command, 24 + length)
+            command = command.decode("ascii").rstrip("\x00")
+            try:
+                if length >= config.offload_min_size:
+                    decoded = await self.offload(self.decode_frame, entry, command, payload, magic, checksum)
+                else:
+                    decoded = self.decode_frame(entry, command, payload, magic, checksum)
+            except MALFORMED as e:
+                self.malformed(fd, command, e)
+                return
+            if decoded and self.nodes.get(fd) is node:
+                self.call(fd, command, *decoded)
+            # stop reading while this peer's send buffer is over the high-water
+            # mark, checked first as awaiting drain() costs a loop iteration
+            transport = node.writer.transport
+            if self.nodes.get(fd) is node and transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+                await node.writer.drain()
+
+    # ret: (handler, payload), None if the checksum is wrong or msg can't be handled
+    def decode_frame(self, entry, command, payload, magic, checksum):
+        msg = Message(command, payload, magic)
+        if checksum != msg.checksum:
+            lib.err("<{}> checksum failed: {}, {}", command, checksum, msg.checksum)
+            return None
+        return self.decode(msg, entry)
+
+    # debug commands are VarStrs
+    async def read_debug(self, fd, reader):
+        while fd in self.nodes:
+            data = await reader.readexactly(1)
+            if data[0] >= 0xFD:
+                data += await reader.readexactly(1 << (data[0] - 0xFC))
+            size, _ = VarInt.read_from(data, 0)
+            cmd = await reader.readexactly(size)
+            self.debug(fd, cmd.decode("utf-8"))
+
+    def sock_close(self, sock):
+        self.close(sock.fileno())
+
+    # by fd, the socket may already be closed by the transport
+    def close(self, fd):
+        lib.info("disconnect: {}", fd)
+        node = self.nodes.pop(fd, None)
+        if node:
+            node.writer.close()
+        self.forget_peer(fd)
+
+    def send_msg(self, fd, msg):
+        node = self.nodes[fd]
+        data = msg.tobytes()
+        node.writer.write(data)
+        if self.metrics:
+            self.metrics.sent(fd, msg.command, len(data))
+        lib.info("-> {}:{}", msg.command, len(data))
+
+    def send_debug_msg(self, fd, string):
+        node = self.nodes[fd]
+        data = VarStr(string.encode("utf-8")).tobytes()
+        node.writer.write(data)
+        lib.info("-> dbg:{}", len(data))
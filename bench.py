@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+import lib
+from structs import *
+from messages import *
+from blockstream import BlockParser
+
+# Microbenchmarks of the wire encoding, framing and hashing hot paths, on
+# synthetic data generated here, so they run without a network or a
+# datadir:
+#
+#   python bench.py                         run all, print a table
+#   python bench.py --json out.json         also write the results as json
+#   python bench.py --baseline out.json     exit 1 if anything got slower
+#                                           than the baseline by more than
+#                                           --threshold
+#
+# Every benchmark reports the best of --repeat runs, a run loops long
+# enough to take about --min-time seconds.
+
+# Synthetic data, deterministic for a given seed
+
+def make_tx(rnd, size, witness):
+    n_in = rnd.choice((1, 1, 1, 2, 3))
+    n_out = rnd.choice((1, 2, 2, 2, 3))
+    # prev (36) + sequence (4) + script length (1) per input, value (8) +
+    # p2wpkh script (23) per output, version, counts and locktime (10)
+    fixed = n_in * 41 + n_out * 31 + 10
+    script = max(0, min(252, (size - fixed) // n_in))
+    txin = [TxIn(OutPoint(rnd.randbytes(32), rnd.randrange(4)), VarStr(b"" if witness else rnd.randbytes(script)), 0xFFFFFFFF) for _ in range(n_in)]
+    txout = [TxOut(rnd.randrange(1, 10 ** 8), VarStr(b"\x00\x14" + rnd.randbytes(20))) for _ in range(n_out)]
+    wit = []
+    if witness:
+        wit = [Witness([VarStr(rnd.randbytes(max(1, script - 34))), VarStr(rnd.randbytes(33))]) for _ in range(n_in)]
+    return Tx(2, 1 if witness else 0, txin, txout, wit, 0)
+
+# size: approximate serialized size in bytes. Half of the txs spend
+# segwit outputs, as on mainnet.
+def make_block(rnd, count, size):
+    coinbase = Tx(1, 0, [TxIn(OutPoint(bytes(32), 0xFFFFFFFF), VarStr(b"\x03\x01\x02\x03"), 0xFFFFFFFF)], [TxOut(625000000, VarStr(b"\x51"))], [], 0)
+    per_tx = max(60, size // count)
+    txs = [coinbase] + [make_tx(rnd, per_tx, i % 2 == 0) for i in range(count - 1)]
+    header = BlockHeader(0x20000000, rnd.randbytes(32), lib.merkle_root(txs), int(time.time()), 0x1703A30C, rnd.getrandbits(32))
+    return Block(header, txs)
+
+def make_inv(rnd, count):
+    return Inv([InvVect(MSG_TX | MSG_WITNESS_FLAG, rnd.randbytes(32)) for _ in range(count)])
+
+def make_addr(rnd, count):
+    now = int(time.time())
+    return Addr([NetAddr(now - rnd.randrange(86400), 1 | 8 | 1024, b"\x00" * 10 + b"\xff\xff" + rnd.randbytes(4), 8333) for _ in range(count)])
+
+# wire bytes of a mixed stream: the block, inv and addr messages and small
+# pings between them
+def make_stream(rnd, block, inv, addr):
+    msgs = [Message("block", block.tobytes()), Message("inv", inv.tobytes()), Message("addr", addr.tobytes())]
+    msgs += [Message("ping", Ping().tobytes()) for _ in range(200)]
+    rnd.shuffle(msgs)
+    return b"".join(bytes(msg.tobytes()) for msg in msgs), len(msgs)
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+# ret: frame(pieces), pushing chunks as they come off the socket through
+# BitCoin.on_recv. The BitCoin has only what on_recv needs: messages go
+# through the real framing, loaders and dispatch table, the handlers do
+# nothing. bitcoin pulls in the database (bsddb3), it's imported here so
+# the other benchmarks run without it
+def make_framer():
+    from bitcoin import BitCoin, Node
+    bc = BitCoin.__new__(BitCoin)
+    bc.metrics = None
+    bc.nodes = {}
+    bc.register_messages()
+    bc.dispatch = {key: (loader, lambda fd, payload: None) for key, (loader, handler) in bc.dispatch.items()}
+
+    def frame(pieces):
+        node = bc.nodes[0] = Node(None)
+        for piece in pieces:
+            node.recvbuf.write(piece)
+            bc.on_recv(0)
+        return node
+    return frame
+
+# A block payload pushed through BlockParser, as a streamed block message
+def parse_stream(pieces):
+    parser = BlockParser()
+    for piece in pieces:
+        parser.feed(piece)
+    parser.parse()
+    return parser.done()
+
+# reference for lib._merkle_root: a double_hash call per pair, indexing
+# into the level
+def merkle_root_concat(nodes):
+    while len(nodes) > 1:
+        if len(nodes) % 2 != 0:
+            nodes.append(nodes[-1])
+        nodes = [lib.double_hash(nodes[2 * i] + nodes[2 * i + 1]) for i in range(len(nodes) // 2)]
+    return nodes[0]
+
+# tobytes() returns the bytes cached by load(), these serialize from the fields
+def block_tobytes(block):
+    block.header.invalidate()
+    for tx in block.txs:
+        tx.invalidate()
+    return block.tobytes()
+
+def tx_tobytes(tx):
+    tx.invalidate()
+    return tx.tobytes()
+
+# Timing
+
+# ret: best seconds per call of fn over repeat runs
+def measure(fn, min_time, repeat):
+    # calls per run, so a run takes about min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / elapsed))
+    best = elapsed / number if number == 1 else float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+# name -> (fn, items, bytes) per call, items and bytes give the rates
+def benchmarks(args):
+    rnd = random.Random(args.seed)
+    block = make_block(rnd, args.txs, args.block_size)
+    raw = bytes(block.tobytes())
+    txs = [bytes(tx.tobytes()) for tx in block.txs]
+    legacy = next(tx for tx in txs[1:] if tx[4] != 0)
+    segwit = next(tx for tx in txs[1:] if tx[4] == 0)
+    inv = make_inv(rnd, args.inv)
+    inv_raw = bytes(inv.tobytes())
+    addr = make_addr(rnd, args.addr)
+    addr_raw = bytes(addr.tobytes())
+    (stream, n_msgs) = make_stream(rnd, block, inv, addr)
+    small = rnd.randbytes(80)
+    big = rnd.randbytes(1 << 20)
+    framed = bytes(Message("block", raw).tobytes())
+    loaded = Block.load(raw)[0]
+    loaded_tx = Tx.load(segwit)[0]
+    try:
+        frame = make_framer()
+    except ImportError as e:
+        print("frame benchmarks skipped: {}".format(e), file = sys.stderr)
+        frame = None
+
+    ret = {
+        "block.load": (lambda: Block.load(raw), 1, len(raw)),
+        "block.load_columnar": (lambda: Block.load(raw, True), 1, len(raw)),
+        "block.tobytes": (lambda: block_tobytes(loaded), 1, len(raw)),
+        "lazyblock.index": (lambda: LazyBlock(raw).index(), 1, len(raw)),
+        "lazyblock.txids": (lambda: LazyBlock(raw).txids(), len(txs), len(raw)),
+        "tx.load_legacy": (lambda: Tx.load(legacy), 1, len(legacy)),
+        "tx.load_segwit": (lambda: Tx.load(segwit), 1, len(segwit)),
+        "tx.tobytes": (lambda: tx_tobytes(loaded_tx), 1, len(segwit)),
+        "inv.load": (lambda: Inv.load(inv_raw), len(inv.inventory), len(inv_raw)),
+        "inv.load_raw": (lambda: list(RawInv(inv_raw).entries()), len(inv.inventory), len(inv_raw)),
+        "inv.tobytes": (lambda: inv.tobytes(), len(inv.inventory), len(inv_raw)),
+        "addr.load": (lambda: Addr.load(addr_raw), len(addr.addr_list), len(addr_raw)),
+        "addr.tobytes": (lambda: addr.tobytes(), len(addr.addr_list), len(addr_raw)),
+        "message.tobytes": (lambda: Message("block", raw).tobytes(), 1, len(raw)),
+        "message.load": (lambda: Message.load_from(framed, 0), 1, len(raw)),
+        "double_hash.80b": (lambda: lib.double_hash(small), 1, len(small)),
+        "double_hash.1mb": (lambda: lib.double_hash(big), 1, len(big)),
+        "double_hash_many.txs": (lambda: lib.double_hash_many(txs), len(txs), sum(len(tx) for tx in txs)),
+    }
+    for count in args.merkle_leaves:
+        leaves = [rnd.randbytes(32) for _ in range(count)]
+        ret["merkle_root.{}".format(count)] = (lambda leaves = leaves: lib._merkle_root(list(leaves)), count, 32 * count)
+        ret["merkle_root_concat.{}".format(count)] = (lambda leaves = leaves: merkle_root_concat(list(leaves)), count, 32 * count)
+    for size in args.chunks:
+        if frame:
+            pieces = chunks(stream, size)
+            ret["frame.chunk_{}".format(size)] = (lambda pieces = pieces: frame(pieces), n_msgs, len(stream))
+        pieces = chunks(raw, size)
+        ret["blockstream.chunk_{}".format(size)] = (lambda pieces = pieces: parse_stream(pieces), 1, len(raw))
+    return ret
+
+def run(args):
+    results = {}
+    # the node logs to stdout, every message on_recv frames included
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, (fn, items, size) in benchmarks(args).items():
+            if args.filter and not re.search(args.filter, name):
+                continue
+            seconds = measure(fn, args.min_time, args.repeat)
+            results[name] = {
+                "us": round(seconds * 1e6, 3),
+                "items_per_s": round(items / seconds, 1),
+                "mb_per_s": round(size / seconds / 1e6, 2),
+            }
+            print("{:<28} {:>12.1f} us {:>14.0f} items/s {:>9.1f} MB/s".format(name, seconds * 1e6, items / seconds, size / seconds / 1e6), file = sys.stderr)
+    return results
+
+# ret: names slower than in baseline by more than threshold, as
+# (name, baseline us, us)
+def regressions(results, baseline, threshold):
+    ret = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old and result["us"] > old["us"] * (1 + threshold):
+            ret.append((name, old["us"], result["us"]))
+    return ret
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "wire encoding, framing and hashing microbenchmarks")
+    parser.add_argument("--txs", type = int, default = 2500, help = "txs per block")
+    parser.add_argument("--block-size", type = int, default = 1000000, help = "approximate block size in bytes")
+    parser.add_argument("--inv", type = int, default = 50000, help = "inv entries")
+    parser.add_argument("--addr", type = int, default = 1000, help = "addr entries")
+    parser.add_argument("--chunks", type = int, nargs = "+", default = [1460, 16384, 65536], help = "socket read sizes for the framing benchmarks")
+    parser.add_argument("--merkle-leaves", type = int, nargs = "+", default = [1000, 5000, 20000], help = "leaf counts of the merkle root benchmarks")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--filter", help = "only run benchmarks whose name matches this regex")
+    parser.add_argument("--min-time", type = float, default = 0.2, help = "seconds per run")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per benchmark, the best is kept")
+    parser.add_argument("--json", help = "write the results to this file")
+    parser.add_argument("--baseline", help = "results json of an earlier run to compare against")
+    parser.add_argument("--threshold", type = float, default = 0.1, help = "allowed slowdown against the baseline, 0.1 = 10%%")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    report = {
+        "time": int(time.time()),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "params": {"txs": args.txs, "block_size": args.block_size, "inv": args.inv, "addr": args.addr, "chunks": args.chunks, "merkle_leaves": args.merkle_leaves, "seed": args.seed},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent = 1, sort_keys = True)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("params") != report["params"]:
+        print("baseline was run with other params: {}".format(baseline.get("params")), file = sys.stderr)
+    slower = regressions(results, baseline["results"], args.threshold)
+    for name, old, new in slower:
+        print("REGRESSION {}: {:.1f} us -> {:.1f} us (+{:.0f}%)".format(name, old, new, (new / old - 1) * 100), file = sys.stderr)
+    return 1 if slower else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,37 +1,186 @@
 import selectors
 import socket
+import struct
+import itertools
+import errno
+import os
+import time
+from collections import OrderedDict, deque
 import config
+import codec
 from structs import *
 from messages import *
 import lib
-from db import DataBase
+from db import open_database
+from recvbuf import RecvBuffer
+from blockstream import BlockParser, PayloadStream
+from merkle import MerkleTree
+from blockindex import *
+from coins import CoinsViewDB, CoinsViewCache
+from sync import SyncManager, MAX_HEADERS, check_header
+from addrman import AddrMan, IPV4_PREFIX
+from validation import ScriptValidator
+from mempool import Mempool
+import bloom
+import compact
+from metrics import Metrics
 
 class Node:
     def __init__(self, sock, debug = False):
         self.sock = sock
-        self.slicedmsg = b""
+        self.recvbuf = RecvBuffer()
+        self.stream = None # PayloadStream of a block being received
+        self.writer = None # asyncio.StreamWriter, asyncio engine only
+        self.sendq = deque() # buffers not sent yet, oldest first
+        self.sendq_size = 0
+        self.paused = False # not read from until sendq drains
+        self.events = selectors.EVENT_READ
         self.debug = debug # debug node
         self.version = 0
         self.services = 0
         self.user_agent = ""
         self.start_height = 0
+        self.send_headers = False # announce blocks with headers instead of inv
+        self.outbound = False
+        self.addr = None # AddrInfo of outbound nodes
+        self.connecting = False # non-blocking connect in progress
+        self.ready = False # verack received
+        self.closing = False # dropped by send(), closed once the current event is handled
+        self.connect_time = time.time()
+        self.last_recv = self.connect_time
+        self.ping_nonce = 0 # of the ping waiting for its pong
+        self.feefilter = 0 # don't announce txs below this fee rate
+        self.txs_in_flight = 0 # tx getdata requests not answered yet
+        self.bloom = None # BIP37 BloomFilter set by filterload
+        self.relay = True # version relay flag, no tx invs while unset, filterload/filterclear set it
+        self.cmpct = False # speaks BIP152 version 2
+        self.cmpct_announce = False # wants new blocks as cmpctblock right away
+        self.partial = None # (block hash, compact.PartialBlock) waiting for blocktxn
 
     def __str__(self):
-        return "sock: {}\ndebug: {}\nversion: {}\nservices: {}\nuser agent: {}\nstart height: {}\n".format(
-            self.sock, self.debug, self.version, self.services, self.user_agent, self.start_height)
+        return "sock: {}\ndebug: {}\noutbound: {}\nversion: {}\nservices: {}\nuser agent: {}\nstart height: {}\n".format(
+            self.sock, self.debug, self.addr if self.outbound else False, self.version, self.services, self.user_agent, self.start_height)
+
+MAX_ADDR = 1000 # per addr message
+MAX_INV = 50000 # per inv message
+
+# command -> payload class, handled by BitCoin.handle_<class>
+MSGTYPES = {"version": "Version", "verack": "VerAck", "addr": "Addr", "inv": "Inv",
+    "getdata": "GetData", "notfound": "NotFound", "getblocks": "GetBlocks",
+    "getheaders": "GetHeaders", "tx": "Tx", "block": "Block", "headers": "Headers",
+    "getaddr": "GetAddr", "mempool": "MemPool", "checkorder": "CheckOrder",
+    "submitorder": "SubmitOrder", "reply": "Reply", "ping": "Ping", "pong": "Pong",
+    "reject": "Reject", "filterload": "FilterLoad", "filteradd": "FilterAdd",
+    "filterclear": "FilterClear", "merkleblock": "MerkleBlock", "alert": "Alert",
+    "sendheaders": "SendHeaders", "feefilter": "FeeFilter", "sendcmpct": "SendCmpct",
+    "cmpctblock": "CmpctBlock", "getblocktxn": "GetBlockTxn", "blocktxn": "BlockTxn"}
+
+# what loaders and handlers raise on payloads they can't parse
+MALFORMED = (ValueError, struct.error, IndexError, OverflowError)
+
+# the command field of a message header: ascii, NUL padded to 12 bytes
+def command_key(cmd):
+    return cmd.encode("ascii").ljust(12, b"\x00")
 
 class BitCoin:
     def __init__(self):
         self.nodes = {}
-        self.db = DataBase(config.db_name)
-        if len(self.db.keys()) <= 0:
+        self.dropped = [] # fds of nodes marked closing
+        self.merkle_trees = OrderedDict() # block hash -> MerkleTree, most recently used last
+        self.filtered_blocks = OrderedDict() # block hash -> (LazyBlock, bloom.Elements), most recently used last
+        self.db = open_database(config.db_name)
+        self.index = BlockIndex(self.db)
+        self.coins = CoinsViewCache(CoinsViewDB(self.db))
+        self.validator = ScriptValidator()
+        self.mempool = Mempool(self.coins, self.validator)
+        self.tx_requests = OrderedDict() # txid -> (fd, time requested), oldest first
+        self.hb_peers = deque() # peers asked to announce with cmpctblock, oldest first
+        self.metrics = Metrics() if config.metrics_enabled else None
+        if not self.index.tip():
             if not self.create_genesis_block():
                 exit()
+        self.sync = SyncManager(self)
+        self.register_messages()
+        self.addrman = AddrMan(self.db)
+        if not self.addrman:
+            self.addrman.add_seed(*config.seed_addr)
+        self.setup_network()
 
+    def setup_network(self):
         self.sel = selectors.DefaultSelector()
         self.sock_listen(config.listen_port)
         self.sock_listen(config.debug_port)
-        self.sock_connect(config.seed_addr)
+        # other threads queue callbacks in woken and write a byte to wake
+        # the select() up
+        self.woken = deque()
+        (self.wake_recv, self.wake_send) = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.sel.register(self.wake_recv, selectors.EVENT_READ, self.on_wake)
+        self.maintain_outbound()
+
+    # fn(result of future) on the loop once future is done, for work
+    # handed to other threads or processes
+    def when_done(self, future, fn):
+        if future.done():
+            fn(future.result())
+            return
+        future.add_done_callback(lambda future: self.wake(lambda: fn(future.result())))
+
+    # any thread: run fn on the loop
+    def wake(self, fn):
+        self.woken.append(fn)
+        try:
+            self.wake_send.send(b"\x00")
+        except BlockingIOError:
+            # full, the loop is woken already
+            pass
+
+    def on_wake(self, sock, mask):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.woken:
+            self.woken.popleft()()
+
+    # AddrInfos of outbound peers, connected or being connected
+    def outbound_addrs(self):
+        return [node.addr for node in self.nodes.values() if node.outbound]
+
+    # dial until config.max_outbound peers, each in its own network group
+    def maintain_outbound(self):
+        addrs = self.outbound_addrs()
+        groups = {addr.group() for addr in addrs}
+        for _ in range(config.max_outbound - len(addrs)):
+            info = self.addrman.select(groups)
+            if not info:
+                break
+            groups.add(info.group())
+            self.addrman.attempt(info)
+            self.sock_connect(info)
+
+    # evict peers that don't finish the handshake or stop answering pings,
+    # then replace dropped outbound peers
+    def check_peers(self):
+        now = time.time()
+        for fd, node in list(self.nodes.items()):
+            if node.debug:
+                continue
+            if not node.ready:
+                if now - node.connect_time > config.connect_timeout:
+                    lib.err("{}: {} timed out", fd, "connect" if node.connecting else "handshake")
+                    self.sock_close(node.sock)
+            elif now - node.last_recv > config.peer_timeout:
+                lib.err("{}: unresponsive for {}s", fd, int(now - node.last_recv))
+                self.sock_close(node.sock)
+            elif now - node.last_recv > config.ping_interval and not node.ping_nonce:
+                ping = Ping()
+                node.ping_nonce = ping.nonce
+                self.send_msg(fd, Message("ping", ping.tobytes()))
+        self.expire_tx_requests(now)
+        self.maintain_outbound()
 
     def create_genesis_block(self):
         txin = []
@@ -40,7 +189,7 @@ class BitCoin:
         txin.append(TxIn(prev, VarStr(script), 0xFFFFFFFF))
 
         txout = []
-        script = VarStr(lib.hexstr2bytes("04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f")).tobytes() + struct.pack("<B", 0xAC)
+        script = VarStr(lib.hexstr2bytes("04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f")).tobytes() + codec.U8.pack(0xAC)
         txout.append(TxOut(50 * config.coin, VarStr(script)))
 
         txs = []
@@ -52,46 +201,134 @@ class BitCoin:
             return False
 
         header = BlockHeader(1, b"", merkle, 1231006505, 0x1d00ffff, 2083236893)
-        key = lib.double_hash(header.tobytes())
+        key = header.hash
         if key != lib.hexstr2bytes("000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f")[::-1]:
             lib.err("create genesis block failed: hash err {}", key.hex())
             return False
 
         b = Block(header, txs)
-        self.db.add(key, b.tobytes())
+        batch = self.db.batch()
+        self.db.add_block(key, b.tobytes(), batch)
+        entry = self.index.add(header, BLOCK_VALID_HEADER | BLOCK_HAVE_DATA | BLOCK_CONNECTED, batch)
+        self.index.set_tip(entry, batch = batch)
+        self.db.write(batch)
+        self.db.flush()
         lib.debug("genesis block created")
         return True
 
-    def sock_accept(self, sock):
+    def sock_accept(self, sock, mask):
         conn, addr = sock.accept()
         conn.setblocking(False)
-        self.sel.register(conn, selectors.EVENT_READ, self.sock_read)
+        self.sel.register(conn, selectors.EVENT_READ, self.sock_event)
 
-        _, port = conn.getsockname()
+        port = conn.getsockname()[1]
         debug = port == config.debug_port
 
         fd = conn.fileno()
         self.nodes[fd] = Node(conn, debug)
         lib.info("new connection: {}({}), debug: {}", addr, fd, debug)
 
+    # the node may be gone by the time a select() batch gets to its event
+    def sock_event(self, sock, mask):
+        node = self.nodes.get(sock.fileno())
+        if not node or node.closing:
+            return
+        if mask & selectors.EVENT_WRITE:
+            if node.connecting:
+                self.sock_connected(sock)
+            else:
+                self.sock_write(sock)
+        if mask & selectors.EVENT_READ and sock.fileno() in self.nodes and not node.closing:
+            self.sock_read(sock)
+
     def sock_read(self, sock):
-        data = sock.recv(4096)
         fd = sock.fileno()
-        if data:
-            self.on_recv(fd, data)
+        node = self.nodes[fd]
+        try:
+            n = node.recvbuf.recv_into(sock)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            lib.err("recv from {} failed: {}", fd, e)
+            n = 0
+        if n > 0:
+            node.last_recv = time.time()
+            if self.metrics:
+                self.metrics.recvbuf.observe(len(node.recvbuf))
+            self.on_recv(fd)
         else:
-            lib.info("disconnect: {}", fd)
-            self.sel.unregister(sock)
+            self.sock_close(sock)
+
+    # send as much of node.sendq as the socket takes, gathered into one sendmsg
+    def sock_write(self, sock):
+        fd = sock.fileno()
+        node = self.nodes[fd]
+        try:
+            sent = sock.sendmsg(list(itertools.islice(node.sendq, config.send_iov_max)))
+        except BlockingIOError:
+            return
+        except OSError as e:
+            lib.err("send to {} failed: {}", fd, e)
+            self.sock_close(sock)
+            return
+        self.dequeue(node, sent)
+        if node.paused and node.sendq_size <= config.send_high_water // 2:
+            node.paused = False
+        self.update_events(node)
+
+    def sock_close(self, sock):
+        fd = sock.fileno()
+        lib.info("disconnect: {}", fd)
+        self.sel.unregister(sock)
+        sock.close()
+        self.nodes.pop(fd, None)
+        self.forget_peer(fd)
+
+    # drop what other parts keep about a closed peer
+    def forget_peer(self, fd):
+        self.sync.remove_peer(fd)
+        self.drop_tx_requests(fd)
+        if fd in self.hb_peers:
+            self.hb_peers.remove(fd)
+        if self.metrics:
+            self.metrics.remove_peer(fd)
+
+    # non-blocking, sock_connected() runs once the socket is writable
+    def sock_connect(self, info):
+        family, addr = info.sockaddr()
+        try:
+            sock = socket.socket(family)
+        except OSError as e:
+            # no IPv6 on this host
+            lib.err("connect to {} failed: {}", info, e)
+            return
+        sock.setblocking(False)
+        err = sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS):
+            lib.err("connect to {} failed: {}", info, os.strerror(err))
             sock.close()
+            return
+        node = Node(sock)
+        node.outbound = True
+        node.addr = info
+        node.connecting = True
+        node.events = selectors.EVENT_WRITE
+        fd = sock.fileno()
+        self.nodes[fd] = node
+        self.sel.register(sock, node.events, self.sock_event)
+        lib.info("connect to: {}({})", info, fd)
 
-    def sock_connect(self, addr):
-        sock = socket.create_connection(addr)
-        self.sel.register(sock, selectors.EVENT_READ, self.sock_read)
+    def sock_connected(self, sock):
         fd = sock.fileno()
-        self.nodes[fd] = Node(sock)
-        lib.info("connect to: {}({})", addr, fd)
-        msg = Message("version", Version(0).tobytes())
-        self.send_msg(fd, msg)
+        node = self.nodes[fd]
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            lib.err("connect to {} failed: {}", node.addr, os.strerror(err))
+            self.sock_close(sock)
+            return
+        node.connecting = False
+        self.update_events(node)
+        self.send_msg(fd, Message("version", Version(self.index.height()).tobytes()))
 
     def sock_listen(self, port):
         sock = socket.socket()
@@ -100,28 +337,120 @@ class BitCoin:
         sock.setblocking(False)
         self.sel.register(sock, selectors.EVENT_READ, self.sock_accept)
 
+    # select() returns as soon as a socket is ready, the ticks only run
+    # once config.tick_interval has passed since the last ones
     def run(self):
-        while True:
-            for key, _ in self.sel.select():
-                key.data(key.fileobj)
+        try:
+            last_tick = time.perf_counter()
+            busy = 0 # seconds of work since the last tick
+            while True:
+                events = self.sel.select(max(0, last_tick + config.tick_interval - time.perf_counter()))
+                start = time.perf_counter()
+                for key, mask in events:
+                    key.data(key.fileobj, mask)
+                    self.reap()
+                now = time.perf_counter()
+                busy += now - start
+                if now - last_tick < config.tick_interval:
+                    continue
+                last_tick = now
+                self.check_peers()
+                self.sync.tick()
+                self.db.tick()
+                self.reap()
+                if self.metrics:
+                    self.metrics.tick(config.tick_interval, busy + time.perf_counter() - now)
+                busy = 0
+        finally:
+            self.validator.close()
+            self.coins.flush()
+            self.db.close()
 
-    def on_recv(self, fd, data):
+    # frames complete messages straight out of node.recvbuf. The payloads
+    # handed to handle() are views into the buffer and only live until the
+    # next read, handlers must copy whatever they keep.
+    def on_recv(self, fd):
         node = self.nodes[fd]
-        if node.slicedmsg and len(node.slicedmsg) > 0:
-            data = node.slicedmsg + data
-        while True:
-            if not data or len(data) <= 0:
-                break
-
+        buf = node.recvbuf
+        data = buf.view()
+        offset = 0
+        while offset < len(data):
             if node.debug:
-                vs, size = VarStr.load(data)
-                data = data[size:]
+                vs, offset = VarStr.load_from(data, offset)
                 self.debug(fd, vs.string.decode("utf-8"))
-            else:
-                (msg, data, node.slicedmsg) = Message.load(data)
-                if not msg:
+                continue
+
+            if node.stream:
+                offset += node.stream.feed(data[offset:])
+                if not node.stream.done():
                     break
-                self.handle(fd, msg)
+                self.on_stream_done(fd)
+                if fd not in self.nodes or node.closing:
+                    return
+                continue
+
+            size = Message.size_from(data, offset)
+            if size is None:
+                break
+            if size > config.max_msg_size:
+                lib.err("message too large from {}: {}", fd, size)
+                self.sock_close(node.sock)
+                return
+            if size > len(data) - offset:
+                node.stream = PayloadStream.start(data, offset, self.block_parser(fd))
+                if node.stream:
+                    offset += 24
+                    continue
+                # grow once for the whole message instead of per chunk
+                buf.consume(offset)
+                buf.reserve(size - len(buf))
+                return
+
+            # drop unknown commands before decoding or checksumming them
+            key = bytes(data[offset + 4:offset + 16])
+            entry = self.dispatch.get(key)
+            if entry is None:
+                lib.err("unknown command from {}: {}", fd, key.rstrip(b"\x00"))
+                offset += size
+                continue
+            if self.metrics:
+                self.metrics.recv(fd, key, size)
+            (msg, offset) = Message.load_from(data, offset)
+            self.handle(fd, msg, entry)
+            if fd not in self.nodes or node.closing:
+                return
+        buf.consume(offset)
+
+    def block_parser(self, fd):
+        return BlockParser(lambda header: self.on_block_header(fd, header),
+            lambda index, tx: self.on_block_tx(fd, index, tx))
+
+    def on_stream_done(self, fd):
+        node = self.nodes[fd]
+        stream = node.stream
+        node.stream = None
+        if not stream.checksum_ok():
+            return
+
+        block = stream.parser.block()
+        if not block:
+            lib.err("malformed <{}> from {}", stream.command, fd)
+            return
+        lib.info("<- <{}>", stream.command)
+        if self.metrics:
+            self.metrics.recv(fd, command_key(stream.command), 24 + stream.length)
+        # through the dispatch table, where it may be timed
+        self.call(fd, stream.command, self.dispatch[command_key(stream.command)][1], block)
+
+    # called while a streamed block is still arriving
+    def on_block_header(self, fd, header):
+        lib.debug("<block> header from {}, prev: {}", fd, header.prev[::-1].hex())
+
+    # hash each tx as it completes, overlapping the transfer, so only the
+    # merkle tree is left to build once the last byte is in
+    def on_block_tx(self, fd, index, tx):
+        tx.txid
+        tx.wtxid
 
     def debug(self, fd, cmd):
         lib.info("dbg: {}\n", cmd)
@@ -134,48 +463,149 @@ class BitCoin:
         handler(fd)
 
     def send_debug_msg(self, fd, string):
-        node = self.nodes[fd]
         data = VarStr(string.encode("utf-8")).tobytes()
-        sent = node.sock.send(data)
+        sent = self.send(fd, [data])
         lib.info("-> dbg:{}/{}", sent, len(data))
 
+    # msg.payload is sent in place, without a copy, and must not change
+    # until it is out. Payloads viewing a RecvBuffer must be copied first.
     def send_msg(self, fd, msg):
+        bufs = [msg.header(), msg.payload] if msg.length > 0 else [msg.header()]
+        sent = self.send(fd, bufs)
+        if self.metrics:
+            self.metrics.sent(fd, msg.command, 24 + msg.length)
+        lib.info("-> {}:{}/{}", msg.command, sent, 24 + msg.length)
+
+    # queue bufs for fd, whatever the socket takes right away is sent now.
+    # Peers whose queue passes config.send_high_water aren't read from until
+    # it drains to half of that, past config.send_max_queue they are dropped.
+    # ret: bytes sent now
+    def send(self, fd, bufs):
+        node = self.nodes.get(fd)
+        if not node or node.closing:
+            return 0
+        sent = 0
+        if not node.sendq:
+            try:
+                sent = node.sock.sendmsg(bufs)
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                lib.err("send to {} failed: {}", fd, e)
+                self.drop(fd)
+                return 0
+
+        skip = sent
+        for buf in bufs:
+            if skip >= len(buf):
+                skip -= len(buf)
+                continue
+            node.sendq.append(memoryview(buf)[skip:])
+            skip = 0
+            node.sendq_size += len(node.sendq[-1])
+
+        if node.sendq_size > config.send_max_queue:
+            lib.err("{} doesn't keep up, {} bytes queued", fd, node.sendq_size)
+            self.drop(fd)
+            return 0
+        if node.sendq_size > config.send_high_water:
+            node.paused = True
+        self.update_events(node)
+        return sent
+
+    # send() is called from loops over self.nodes and from other peers'
+    # events, so it only marks the node. reap() closes it after the event
+    def drop(self, fd):
         node = self.nodes[fd]
-        data = msg.tobytes()
-        sent = node.sock.send(data)
-        lib.info("-> {}:{}/{}", msg.command, sent, len(data))
-
-    def handle(self, fd, msg):
-        msgtypes = {"version": "Version", "verack": "VerAck", "addr": "Addr", "inv": "Inv", 
-            "getdata": "GetData", "notfound": "NotFound", "getblocks": "GetBlocks",
-            "getheaders": "GetHeaders", "tx": "Tx", "block": "Block", "headers": "Headers",
-            "getaddr": "GetAddr", "mempool": "MemPool", "checkorder": "CheckOrder",
-            "submitorder": "SubmitOrder", "reply": "Reply", "ping": "Ping", "pong": "Pong",
-            "reject": "Reject", "filterload": "FilterLoad", "fileteradd": "FilterAdd",
-            "filterclear": "FilterClear", "merkleblock": "MerkleBlock", "alert": "Alert",
-            "sendheaders": "SendHeaders", "feefilter": "FeeFilter", "sendcmpct": "SendCmpct",
-            "cmpctblock": "CmpctBlock", "getblocktxn": "GetBlockTxn", "blocktxn": "BlockTxn"}
-
-        cmd = msg.command
-        if cmd not in msgtypes:
-            lib.err("unknown command: <{}>({})", cmd, cmd.encode("utf-8"))
-            return
-
-        clsname = msgtypes[cmd]
-        handler = getattr(self, "handle_" + clsname, None)
-        if not handler:
-            lib.err("no handler for <{}, {}>", cmd, clsname)
-            return
-        lib.info("<- <{}>", cmd)
+        if not node.closing:
+            node.closing = True
+            self.dropped.append(fd)
 
-        if clsname not in globals():
-            lib.err("no class for <{}, {}>", cmd, clsname)
+    def reap(self):
+        while self.dropped:
+            node = self.nodes.get(self.dropped.pop())
+            if node and node.closing:
+                self.sock_close(node.sock)
+
+    def dequeue(self, node, sent):
+        node.sendq_size -= sent
+        while sent > 0:
+            buf = node.sendq[0]
+            if sent < len(buf):
+                node.sendq[0] = buf[sent:]
+                break
+            sent -= len(buf)
+            node.sendq.popleft()
+
+    def update_events(self, node):
+        events = 0 if node.paused else selectors.EVENT_READ
+        if node.sendq:
+            events |= selectors.EVENT_WRITE
+        if events != node.events:
+            node.events = events
+            self.sel.modify(node.sock, events, self.sock_event)
+
+    # build the command -> (loader, handler) table, once
+    def register_messages(self):
+        self.dispatch = {}
+        for cmd, clsname in MSGTYPES.items():
+            cls = globals().get(clsname)
+            handler = getattr(self, "handle_" + clsname, None)
+            if not cls or not handler:
+                lib.debug("<{}> not handled: no {}", cmd, "class" if not cls else "handler")
+                continue
+            loader = cls.load
+            if clsname in ("Block", "Tx"):
+                # these also return the size read
+                loader = lambda data, load = cls.load: load(data)[0]
+            elif clsname == "Inv":
+                loader = RawInv
+            self.register(cmd, loader, handler)
+
+    # loader(payload) -> object passed to handler(fd, object).
+    # Extensions register their own message types through this
+    def register(self, cmd, loader, handler):
+        if self.metrics:
+            handler = self.metrics.timed(cmd, handler)
+        self.dispatch[command_key(cmd)] = (loader, handler)
+
+    # entry: dispatch entry of msg if already looked up
+    def handle(self, fd, msg, entry = None):
+        try:
+            decoded = self.decode(msg, entry)
+        except MALFORMED as e:
+            self.malformed(fd, msg.command, e)
             return
+        if decoded:
+            self.call(fd, msg.command, *decoded)
 
-        payload = globals()[clsname].load(msg.payload)
-        if config.debug_enabled:
+    # every message of both engines reaches its handler through here
+    def call(self, fd, command, handler, payload):
+        if config.debug_payloads:
             payload.debug()
-        return handler(fd, payload)
+        try:
+            handler(fd, payload)
+        except MALFORMED as e:
+            self.malformed(fd, command, e)
+
+    # a payload its loader or handler can't parse drops the peer, not the loop
+    def malformed(self, fd, command, e):
+        lib.err("malformed <{}> from {}: {}", command, fd, e)
+        node = self.nodes.get(fd)
+        if node:
+            self.sock_close(node.sock)
+
+    # ret: (handler, payload) for msg, None if it can't be handled.
+    # Touches no node state, the asyncio engine runs it off the loop
+    def decode(self, msg, entry = None):
+        if entry is None:
+            entry = self.dispatch.get(command_key(msg.command))
+            if entry is None:
+                lib.err("unknown command: <{}>", msg.command)
+                return None
+        lib.info("<- <{}>", msg.command)
+        (loader, handler) = entry
+        return (handler, loader(msg.payload))
 
     def handle_Version(self, fd, payload):
         node = self.nodes[fd]
@@ -183,54 +613,283 @@ class BitCoin:
         node.services = payload.services
         node.user_agent = payload.user_agent
         node.start_height = payload.start_height
+        node.relay = payload.relay
 
+        if not node.outbound:
+            self.send_msg(fd, Message("version", Version(self.index.height()).tobytes()))
         msg = Message("verack", VerAck().tobytes())
         self.send_msg(fd, msg)
 
     def handle_VerAck(self, fd, payload):
         node = self.nodes[fd]
-        ip, _ = node.sock.getsockname()
-        msg = Message("addr", Addr([NetAddr(int(time.time()), config.services, socket.inet_pton(node.sock.family, ip), config.listen_port)]).tobytes())
+        node.ready = True
+        if node.outbound:
+            self.addrman.good(node.addr)
+        # IPv6 socket names are 4-tuples
+        ip = socket.inet_pton(node.sock.family, node.sock.getsockname()[0])
+        if node.sock.family == socket.AF_INET:
+            ip = IPV4_PREFIX + ip
+        msg = Message("addr", Addr([NetAddr(int(time.time()), config.services, ip, config.listen_port)]).tobytes())
         self.send_msg(fd, msg)
 
         msg = Message("getaddr", GetAddr().tobytes())
         self.send_msg(fd, msg)
-        pass
+        self.send_msg(fd, Message("feefilter", FeeFilter(self.mempool.min_feerate()).tobytes()))
+        self.send_msg(fd, Message("sendcmpct", SendCmpct(0, 2).tobytes()))
+        self.sync.add_peer(fd)
 
     def handle_Addr(self, fd, payload):
-        # do nothing
-        pass
+        added = self.addrman.add(payload.addr_list[:MAX_ADDR])
+        lib.debug("{} new addresses from {}, {} known", added, fd, len(self.addrman))
 
+    # Every peer announces the same txs: those known to the mempool or
+    # already requested from someone are skipped, before any InvVect is
+    # built for them
     def handle_Inv(self, fd, payload):
-        pass
+        node = self.nodes[fd]
+        requests = self.tx_requests
+        known = self.mempool.known
+        now = time.time()
+        wanted = []
+        for type, hash in payload.entries():
+            type &= ~MSG_WITNESS_FLAG
+            if type == MSG_TX:
+                if hash in requests or known(hash) or node.txs_in_flight >= config.max_tx_in_flight:
+                    continue
+                requests[hash] = (fd, now)
+                node.txs_in_flight += 1
+                wanted.append(InvVect(MSG_TX | MSG_WITNESS_FLAG, hash))
+            elif type == MSG_BLOCK:
+                self.sync.on_announce(fd, hash)
+        if wanted:
+            self.send_msg(fd, Message("getdata", GetData(wanted).tobytes()))
+
+    # forget requests that weren't answered in time, so another peer's
+    # announcement of the tx is fetched
+    def expire_tx_requests(self, now):
+        requests = self.tx_requests
+        while requests:
+            txid, (fd, t) = next(iter(requests.items()))
+            if now - t <= config.tx_request_timeout:
+                break
+            self.tx_request_done(txid)
+
+    def tx_request_done(self, txid):
+        request = self.tx_requests.pop(txid, None)
+        if request:
+            node = self.nodes.get(request[0])
+            if node:
+                node.txs_in_flight -= 1
+
+    # requests to fd can't be answered anymore
+    def drop_tx_requests(self, fd):
+        for txid in [txid for txid, (peer, t) in self.tx_requests.items() if peer == fd]:
+            del self.tx_requests[txid]
 
     def handle_GetData(self, fd, payload):
-        pass
+        notfound = []
+        for iv in payload.inventory:
+            type = iv.type & ~MSG_WITNESS_FLAG
+            if type == MSG_TX:
+                entry = self.mempool.get(iv.hash)
+                if not entry:
+                    notfound.append(iv)
+                elif iv.type & MSG_WITNESS_FLAG:
+                    self.send_msg(fd, Message("tx", entry.raw))
+                else:
+                    self.send_msg(fd, Message("tx", entry.tx().tobytes(False)))
+                continue
+            if type not in (MSG_BLOCK, MSG_FILTERED_BLOCK, MSG_CMPCT_BLOCK):
+                notfound.append(iv)
+                continue
+
+            if type == MSG_FILTERED_BLOCK:
+                # nothing to filter with, ignored like other nodes do
+                if not self.nodes[fd].bloom:
+                    continue
+                filtered = self.filtered_block(iv.hash)
+                if not filtered:
+                    notfound.append(iv)
+                    continue
+                self.send_filtered_block(fd, *filtered)
+                continue
 
+            data = self.db.get_block(iv.hash)
+            if data is None:
+                notfound.append(iv)
+                continue
+            if type == MSG_CMPCT_BLOCK and self.nodes[fd].cmpct:
+                entry = self.index.get(iv.hash)
+                if entry and self.index.height() - entry.height <= compact.MAX_CMPCTBLOCK_DEPTH:
+                    self.send_msg(fd, Message("cmpctblock", compact.make_cmpctblock(LazyBlock(data)).tobytes()))
+                    continue
+            self.send_msg(fd, Message("block", data))
+
+        if notfound:
+            self.send_msg(fd, Message("notfound", NotFound(notfound).tobytes()))
+
+    # merkle tree of a stored block, kept around so proofs for the
+    # same block don't rehash it
+    def merkle_tree(self, block):
+        key = block.header.hash
+        tree = self.merkle_trees.get(key)
+        if tree:
+            self.merkle_trees.move_to_end(key)
+            return tree
+
+        tree = MerkleTree(block.txids())
+        self.merkle_trees[key] = tree
+        if len(self.merkle_trees) > config.merkle_cache_size:
+            self.merkle_trees.popitem(last = False)
+        return tree
+
+    # block: Block or LazyBlock, matches: indexes of the txs to prove
+    def send_merkleblock(self, fd, block, matches):
+        pmt = self.merkle_tree(block).partial(matches)
+        self.send_msg(fd, Message("merkleblock", MerkleBlock(block.header, pmt).tobytes()))
+
+    # ret: (LazyBlock, its BIP37 match data), shared by the peers asking
+    # for the block. None if we don't have it
+    def filtered_block(self, hash):
+        filtered = self.filtered_blocks.get(hash)
+        if filtered:
+            self.filtered_blocks.move_to_end(hash)
+            return filtered
+
+        data = self.db.get_block(hash)
+        if data is None:
+            return None
+        block = LazyBlock(data)
+        filtered = (block, bloom.block_elements(block))
+        self.filtered_blocks[hash] = filtered
+        if len(self.filtered_blocks) > config.filter_cache_size:
+            self.filtered_blocks.popitem(last = False)
+        return filtered
+
+    # merkleblock with the txs matching the peer's filter, then those txs
+    def send_filtered_block(self, fd, block, elements):
+        matches = self.nodes[fd].bloom.match(elements)
+        self.send_merkleblock(fd, block, matches)
+        for i in matches:
+            self.send_msg(fd, Message("tx", block.tx(i).tobytes(False)))
+
+    # the peer doesn't have the txs anymore, they may be asked from others
     def handle_NotFound(self, fd, payload):
-        pass
+        for iv in payload.inventory:
+            request = self.tx_requests.get(iv.hash)
+            if request and request[0] == fd:
+                self.tx_request_done(iv.hash)
+
+    # entries of the active chain after the first known locator, up to stop
+    def chain_after(self, payload, limit):
+        entry = self.index.locate(payload.locators)
+        entries = []
+        while len(entries) < limit:
+            entry = self.index.at_height(entry.height + 1)
+            if not entry:
+                break
+            entries.append(entry)
+            if entry.hash == payload.stop:
+                break
+        return entries
 
     def handle_GetBlocks(self, fd, payload):
-        pass
+        entries = self.chain_after(payload, 500)
+        if entries:
+            inventory = [InvVect(MSG_BLOCK, entry.hash) for entry in entries]
+            self.send_msg(fd, Message("inv", Inv(inventory).tobytes()))
 
     def handle_GetHeaders(self, fd, payload):
-        # do nothing
-        pass
+        entries = self.chain_after(payload, MAX_HEADERS)
+        headers = [entry.header() for entry in entries]
+        self.send_msg(fd, Message("headers", Headers(headers).tobytes()))
 
+    # the scripts are checked off the loop, on_tx_checked() goes on
     def handle_Tx(self, fd, payload):
-        pass
+        self.tx_request_done(payload.txid)
+        (future, reason) = self.mempool.begin(payload)
+        if not future:
+            lib.debug("tx {} from {} rejected: {}", payload.txid[::-1].hex(), fd, reason)
+            return
+        self.when_done(future, lambda error: self.on_tx_checked(fd, payload, error))
+
+    def on_tx_checked(self, fd, tx, error):
+        (entry, reason) = self.mempool.finish(tx, error)
+        if not entry:
+            lib.debug("tx {} from {} rejected: {}", tx.txid[::-1].hex(), fd, reason)
+            return
+        lib.debug("tx {} accepted, fee rate {}, mempool {} txs {} bytes", entry.txid[::-1].hex(),
+            entry.feerate, len(self.mempool), self.mempool.usage)
+        self.relay_tx(entry, fd)
+
+    # announce a new mempool entry to the peers that want txs and whose fee
+    # filter it passes
+    def relay_tx(self, entry, source = None):
+        msg = Message("inv", Inv([InvVect(MSG_TX, entry.txid)]).tobytes())
+        elements = None
+        for fd, node in list(self.nodes.items()):
+            if fd == source or not node.ready or node.debug or not node.relay or entry.feerate < node.feefilter:
+                continue
+            if node.bloom:
+                if elements is None:
+                    elements = bloom.Elements([entry.tx()])
+                if not node.bloom.match(elements):
+                    continue
+            self.send_msg(fd, msg)
 
     def handle_Block(self, fd, payload):
-        pass
+        self.on_block(fd, payload)
+
+    def on_block(self, fd, block):
+        self.sync.on_block(fd, block)
+        if self.index.tip().hash == block.hash:
+            self.use_hb_peer(fd)
+
+    # fd delivered our new tip: have it announce the next blocks with
+    # cmpctblock right away. The config.cmpct_hb_peers that did so last
+    # are kept, like other nodes do
+    def use_hb_peer(self, fd):
+        node = self.nodes.get(fd)
+        if not node or not node.cmpct or fd in self.hb_peers:
+            return
+        self.hb_peers.append(fd)
+        self.send_msg(fd, Message("sendcmpct", SendCmpct(1, 2).tobytes()))
+        while len(self.hb_peers) > config.cmpct_hb_peers:
+            old = self.hb_peers.popleft()
+            if old in self.nodes:
+                self.send_msg(old, Message("sendcmpct", SendCmpct(0, 2).tobytes()))
+
+    # a new tip once we are synced: cmpctblock to the peers that asked for
+    # it, headers or inv to the others
+    def announce_block(self, block):
+        cmpct = None
+        for fd, node in list(self.nodes.items()):
+            if not node.ready or node.debug:
+                continue
+            if node.cmpct_announce:
+                if cmpct is None:
+                    cmpct = Message("cmpctblock", compact.make_cmpctblock(block).tobytes())
+                self.send_msg(fd, cmpct)
+            elif node.send_headers:
+                self.send_msg(fd, Message("headers", Headers([block.header]).tobytes()))
+            else:
+                self.send_msg(fd, Message("inv", Inv([InvVect(MSG_BLOCK, block.hash)]).tobytes()))
 
     def handle_Headers(self, fd, payload):
-        pass
+        self.sync.on_headers(fd, payload.headers)
 
     def handle_GetAddr(self, fd, payload):
-        pass
+        addrs = [NetAddr(info.time, info.services, info.ip, info.port) for info in self.addrman.sample(MAX_ADDR)]
+        self.send_msg(fd, Message("addr", Addr(addrs).tobytes()))
  
     def handle_MemPool(self, fd, payload):
-        pass
+        node = self.nodes[fd]
+        txids = self.mempool.txids(node.feefilter)
+        if node.bloom:
+            txids = [txid for txid in txids if node.bloom.match_tx(self.mempool.get(txid).tx())]
+        for i in range(0, len(txids), MAX_INV):
+            inventory = [InvVect(MSG_TX, txid) for txid in txids[i:i + MAX_INV]]
+            self.send_msg(fd, Message("inv", Inv(inventory).tobytes()))
 
     def handle_CheckOrder(self, fd, payload):
         pass
@@ -246,43 +905,133 @@ class BitCoin:
         self.send_msg(fd, msg)
 
     def handle_Pong(self, fd, payload):
-        pass
+        node = self.nodes[fd]
+        if payload.nonce == node.ping_nonce:
+            node.ping_nonce = 0
 
     def handle_Reject(self, fd, payload):
         pass
 
+    # BIP37: peers sending oversized filters or elements are dropped
     def handle_FilterLoad(self, fd, payload):
-        pass
+        node = self.nodes[fd]
+        if len(payload.filter) > bloom.MAX_FILTER_SIZE or payload.nhashes > bloom.MAX_HASH_FUNCS:
+            lib.err("{}: filterload of {} bytes, {} hash funcs", fd, len(payload.filter), payload.nhashes)
+            self.sock_close(node.sock)
+            return
+        node.bloom = bloom.BloomFilter(payload.filter, payload.nhashes, payload.tweak, payload.flags)
+        node.relay = True
 
-    def handle_FileterAdd(self, fd, payload):
-        pass
+    def handle_FilterAdd(self, fd, payload):
+        node = self.nodes[fd]
+        if len(payload.data) > bloom.MAX_ELEMENT_SIZE or not node.bloom:
+            lib.err("{}: filteradd of {} bytes{}", fd, len(payload.data), "" if node.bloom else " without a filter")
+            self.sock_close(node.sock)
+            return
+        node.bloom.insert(payload.data)
 
     def handle_FilterClear(self, fd, payload):
-        pass
+        node = self.nodes[fd]
+        node.bloom = None
+        node.relay = True
 
     def handle_MerkleBlock(self, fd, payload):
-        pass
+        root, matched = payload.pmt.extract()
+        if root is None or root != payload.header.merkle:
+            lib.err("invalid merkleblock from {}", fd)
+            return
+        lib.debug("merkleblock {}: {} matched txs", payload.header.hash[::-1].hex(), len(matched))
 
     def handle_Alert(self, fd, payload):
         pass
 
     def handle_SendHeaders(self, fd, payload):
-        pass
+        self.nodes[fd].send_headers = True
 
     def handle_FeeFilter(self, fd, payload):
-        pass
+        self.nodes[fd].feefilter = payload.feerate
 
+    # BIP152, only version 2 (wtxid short ids) is spoken
     def handle_SendCmpct(self, fd, payload):
-        pass
+        if payload.version != 2:
+            return
+        node = self.nodes[fd]
+        node.cmpct = True
+        node.cmpct_announce = payload.announce != 0
 
     def handle_CmpctBlock(self, fd, payload):
-        pass
+        node = self.nodes[fd]
+        hash = payload.header.hash
+        entry = self.index.get(hash)
+        if entry and entry.status & (BLOCK_HAVE_DATA | BLOCK_FAILED):
+            return
+        prev = self.index.get(payload.header.prev)
+        if not prev:
+            self.sync.on_announce(fd, hash)
+            return
+        # before hashing the mempool for it
+        err = check_header(payload.header, prev)
+        if err:
+            lib.err("cmpctblock {} from {}: {}", hash[::-1].hex(), fd, err)
+            return
 
-    def handle_GetBlockTxn(self, fd, payload):
-        pass
+        partial, reason = compact.reconstruct(payload, self.mempool)
+        if not partial:
+            lib.info("cmpctblock {} from {}: {}, getting the full block", hash[::-1].hex(), fd, reason)
+            self.request_block(fd, hash)
+            return
+        missing = partial.missing()
+        lib.debug("cmpctblock {}: {} txs, {} missing", hash[::-1].hex(), len(partial.txs), len(missing))
+        if missing:
+            node.partial = (hash, partial)
+            self.send_msg(fd, Message("getblocktxn", GetBlockTxn(hash, missing).tobytes()))
+            return
+        self.complete_block(fd, partial)
 
     def handle_BlockTxn(self, fd, payload):
-        pass
+        node = self.nodes[fd]
+        if not node.partial or node.partial[0] != payload.hash:
+            lib.err("unrequested blocktxn {} from {}", payload.hash[::-1].hex(), fd)
+            return
+        (hash, partial) = node.partial
+        node.partial = None
+        if not partial.fill(payload.txs):
+            lib.err("blocktxn {} from {}: wrong tx count", hash[::-1].hex(), fd)
+            self.request_block(fd, hash)
+            return
+        self.complete_block(fd, partial)
+
+    def complete_block(self, fd, partial):
+        block = partial.block()
+        if not block:
+            # a short id matched the wrong mempool tx
+            lib.info("cmpctblock {}: merkle root mismatch, getting the full block", partial.header.hash[::-1].hex())
+            self.request_block(fd, partial.header.hash)
+            return
+        self.on_block(fd, block)
+
+    def request_block(self, fd, hash):
+        self.send_msg(fd, Message("getdata", GetData([InvVect(MSG_BLOCK | MSG_WITNESS_FLAG, hash)]).tobytes()))
+
+    def handle_GetBlockTxn(self, fd, payload):
+        entry = self.index.get(payload.hash)
+        if not entry or not entry.status & BLOCK_HAVE_DATA:
+            return
+        data = self.db.get_block(payload.hash)
+        if data is None:
+            # indexed as stored, but not in the store (yet)
+            self.send_msg(fd, Message("notfound", NotFound([InvVect(MSG_BLOCK, payload.hash)]).tobytes()))
+            return
+        if self.index.height() - entry.height > compact.MAX_BLOCKTXN_DEPTH:
+            self.send_msg(fd, Message("block", data))
+            return
+        block = LazyBlock(data)
+        if payload.indexes and payload.indexes[-1] >= len(block):
+            lib.err("{}: getblocktxn index {} of {}", fd, payload.indexes[-1], len(block))
+            self.sock_close(self.nodes[fd].sock)
+            return
+        txs = [bytes(block.tx_bytes(i)) for i in payload.indexes]
+        self.send_msg(fd, Message("blocktxn", BlockTxn(payload.hash, txs).tobytes()))
 
     # debug handlers
     def debug_nodes(self, fd):
@@ -290,3 +1039,22 @@ class BitCoin:
         for k, v in self.nodes.items():
             msg += "{}:\n{}\n".format(k, v)
         self.send_debug_msg(fd, msg)
+
+    # message counters, handler and loop timings
+    def debug_metrics(self, fd):
+        if not self.metrics:
+            self.send_debug_msg(fd, "metrics are off, set config.metrics_enabled")
+            return
+        self.send_debug_msg(fd, self.metrics.summary(self.nodes))
+
+    # the same in the Prometheus text format
+    def debug_prometheus(self, fd):
+        if not self.metrics:
+            self.send_debug_msg(fd, "metrics are off, set config.metrics_enabled")
+            return
+        self.send_debug_msg(fd, self.metrics.prometheus(self.nodes))
+
+    def debug_metrics_reset(self, fd):
+        if self.metrics:
+            self.metrics.reset()
+        self.send_debug_msg(fd, "ok")
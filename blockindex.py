@@ -0,0 +1,255 @@
+import codec
+import lib
+from structs import BlockHeader
+
+# status flags
+BLOCK_VALID_HEADER = 1  # header connects and has enough work
+BLOCK_HAVE_DATA = 2     # full block is stored
+BLOCK_CONNECTED = 4     # block is connected to the utxo set
+BLOCK_FAILED = 8        # block or an ancestor is invalid
+BLOCK_STALE = 16        # on a branch forking below the active tip, reorgs aren't supported
+
+INDEX_PREFIX = b"i"     # db key: "i" + hash -> header(80) height(4) status(4)
+TIP_KEY = b"tip"        # db key: hash of the active chain tip
+
+def bits_to_target(bits):
+    size = bits >> 24
+    mantissa = bits & 0x007FFFFF
+    if size <= 3:
+        return mantissa >> (8 * (3 - size))
+    return mantissa << (8 * (size - 3))
+
+def target_to_bits(target):
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    # the mantissa is signed, keep its top bit clear
+    if mantissa & 0x00800000:
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+def bits_to_work(bits):
+    target = bits_to_target(bits)
+    if target <= 0:
+        return 0
+    return (1 << 256) // (target + 1)
+
+def _invert_lowest_one(n):
+    return n & (n - 1)
+
+# height the skip pointer of a block at height jumps to (same as bitcoin core)
+def skip_height(height):
+    if height < 2:
+        return 0
+    if height & 1:
+        return _invert_lowest_one(_invert_lowest_one(height - 1)) + 1
+    return _invert_lowest_one(height)
+
+class BlockIndexEntry:
+    __slots__ = ("hash", "raw", "prev", "height", "chainwork", "status", "skip")
+
+    def __init__(self, hash, raw, prev, height, status):
+        self.hash = hash
+        self.raw = raw # 80 header bytes, decoded with header()
+        self.prev = prev # BlockIndexEntry or None
+        self.height = height
+        self.status = status
+        self.chainwork = (prev.chainwork if prev else 0) + bits_to_work(codec.BLOCKHEADER.unpack_from(raw)[4])
+        self.skip = prev.ancestor(skip_height(height)) if prev else None
+
+    def header(self):
+        return BlockHeader.load(self.raw)[0]
+
+    def timestamp(self):
+        return codec.BLOCKHEADER.unpack_from(self.raw)[3]
+
+    def bits(self):
+        return codec.BLOCKHEADER.unpack_from(self.raw)[4]
+
+    # median timestamp of this block and its 10 ancestors
+    def median_time(self):
+        times = []
+        entry = self
+        while entry and len(times) < 11:
+            times.append(entry.timestamp())
+            entry = entry.prev
+        times.sort()
+        return times[len(times) // 2]
+
+    # ancestor at height, O(log n) through the skip pointers
+    def ancestor(self, height):
+        if height > self.height or height < 0:
+            return None
+        entry = self
+        walk = self.height
+        while walk > height:
+            skip = skip_height(walk)
+            prev_skip = skip_height(walk - 1)
+            if entry.skip and (skip == height or (skip > height and not (prev_skip < skip - 2 and prev_skip >= height))):
+                entry = entry.skip
+                walk = skip
+            else:
+                entry = entry.prev
+                walk -= 1
+        return entry
+
+    def tobytes(self):
+        return self.raw + codec.U32.pack(self.height) + codec.U32.pack(self.status)
+
+    def __str__(self):
+        return "{} height: {} status: {}".format(self.hash[::-1].hex(), self.height, self.status)
+
+# In-memory index of every known header, persisted in the DataBase.
+# chain[height] is the active chain, best_header the entry with most work.
+# Writing methods take an optional db.WriteBatch to commit with.
+class BlockIndex:
+    def __init__(self, db):
+        self.db = db
+        self.entries = {} # hash -> BlockIndexEntry
+        self.chain = []
+        self.best_header = None
+        self.load()
+
+    def load(self):
+        records = []
+        for key, value in self.db.items(INDEX_PREFIX):
+            # blocks of older databases are keyed by bare hash, some start with "i"
+            if len(key) != 33:
+                continue
+            (height, status) = codec.get("<II").unpack_from(value, 80)
+            records.append((height, key[1:], bytes(value[:80]), status))
+        # parents first
+        records.sort(key = lambda r: r[0])
+        for height, hash, raw, status in records:
+            prev = self.entries.get(raw[4:36])
+            if height > 0 and not prev:
+                lib.err("block index: orphan entry {}", hash[::-1].hex())
+                continue
+            self.insert(BlockIndexEntry(hash, raw, prev, height, status))
+
+        tip = self.entries.get(self.db.get(TIP_KEY))
+        if tip:
+            self.set_tip(tip, False)
+        lib.info("block index: {} headers, tip height {}", len(self.entries), self.height())
+
+    def insert(self, entry):
+        self.entries[entry.hash] = entry
+        if not self.best_header or entry.chainwork > self.best_header.chainwork:
+            if not entry.status & (BLOCK_FAILED | BLOCK_STALE):
+                self.best_header = entry
+
+    def get(self, hash):
+        return self.entries.get(hash)
+
+    # ret: entry of header, None if its parent is unknown
+    def add(self, header, status = BLOCK_VALID_HEADER, batch = None):
+        hash = header.hash
+        entry = self.entries.get(hash)
+        if entry:
+            return entry
+
+        prev = self.entries.get(header.prev)
+        if not prev and self.entries:
+            return None
+        height = prev.height + 1 if prev else 0
+        if prev:
+            status |= prev.status & BLOCK_STALE
+        entry = BlockIndexEntry(hash, header.tobytes(), prev, height, status)
+        self.insert(entry)
+        self.save(entry, batch)
+        return entry
+
+    def save(self, entry, batch = None):
+        (batch if batch is not None else self.db).add(INDEX_PREFIX + entry.hash, entry.tobytes())
+
+    # mark entry invalid and fall back to the best header not built on it
+    def mark_failed(self, entry, batch = None):
+        self.raise_status(entry, BLOCK_FAILED, batch)
+        self.drop_branch(entry)
+
+    # mark entry and every header built on it stale, they are no longer
+    # followed, and fall back to the best header off that branch
+    def mark_stale(self, entry, batch = None):
+        for other in list(self.entries.values()):
+            if other.ancestor(entry.height) is entry:
+                self.raise_status(other, BLOCK_STALE, batch)
+        self.drop_branch(entry)
+
+    # best_header = the entry with most work not built on entry
+    def drop_branch(self, entry):
+        self.best_header = None
+        for other in self.entries.values():
+            if other.status & (BLOCK_FAILED | BLOCK_STALE) or other.ancestor(entry.height) is entry:
+                continue
+            if not self.best_header or other.chainwork > self.best_header.chainwork:
+                self.best_header = other
+
+    def raise_status(self, entry, status, batch = None):
+        if entry.status & status == status:
+            return
+        entry.status |= status
+        self.save(entry, batch)
+
+    def tip(self):
+        return self.chain[-1] if self.chain else None
+
+    def height(self):
+        return len(self.chain) - 1
+
+    def contains(self, entry):
+        return entry.height < len(self.chain) and self.chain[entry.height] is entry
+
+    def at_height(self, height):
+        if height < 0 or height >= len(self.chain):
+            return None
+        return self.chain[height]
+
+    def height_of(self, hash):
+        entry = self.entries.get(hash)
+        return entry.height if entry else -1
+
+    # switch the active chain to end at entry, only the diverging part is rewritten
+    def set_tip(self, entry, persist = True, batch = None):
+        del self.chain[entry.height + 1:]
+        while len(self.chain) <= entry.height:
+            self.chain.append(None)
+        walk = entry
+        while walk and self.chain[walk.height] is not walk:
+            self.chain[walk.height] = walk
+            walk = walk.prev
+        if persist:
+            (batch if batch is not None else self.db).add(TIP_KEY, entry.hash)
+
+    # last common entry of the active chain and entry
+    def find_fork(self, entry):
+        if entry.height > self.height():
+            entry = entry.ancestor(self.height())
+        while entry and not self.contains(entry):
+            entry = entry.prev
+        return entry
+
+    # block locator hashes from entry (default the tip) back to genesis
+    def locator(self, entry = None):
+        entry = entry or self.tip()
+        hashes = []
+        step = 1
+        while entry:
+            hashes.append(entry.hash)
+            if entry.height == 0:
+                break
+            height = max(entry.height - step, 0)
+            entry = self.chain[height] if self.contains(entry) else entry.ancestor(height)
+            if len(hashes) > 10:
+                step *= 2
+        return hashes
+
+    # first locator hash that is on the active chain, genesis if none
+    def locate(self, locators):
+        for hash in locators:
+            entry = self.entries.get(hash)
+            if entry and self.contains(entry):
+                return entry
+        return self.at_height(0)
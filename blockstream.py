@@ -0,0 +1,104 @@
+import hashlib
+import struct
+import codec
+import config
+import lib
+from structs import *
+from recvbuf import RecvBuffer
+
+# Push-style block parser. Feed it the block payload in chunks as they come
+# off the socket, it calls on_header(header) once the 80 header bytes are in
+# and on_tx(index, tx) for every transaction as soon as it is complete.
+# Parsed bytes are dropped right away, so only the unfinished tx is buffered.
+class BlockParser:
+    def __init__(self, on_header = None, on_tx = None):
+        self.on_header = on_header
+        self.on_tx = on_tx
+        self.buf = RecvBuffer()
+        self.header = None
+        self.count = None
+        self.txs = []
+        # don't retry a partial tx until this many bytes are buffered,
+        # so a large tx is re-parsed O(log size) times, not once per chunk
+        self.retry_at = 0
+
+    def feed(self, data):
+        self.buf.write(data)
+        if len(self.buf) >= self.retry_at:
+            self.parse()
+
+    def done(self):
+        return self.count is not None and len(self.txs) >= self.count
+
+    def block(self):
+        if not self.done():
+            return None
+        return Block(self.header, self.txs)
+
+    def parse(self):
+        data = self.buf.view()
+        offset = 0
+        try:
+            if not self.header:
+                if len(data) < 80:
+                    return
+                self.header, offset = BlockHeader.load_from(data, offset)
+                if self.on_header:
+                    self.on_header(self.header)
+
+            if self.count is None:
+                vi, offset = VarInt.load_from(data, offset)
+                self.count = vi.value
+
+            while len(self.txs) < self.count:
+                tx, offset = Tx.load_from(data, offset)
+                self.txs.append(tx)
+                if self.on_tx:
+                    self.on_tx(len(self.txs) - 1, tx)
+            self.retry_at = 0
+        except (IndexError, struct.error):
+            # incomplete, wait for more data
+            self.retry_at = (len(data) - offset) * 3 // 2
+        finally:
+            data.release()
+            self.buf.consume(offset)
+
+# A message whose payload is streamed into a BlockParser instead of being
+# buffered whole. Tracks the remaining length and the running checksum.
+class PayloadStream:
+    def __init__(self, command, length, checksum, parser):
+        self.command = command
+        self.length = length
+        self.remaining = length
+        self.checksum = checksum
+        self.parser = parser
+        self.sha = hashlib.sha256()
+
+    @staticmethod
+    # ret: PayloadStream for the message header at offset, None if it shouldn't be streamed
+    def start(buf, offset, parser):
+        (command, length, checksum) = codec.MSGLENGTH.unpack_from(buf, offset + 4)
+        if command.rstrip(b"\x00") != b"block" or length < config.stream_min_size:
+            return None
+        return PayloadStream("block", length, checksum, parser)
+
+    # ret: bytes consumed from data
+    def feed(self, data):
+        data = data[:self.remaining]
+        self.sha.update(data)
+        self.parser.feed(data)
+        self.remaining -= len(data)
+        if self.remaining <= 0:
+            # the last bytes may be below the parser's retry threshold
+            self.parser.parse()
+        return len(data)
+
+    def done(self):
+        return self.remaining <= 0
+
+    def checksum_ok(self):
+        checksum = hashlib.sha256(self.sha.digest()).digest()[:4]
+        if checksum != self.checksum:
+            lib.err("<{}> checksum failed: {}, {}", self.command, self.checksum, checksum)
+            return False
+        return True
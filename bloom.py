@@ -0,0 +1,364 @@
+import heapq
+import math
+from array import array
+from itertools import compress
+import codec
+import validation
+
+# Remembers roughly the last count..2*count keys in fixed memory, with
+# false positives at about fp_rate. Two generations of bit arrays, each
+# sized for count keys: keys go into the current one, and once it holds
+# count the older one is cleared and becomes current.
+#
+# Bit positions come from python's hash() of the key, which is keyed per
+# process (unless PYTHONHASHSEED is set), so peers can't grind hashes that
+# collide with ours.
+class RollingBloomFilter:
+    def __init__(self, count, fp_rate):
+        self.count = count
+        # two generations are checked, each gets half the rate
+        bits = -count * math.log(fp_rate / 2) / (math.log(2) ** 2)
+        self.nbytes = max(1, int(bits) // 8)
+        self.bits = self.nbytes * 8
+        self.k = max(1, min(50, round(self.bits / count * math.log(2))))
+        self.gens = [bytearray(self.nbytes), bytearray(self.nbytes)]
+        self.added = 0 # keys in gens[0]
+
+    def add(self, key):
+        if self.added >= self.count:
+            self.gens.reverse()
+            self.gens[0][:] = bytes(self.nbytes)
+            self.added = 0
+        gen = self.gens[0]
+        h = hash(key)
+        pos = h & 0xFFFFFFFF
+        step = ((h >> 32) & 0xFFFFFFFF) | 1
+        bits = self.bits
+        for _ in range(self.k):
+            pos = (pos + step) % bits
+            gen[pos >> 3] |= 1 << (pos & 7)
+        self.added += 1
+
+    # stops at the first clear bit, so keys not in the filter are cheap
+    def __contains__(self, key):
+        h = hash(key)
+        start = h & 0xFFFFFFFF
+        step = ((h >> 32) & 0xFFFFFFFF) | 1
+        bits = self.bits
+        for gen in self.gens:
+            pos = start
+            for _ in range(self.k):
+                pos = (pos + step) % bits
+                if not gen[pos >> 3] & (1 << (pos & 7)):
+                    break
+            else:
+                return True
+        return False
+
+# BIP37 filters, set by light clients with filterload
+
+MAX_FILTER_SIZE = 36000 # bytes
+MAX_HASH_FUNCS = 50
+MAX_ELEMENT_SIZE = 520 # filteradd data
+
+# nFlags: what to add when an output matches
+BLOOM_UPDATE_NONE = 0
+BLOOM_UPDATE_ALL = 1 # the outpoint, so spends of it match too
+BLOOM_UPDATE_P2PUBKEY_ONLY = 2 # the outpoint of pay to pubkey and multisig outputs only
+BLOOM_UPDATE_MASK = 3
+
+M32 = 0xFFFFFFFF
+C1 = 0xCC9E2D51
+C2 = 0x1B873593
+
+def _mix(k):
+    k = k * C1 & M32
+    k = (k << 15 | k >> 17) & M32
+    return k * C2 & M32
+
+# MurmurHash3 x86_32 in two steps. The mixing of each 4 byte block doesn't
+# depend on the seed, prepare() does it once per element and murmur3_prepared()
+# finishes the hash for each of the filter's seeds.
+# ret: (mixed blocks, mixed tail, length)
+def prepare(data):
+    n = len(data) // 4
+    blocks = tuple(_mix(k) for k in codec.get("<{}I".format(n)).unpack_from(data, 0)) if n else ()
+    tail = data[n * 4:]
+    return (blocks, _mix(int.from_bytes(tail, "little")) if tail else 0, len(data))
+
+def murmur3_prepared(element, seed):
+    (blocks, tail, length) = element
+    h = seed
+    for k in blocks:
+        h ^= k
+        h = (h << 13 | h >> 19) & M32
+        h = (h * 5 + 0xE6546B64) & M32
+    h ^= tail ^ length
+    h ^= h >> 16
+    h = h * 0x85EBCA6B & M32
+    h ^= h >> 13
+    h = h * 0xC2B2AE35 & M32
+    return h ^ h >> 16
+
+def murmur3(seed, data):
+    return murmur3_prepared(prepare(data), seed)
+
+# data of every push in script, other opcodes are skipped
+def script_pushes(script):
+    items = []
+    i = 0
+    while i < len(script):
+        op = script[i]
+        i += 1
+        if op > 78:
+            continue
+        if op < 76:
+            size = op
+        elif op == 76:
+            if i + 1 > len(script):
+                break
+            size = script[i]
+            i += 1
+        elif op == 77:
+            if i + 2 > len(script):
+                break
+            (size, ) = codec.U16.unpack_from(script, i)
+            i += 2
+        else:
+            if i + 4 > len(script):
+                break
+            (size, ) = codec.U32.unpack_from(script, i)
+            i += 4
+        if i + size > len(script):
+            break
+        if size:
+            items.append(bytes(script[i:i + size]))
+        i += size
+    return items
+
+def is_pubkey_script(script):
+    if validation.is_p2pk(script):
+        return True
+    # bare multisig: OP_m <pubkeys> OP_n OP_CHECKMULTISIG
+    return len(script) >= 3 and 0x51 <= script[0] <= 0x60 and 0x51 <= script[-2] <= 0x60 and script[-1] == 0xAE
+
+# Many elements hashed at once: element i's 32 bit word sits in bits
+# 64 * i .. 64 * i + 31 of one python int, so xor, shifts and products
+# with 32 bit constants work on every lane per operation. Products stay
+# below 2^64, what spills past bit 31 is masked off.
+class ElementGroup:
+    def __init__(self, indexes, datas):
+        self.indexes = indexes # into Elements.data
+        self.count = len(datas)
+        self.ones = int.from_bytes(codec.U64.pack(1) * self.count, "little")
+        self.mask = M32 * self.ones
+        size = len(datas[0])
+        n = size // 4
+        words = array("I", b"".join(data[:n * 4] for data in datas))
+        self.blocks = [self.mix(self.pack(words[j::n])) for j in range(n)] if n else []
+        tail = 0
+        if size % 4:
+            tail = self.mix(self.pack(array("I", b"".join(data[n * 4:].ljust(4, b"\0") for data in datas))))
+        self.final = tail ^ size * self.ones
+
+    def pack(self, words):
+        return int.from_bytes(array("Q", words).tobytes(), "little")
+
+    def mix(self, k):
+        mask = self.mask
+        k = k * C1 & mask
+        k = (k << 15 | k >> 17) & mask
+        return k * C2 & mask
+
+    # ret: murmur3 of every element with seed, array of 64 bit lanes
+    def murmur3(self, seed):
+        mask = self.mask
+        add = 0xE6546B64 * self.ones
+        h = seed * self.ones
+        for k in self.blocks:
+            h ^= k
+            h = (h << 13 | h >> 19) & mask
+            h = (h * 5 + add) & mask
+        h ^= self.final
+        h = (h ^ h >> 16) & mask
+        h = h * 0x85EBCA6B & mask
+        h = (h ^ h >> 13) & mask
+        h = h * 0xC2B2AE35 & mask
+        h = (h ^ h >> 16) & mask
+        return array("Q", h.to_bytes(8 * self.count, "little"))
+
+# What BIP37 matches in some txs (those of a block, or a single one):
+# txs[i] = (txid, txid element, [(output push elements, is pubkey
+# script)], [(outpoint element, input push elements)]), elements being
+# indexes into data, owner[element] the index of its tx. Doesn't depend on
+# any filter, so the elements of a block are built once and shared by
+# every peer asking for it.
+class Elements:
+    def __init__(self, txs):
+        self.data = []
+        self.owner = array("I")
+        self.txs = []
+        for n, tx in enumerate(txs):
+            outputs = []
+            for out in tx.txout:
+                script = out.script.string
+                outputs.append(([self.add(item, n) for item in script_pushes(script)], is_pubkey_script(script)))
+            inputs = [(self.add(txin.prev.tobytes(), n), [self.add(item, n) for item in script_pushes(txin.script.string)])
+                for txin in tx.txin]
+            self.txs.append((tx.txid, self.add(tx.txid, n), outputs, inputs))
+
+        sizes = {}
+        for i, data in enumerate(self.data):
+            sizes.setdefault(len(data), []).append(i)
+        self.groups = [ElementGroup(indexes, [self.data[i] for i in indexes]) for indexes in sizes.values()]
+
+    def add(self, data, owner):
+        self.data.append(data)
+        self.owner.append(owner)
+        return len(self.data) - 1
+
+def block_elements(block):
+    return Elements(block.tx(i) for i in range(len(block)))
+
+# a byte's bits as 8 bytes of 0 or 1
+EXPAND = [bytes(b >> j & 1 for j in range(8)) for b in range(256)]
+
+class BloomFilter:
+    def __init__(self, data, nhashes, tweak, flags):
+        self.data = bytearray(data)
+        self.bits = len(data) * 8
+        self.seeds = [(i * 0xFBA4C795 + tweak) & M32 for i in range(nhashes)]
+        self.flags = flags & BLOOM_UPDATE_MASK
+        self.full = all(b == 0xFF for b in self.data)
+        self.empty = not any(self.data)
+        # one byte per bit, built by the first match(). Up to 288KB, but
+        # lets whole lists of positions be tested by map()
+        self.bitmap = None
+
+    # ret: the first clear bit element hashes to, -1 if there is none.
+    # Stops there, most elements don't match
+    def clear_bit(self, element, seeds = None):
+        data = self.data
+        bits = self.bits
+        for seed in self.seeds if seeds is None else seeds:
+            pos = murmur3_prepared(element, seed) % bits
+            if not data[pos >> 3] & (1 << (pos & 7)):
+                return pos
+        return -1
+
+    def contains(self, data):
+        if self.full or not self.seeds:
+            return True
+        if self.empty:
+            return False
+        return self.clear_bit(prepare(data)) < 0
+
+    # ret: positions of the bits it set
+    def insert(self, data):
+        if self.full or not self.bits:
+            return []
+        element = prepare(data)
+        added = []
+        for seed in self.seeds:
+            pos = murmur3_prepared(element, seed) % self.bits
+            bit = 1 << (pos & 7)
+            if not self.data[pos >> 3] & bit:
+                self.data[pos >> 3] |= bit
+                if self.bitmap is not None:
+                    self.bitmap[pos] = 1
+                added.append(pos)
+        self.empty = False
+        return added
+
+    # ret: (hits, clear), hits the set of elements in the filter, clear[g][j]
+    # a clear bit the j-th element of group g hashes to, -1 for hits
+    def test(self, elements):
+        if self.bitmap is None:
+            self.bitmap = bytearray(b"".join(EXPAND[b] for b in self.data))
+        bitmap = self.bitmap
+        bits = self.bits
+        hits = set()
+        clear = []
+        for group in elements.groups:
+            indexes = group.indexes
+            # the first pass sees every element, keep it out of python loops
+            positions = [h % bits for h in group.murmur3(self.seeds[0])]
+            alive = list(compress(range(group.count), map(bitmap.__getitem__, positions)))
+            for n in range(1, len(self.seeds)):
+                if len(alive) * 64 < group.count:
+                    # cheaper to hash the few left one by one
+                    left = []
+                    for i in alive:
+                        positions[i] = pos = self.clear_bit(prepare(elements.data[indexes[i]]), self.seeds[n:])
+                        if pos < 0:
+                            left.append(i)
+                    alive = left
+                    break
+                hashes = group.murmur3(self.seeds[n])
+                left = []
+                for i in alive:
+                    pos = hashes[i] % bits
+                    if bitmap[pos]:
+                        left.append(i)
+                    else:
+                        positions[i] = pos
+                alive = left
+            for i in alive:
+                positions[i] = -1
+                hits.add(indexes[i])
+            clear.append(positions)
+        return (hits, clear)
+
+    # ret: indexes of the matching txs in elements. Outputs matching add
+    # their outpoint as nFlags say, so the txs spending them match later.
+    # Only txs with an element in the filter are looked at; after an
+    # insert, the later elements whose clear bit it set are checked again.
+    def match(self, elements):
+        if self.full or not self.seeds:
+            return list(range(len(elements.txs)))
+        if self.empty:
+            return []
+        (hits, clear) = self.test(elements)
+        owner = elements.owner
+        candidates = sorted(set(owner[i] for i in hits))
+        waiting = None # clear bit -> elements, built on the first insert
+        matches = []
+        last = -1
+        while candidates:
+            n = heapq.heappop(candidates)
+            if n == last:
+                continue
+            last = n
+            (txid, txid_element, outputs, inputs) = elements.txs[n]
+            found = txid_element in hits
+            for index, (pushes, pubkey) in enumerate(outputs):
+                if hits.isdisjoint(pushes):
+                    continue
+                found = True
+                if not (self.flags == BLOOM_UPDATE_ALL or (self.flags == BLOOM_UPDATE_P2PUBKEY_ONLY and pubkey)):
+                    continue
+                added = self.insert(codec.OUTPOINT.pack(txid, index))
+                if added and waiting is None:
+                    waiting = {}
+                    for group, positions in zip(elements.groups, clear):
+                        for i, pos in zip(group.indexes, positions):
+                            if pos >= 0 and owner[i] >= n:
+                                waiting.setdefault(pos, []).append(i)
+                for pos in added:
+                    for i in waiting.pop(pos, ()):
+                        if owner[i] < n:
+                            continue
+                        pos = self.clear_bit(prepare(elements.data[i]))
+                        if pos < 0:
+                            hits.add(i)
+                            heapq.heappush(candidates, owner[i])
+                        else:
+                            waiting.setdefault(pos, []).append(i)
+            if not found:
+                found = any(outpoint in hits or not hits.isdisjoint(pushes) for outpoint, pushes in inputs)
+            if found:
+                matches.append(n)
+        return matches
+
+    def match_tx(self, tx):
+        return bool(self.match(Elements([tx])))
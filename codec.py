@@ -0,0 +1,45 @@
+import struct
+
+# Precompiled struct.Struct for every fixed wire layout. Hot paths use these
+# directly (codec.U32.unpack_from(buf, offset)) so no format string is looked
+# up per call. Layouts that aren't listed here go through get().
+
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+I32 = struct.Struct("<i")
+U64 = struct.Struct("<Q")
+BOOL = struct.Struct("<?")
+
+MSGHEADER = struct.Struct("<I12sI4s")    # magic, command, length, checksum
+MSGLENGTH = struct.Struct("<12sI4s")     # command, length, checksum (after magic)
+NETADDR = struct.Struct("<IQ16s")        # time, services, ip, then PORT
+VERSION_NETADDR = struct.Struct("<Q16s")
+PORT = struct.Struct(">H")               # network byte order
+INVVECT = struct.Struct("<I32s")
+OUTPOINT = struct.Struct("<32sI")
+BLOCKHEADER = struct.Struct("<i32s32sIII")
+VERSION = struct.Struct("<iQq26s")       # version, services, timestamp, addr_recv
+VERSION_FROM = struct.Struct("<26sQ")    # addr_from, nonce
+SENDCMPCT = struct.Struct("<BQ")
+
+registry = {}
+
+def get(fmt):
+    codec = registry.get(fmt)
+    if codec is None:
+        codec = struct.Struct(fmt)
+        registry[fmt] = codec
+    return codec
+
+def pack_into(fmt, buf, offset, *args):
+    codec = get(fmt)
+    codec.pack_into(buf, offset, *args)
+    return offset + codec.size
+
+def unpack_from(fmt, buf, offset = 0):
+    return get(fmt).unpack_from(buf, offset)
+
+for _name, _codec in list(globals().items()):
+    if isinstance(_codec, struct.Struct):
+        registry[_codec.format] = _codec
@@ -0,0 +1,198 @@
+import codec
+import config
+import lib
+
+COIN_PREFIX = b"c"  # db key: "c" + txid + index -> Coin
+
+# per entry bookkeeping on top of the script, roughly what the dict slot,
+# key bytes, CacheEntry and Coin objects cost
+ENTRY_OVERHEAD = 240
+
+DIRTY = 1   # differs from the view below
+FRESH = 2   # the view below doesn't have it, can be dropped once spent
+
+def coin_key(hash, index):
+    return COIN_PREFIX + hash + codec.U32.pack(index)
+
+# An unspent output
+class Coin:
+    __slots__ = ("value", "script", "height", "coinbase")
+
+    def __init__(self, value, script, height, coinbase):
+        self.value = value
+        self.script = script # bytes
+        self.height = height
+        self.coinbase = coinbase
+
+    @staticmethod
+    def load(data):
+        (value, code) = codec.get("<QI").unpack_from(data, 0)
+        return Coin(value, bytes(data[12:]), code >> 1, code & 1 == 1)
+
+    def tobytes(self):
+        return codec.get("<QI").pack(self.value, (self.height << 1) | int(self.coinbase)) + self.script
+
+class CacheEntry:
+    __slots__ = ("coin", "flags")
+
+    def __init__(self, coin, flags):
+        self.coin = coin # None once spent
+        self.flags = flags
+
+# Coins stored in the DataBase
+class CoinsViewDB:
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, key):
+        data = self.db.get(key)
+        if data is None:
+            return None
+        return Coin.load(data)
+
+    # batch: the caller's, written by the caller, otherwise one is written here
+    def write(self, entries, batch = None):
+        own = batch is None
+        if own:
+            batch = self.db.batch()
+        for key, entry in entries.items():
+            if entry.coin is None:
+                batch.delete(key)
+            else:
+                batch.add(key, entry.coin.tobytes())
+        if own:
+            self.db.write(batch)
+
+# Write-back cache over another view (CoinsViewDB or another cache).
+# Coins created and spent while cached (FRESH) never reach the view below,
+# dirty coins are written there in one batch by flush().
+class CoinsViewCache:
+    def __init__(self, base, budget = config.coins_cache_bytes):
+        self.base = base
+        self.budget = budget
+        self.cache = {}
+        self.usage = 0
+
+    def fetch(self, key):
+        entry = self.cache.get(key)
+        if entry:
+            return entry
+        coin = self.base.get(key)
+        if coin is None:
+            return None
+        entry = CacheEntry(coin, 0)
+        self.cache[key] = entry
+        self.usage += ENTRY_OVERHEAD + len(coin.script)
+        return entry
+
+    # view interface, ret: Coin or None if missing/spent
+    def get(self, key):
+        entry = self.fetch(key)
+        return entry.coin if entry else None
+
+    def get_coin(self, hash, index):
+        return self.get(coin_key(hash, index))
+
+    def add_coin(self, hash, index, coin):
+        key = coin_key(hash, index)
+        entry = self.cache.get(key)
+        if entry is None:
+            # new outputs can't be in the view below
+            self.cache[key] = CacheEntry(coin, DIRTY | FRESH)
+            self.usage += ENTRY_OVERHEAD + len(coin.script)
+            return
+
+        if entry.coin is not None:
+            self.usage -= len(entry.coin.script)
+        elif not entry.flags & DIRTY:
+            entry.flags |= FRESH
+        entry.coin = coin
+        entry.flags |= DIRTY
+        self.usage += len(coin.script)
+
+    # ret: the spent Coin, None if it doesn't exist or is already spent
+    def spend_coin(self, hash, index):
+        key = coin_key(hash, index)
+        entry = self.fetch(key)
+        if not entry or entry.coin is None:
+            return None
+        coin = entry.coin
+        if entry.flags & FRESH:
+            del self.cache[key]
+            self.usage -= ENTRY_OVERHEAD + len(coin.script)
+        else:
+            entry.coin = None
+            entry.flags |= DIRTY
+            self.usage -= len(coin.script)
+        return coin
+
+    # view interface, merge the dirty entries of a child cache into this one
+    def write(self, entries, batch = None):
+        for key, child in entries.items():
+            entry = self.cache.get(key)
+            if entry is None:
+                if child.flags & FRESH and child.coin is None:
+                    continue
+                self.cache[key] = CacheEntry(child.coin, DIRTY | (child.flags & FRESH))
+                self.usage += ENTRY_OVERHEAD + (len(child.coin.script) if child.coin else 0)
+                continue
+
+            if entry.coin is not None:
+                self.usage -= len(entry.coin.script)
+            if entry.flags & FRESH and child.coin is None:
+                del self.cache[key]
+                self.usage -= ENTRY_OVERHEAD
+                continue
+            entry.coin = child.coin
+            entry.flags |= DIRTY
+            if child.coin is not None:
+                self.usage += len(child.coin.script)
+
+    # write every dirty entry to the view below in one batch and empty the cache
+    def flush(self, batch = None):
+        dirty = {key: entry for key, entry in self.cache.items() if entry.flags & DIRTY}
+        if dirty:
+            self.base.write(dirty, batch)
+        self.cache = {}
+        self.usage = 0
+
+    # keep the cache within budget: drop clean entries first, flush if that's not enough
+    def trim(self, batch = None):
+        if self.usage <= self.budget:
+            return
+        for key in [key for key, entry in self.cache.items() if not entry.flags]:
+            entry = self.cache.pop(key)
+            self.usage -= ENTRY_OVERHEAD + len(entry.coin.script)
+        if self.usage > self.budget:
+            lib.debug("coins cache: flushing {} entries, {} bytes", len(self.cache), self.usage)
+            self.flush(batch)
+
+    # spend the inputs and add the outputs of block at height.
+    # check(block, spent coins) runs before anything is written here and
+    # can reject the block.
+    # ret: spent coins in input order (undo data), None if an input is missing
+    # or check failed, in which case this view is left untouched
+    def connect_block(self, block, height, check = None):
+        view = CoinsViewCache(self)
+        undo = []
+        for i, tx in enumerate(block.txs):
+            coinbase = i == 0
+            if not coinbase:
+                for txin in tx.txin:
+                    coin = view.spend_coin(txin.prev.hash, txin.prev.index)
+                    if coin is None:
+                        lib.err("missing input {}:{}", txin.prev.hash[::-1].hex(), txin.prev.index)
+                        return None
+                    undo.append(coin)
+
+            txid = tx.txid
+            for n, out in enumerate(tx.txout):
+                script = out.script.string
+                # OP_RETURN outputs can never be spent
+                if script[:1] == b"\x6a":
+                    continue
+                view.add_coin(txid, n, Coin(out.value, script, height, coinbase))
+        if check is not None and not check(block, undo):
+            return None
+        view.flush()
+        return undo
@@ -0,0 +1,98 @@
+import hashlib
+import random
+import codec
+from structs import Block
+from messages import CmpctBlock
+from siphash import siphash_many
+
+SHORTID_MASK = 0xFFFFFFFFFFFF # short ids are the low 6 bytes
+# 4M weight over 40, the weight of the smallest tx
+MAX_BLOCK_TXS = 100000
+# blocks deeper than this below the tip are served in full instead
+MAX_CMPCTBLOCK_DEPTH = 5
+MAX_BLOCKTXN_DEPTH = 10
+
+# siphash keys of a cmpctblock: the first 16 bytes of sha256(header || nonce)
+def shortid_keys(header, nonce):
+    digest = hashlib.sha256(header.tobytes() + codec.U64.pack(nonce)).digest()
+    return (int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:16], "little"))
+
+# block: Block or LazyBlock. Only the coinbase is prefilled, the peer is
+# expected to have the rest. Short ids are of wtxids (version 2), the
+# only version we speak
+def make_cmpctblock(block):
+    nonce = random.getrandbits(64)
+    (k0, k1) = shortid_keys(block.header, nonce)
+    if isinstance(block, Block):
+        (coinbase, wtxids) = (block.txs[0], [tx.wtxid for tx in block.txs[1:]])
+    else:
+        # hashed from the raw bytes, no need to decode the txs
+        (coinbase, wtxids) = (block.tx(0), [block.wtxid(i) for i in range(1, len(block))])
+    shortids = [h & SHORTID_MASK for h in siphash_many(k0, k1, wtxids)]
+    return CmpctBlock(block.header, nonce, shortids, [(0, coinbase)])
+
+# Rebuilds a block from a cmpctblock: prefilled txs, then mempool txs by
+# the short ids of their wtxids, hashed all at once. mempool: Mempool
+# ret: (PartialBlock, None), (None, reason) if short ids collide and the
+# full block is needed. Raises ValueError if cmpct is invalid
+def reconstruct(cmpct, mempool):
+    count = len(cmpct.shortids) + len(cmpct.prefilled)
+    if not count or count > MAX_BLOCK_TXS:
+        raise ValueError("cmpctblock: {} txs".format(count))
+    txs = [None] * count
+    for index, tx in cmpct.prefilled:
+        if index >= count:
+            raise ValueError("cmpctblock: prefilled index {} of {}".format(index, count))
+        txs[index] = tx
+
+    slots = {} # short id -> slot
+    shortids = iter(cmpct.shortids)
+    for i in range(count):
+        if txs[i] is None:
+            id = next(shortids)
+            if id in slots:
+                # colliding short ids in one block, can't be resolved
+                return (None, "duplicate short id")
+            slots[id] = i
+
+    (k0, k1) = shortid_keys(cmpct.header, cmpct.nonce)
+    entries = list(mempool.txs.values())
+    taken = set()
+    for entry, id in zip(entries, siphash_many(k0, k1, [entry.wtxid for entry in entries])):
+        slot = slots.get(id & SHORTID_MASK)
+        if slot is None:
+            continue
+        if slot in taken:
+            # two mempool txs with that short id, fetch the real one
+            txs[slot] = None
+            continue
+        taken.add(slot)
+        txs[slot] = entry.tx()
+    return (PartialBlock(cmpct.header, txs), None)
+
+# A block rebuilt from a cmpctblock, the slots still None are asked with
+# getblocktxn
+class PartialBlock:
+    def __init__(self, header, txs):
+        self.header = header
+        self.txs = txs
+
+    def missing(self):
+        return [i for i, tx in enumerate(self.txs) if tx is None]
+
+    # txs: the missing ones, in order. ret: False if the count is off
+    def fill(self, txs):
+        missing = self.missing()
+        if len(txs) != len(missing):
+            return False
+        for i, tx in zip(missing, txs):
+            self.txs[i] = tx
+        return True
+
+    # ret: the Block, None if its merkle root is wrong (a short id matched
+    # the wrong mempool tx)
+    def block(self):
+        block = Block(self.header, self.txs)
+        if block.merkle_root() != self.header.merkle:
+            return None
+        return block
@@ -4,12 +4,87 @@ debug_port = 8334
 #seed_addr = ("14.192.8.27", 21301)
 seed_addr = ("13.80.67.162", 8333)
 version = 70015
-services = 1
+services = 1 | 4 # NODE_NETWORK | NODE_BLOOM
 user_agent = b"/Satoshi:0.7.2/"
 relay = True
 addr = bytes.fromhex('0000 0000 0000 0000 0000 ffff 0000 0000 0000')
 
 debug_enabled = True
+# dump every decoded payload, formats large strings per message
+debug_payloads = False
 
 db_name = ".bitcoin.db"
-coin = 100000000
\ No newline at end of file
+coin = 100000000
+recvbuf_size = 64 * 1024
+recv_chunk = 16 * 1024
+max_msg_size = 32 * 1024 * 1024
+# block messages at least this large are parsed while they arrive
+stream_min_size = 256 * 1024
+# threads for hashing large batches of txs, 0/1 hashes inline
+hash_threads = 0
+hash_parallel_bytes = 1024 * 1024
+# blocks whose merkle trees are kept for serving merkleblock
+merkle_cache_size = 16
+# "btree": blocks stored as values in the db
+# "flatfile": blocks appended to blocks_dir/blkNNNNN.dat, the db only indexes them
+db_backend = "btree"
+blocks_dir = ".blocks"
+blockfile_size = 128 * 1024 * 1024
+# group commit: flush pending db writes after this many keys or seconds
+db_flush_writes = 10000
+db_flush_interval = 5
+# memory budget of the utxo cache
+coins_cache_bytes = 300 * 1024 * 1024
+# block download: blocks past the tip to request, per peer requests
+# in flight, seconds before a request is given to another peer
+download_window = 256
+max_blocks_in_flight = 16
+block_timeout = 60
+# seconds between timeout checks
+tick_interval = 1
+# network engine: "selectors" or "asyncio"
+engine = "selectors"
+# outbound peers to keep, seconds for connect + handshake
+max_outbound = 8
+connect_timeout = 10
+# ping peers quiet for ping_interval seconds, drop them after peer_timeout
+ping_interval = 2 * 60
+peer_timeout = 20 * 60
+# address book: at most addr_group_size per network group, addr_book_size
+# in all. Failed addresses are retried after addr_retry_interval * 2^fails
+addr_group_size = 64
+addr_book_size = 20000
+addr_retry_interval = 60
+# asyncio engine: messages at least this large are decoded on worker threads
+offload_threads = 2
+offload_min_size = 256 * 1024
+# outbound queue per peer: stop reading from a peer past the high-water
+# mark, disconnect it past max. At most send_iov_max buffers per sendmsg
+send_high_water = 4 * 1024 * 1024
+send_max_queue = 64 * 1024 * 1024
+send_iov_max = 512
+# script checks: worker processes (0 checks inline) and inputs per batch
+script_workers = 4
+script_batch = 256
+# mempool: memory cap, minimum fee rate (satoshis per 1000 vbytes) and
+# half-life of the floor raised by evictions. The cap is on estimated
+# usage, raw tx bytes plus fixed per object costs (mempool.py)
+mempool_bytes = 300 * 1024 * 1024
+min_relay_feerate = 1000
+mempool_floor_halflife = 12 * 60 * 60
+# inv handling: txids rejected or confirmed lately that aren't fetched
+# again (a rolling bloom filter remembering at least recent_txs of them,
+# false positive rate recent_txs_fp), tx getdata requests in flight per
+# peer, seconds before an announced tx may be asked from another peer
+recent_txs = 50000
+recent_txs_fp = 0.000001
+max_tx_in_flight = 100
+tx_request_timeout = 60
+# blocks whose BIP37 match data is kept for serving filtered blocks
+filter_cache_size = 4
+# peers asked to announce new blocks with cmpctblock right away (BIP152
+# high-bandwidth mode), the ones that delivered a new tip last
+cmpct_hb_peers = 3
+# count messages and bytes per command and peer, time handlers and the
+# main loop, read with the debug_metrics and debug_prometheus commands
+metrics_enabled = False
@@ -2,23 +2,279 @@
 
 # using Berkeley DB
 
+import os
+import mmap
+import time
+import zlib
 import bsddb3
+import codec
+import config
+import lib
 
+BLOCK_PREFIX = b"b"	# db key: "b" + hash -> serialized block, or its flat file location
+
+# Writes collected to be committed together, value None deletes the key
+class WriteBatch:
+	def __init__(self):
+		self.writes = {}
+
+	def __len__(self):
+		return len(self.writes)
+
+	def add(self, key, value):
+		self.writes[key] = value
+
+	def delete(self, key):
+		self.writes[key] = None
+
+	# journal record: crc, length, then (key length, value length + 1, key, value)
+	# per write, value length 0 marks a delete
+	def tobytes(self):
+		parts = []
+		for key, value in self.writes.items():
+			size = 0 if value is None else len(value) + 1
+			parts.append(codec.get("<II").pack(len(key), size))
+			parts.append(key)
+			if value is not None:
+				parts.append(value)
+		body = b"".join(parts)
+		return codec.get("<II").pack(zlib.crc32(body), len(body)) + body
+
+	@staticmethod
+	# ret: (batch, offset), batch is None if the record is torn or corrupt
+	def load_from(buf, offset):
+		if len(buf) - offset < 8:
+			return (None, offset)
+		(crc, length) = codec.get("<II").unpack_from(buf, offset)
+		body = buf[offset + 8:offset + 8 + length]
+		if len(body) < length or zlib.crc32(body) != crc:
+			return (None, offset)
+
+		batch = WriteBatch()
+		pos = 0
+		while pos < length:
+			(keylen, size) = codec.get("<II").unpack_from(body, pos)
+			pos += 8
+			key = bytes(body[pos:pos + keylen])
+			pos += keylen
+			if size == 0:
+				batch.delete(key)
+			else:
+				batch.add(key, bytes(body[pos:pos + size - 1]))
+				pos += size - 1
+		return (batch, offset + 8 + length)
+
+# Writes are buffered in memory and group-committed by flush(): all pending
+# writes go to the journal in one record and are fsynced, then applied to
+# the B-tree, which is synced before the journal is emptied. A crash leaves
+# either none or all of a flush, the journal is replayed on open.
+# flush() runs every config.db_flush_writes keys, every config.db_flush_interval
+# seconds (from tick()) and on close(). Single add()s never flush on their
+# own, so everything written while handling one message lands together.
 class DataBase:
 	def __init__(self, db_name):
 		self.db = bsddb3.btopen(db_name, "c")
+		self.pending = {}
+		self.last_flush = time.time()
+		self.journal_name = db_name + ".journal"
+		self.replay()
+		self.journal = open(self.journal_name, "ab")
 
 	def get(self, key):
+		if key in self.pending:
+			return self.pending[key]
 		if key in self.db:
 			return self.db[key]
 		else:
 			return None
 
 	def add(self, key, value):
-		self.db[key] = value
+		self.pending[key] = value
 
-	def save(self):
+	def delete(self, key):
+		self.pending[key] = None
+
+	def batch(self):
+		return WriteBatch()
+
+	def write(self, batch):
+		self.pending.update(batch.writes)
+		if len(self.pending) >= config.db_flush_writes:
+			self.flush()
+
+	# full blocks, hash -> serialized block
+	def get_block(self, hash):
+		return self.get_block_value(hash)
+
+	def add_block(self, hash, data, batch = None):
+		(batch if batch is not None else self).add(BLOCK_PREFIX + hash, data)
+
+	# databases written before BLOCK_PREFIX keep blocks under the bare hash
+	def get_block_value(self, hash):
+		value = self.get(BLOCK_PREFIX + hash)
+		if value is None and len(hash) == 32:
+			value = self.get(hash)
+		return value
+
+	def tick(self):
+		if self.pending and time.time() - self.last_flush >= config.db_flush_interval:
+			self.flush()
+
+	def flush(self):
+		self.last_flush = time.time()
+		if not self.pending:
+			return
+		batch = WriteBatch()
+		batch.writes = self.pending
+		self.pending = {}
+
+		self.journal.write(batch.tobytes())
+		self.journal.flush()
+		os.fsync(self.journal.fileno())
+		self.apply(batch)
+		self.journal.truncate(0)
+
+	def apply(self, batch):
+		for key, value in batch.writes.items():
+			if value is not None:
+				self.db[key] = value
+			elif key in self.db:
+				del self.db[key]
 		self.db.sync()
 
+	def replay(self):
+		if not os.path.exists(self.journal_name):
+			return
+		with open(self.journal_name, "rb") as f:
+			data = f.read()
+		offset = 0
+		count = 0
+		while True:
+			batch, offset = WriteBatch.load_from(data, offset)
+			if not batch:
+				break
+			self.apply(batch)
+			count += 1
+		if count > 0:
+			lib.info("db: replayed {} journal records", count)
+		if offset < len(data):
+			lib.err("db: dropped {} bytes of torn journal", len(data) - offset)
+		os.truncate(self.journal_name, 0)
+
+	def save(self):
+		self.flush()
+
+	def close(self):
+		self.flush()
+		self.journal.close()
+		self.db.close()
+
 	def keys(self):
-		return self.db.keys()
\ No newline at end of file
+		if not self.pending:
+			return self.db.keys()
+		keys = set(self.db.keys())
+		for key, value in self.pending.items():
+			if value is None:
+				keys.discard(key)
+			else:
+				keys.add(key)
+		return list(keys)
+
+	# (key, value) of every key starting with prefix, in key order
+	def items(self, prefix):
+		pending = {k: v for k, v in self.pending.items() if k.startswith(prefix)}
+		if not pending:
+			yield from self.db_items(prefix)
+			return
+
+		merged = dict(self.db_items(prefix))
+		merged.update(pending)
+		for key in sorted(merged):
+			if merged[key] is not None:
+				yield (key, merged[key])
+
+	def db_items(self, prefix):
+		try:
+			key, value = self.db.set_location(prefix)
+			while key.startswith(prefix):
+				yield (key, value)
+				key, value = self.db.next()
+		except KeyError:
+			# DBNotFoundError: ran off the end of the tree
+			return
+
+# Blocks are appended to blocks_dir/blkNNNNN.dat, each one prefixed with
+# magic and length like bitcoin core does. The B-tree only keeps
+# hash -> (file, offset, length), and get_block returns a memoryview of an
+# mmap of the file, so reading a block copies nothing.
+class FlatFileDataBase(DataBase):
+	LOCATION = codec.get("<III")
+	RECORD = codec.get("<II")
+
+	def __init__(self, db_name, blocks_dir):
+		DataBase.__init__(self, db_name)
+		self.dir = blocks_dir
+		os.makedirs(self.dir, exist_ok = True)
+		self.maps = {} # file number -> mmap
+
+		self.num = 0
+		while os.path.exists(self.path(self.num + 1)):
+			self.num += 1
+		self.file = open(self.path(self.num), "ab")
+
+	def path(self, num):
+		return os.path.join(self.dir, "blk{:05d}.dat".format(num))
+
+	# databases written by the btree backend hold whole blocks, no block is
+	# as short as a location, they are returned as they are
+	def get_block(self, hash):
+		location = self.get_block_value(hash)
+		if location is None or len(location) != self.LOCATION.size:
+			return location
+		(num, offset, length) = self.LOCATION.unpack(location)
+		return memoryview(self.map(num, offset + length))[offset:offset + length]
+
+	def add_block(self, hash, data, batch = None):
+		size = self.RECORD.size + len(data)
+		if self.file.tell() > 0 and self.file.tell() + size > config.blockfile_size:
+			# flush() only syncs the current file, pending locations may
+			# still point into this one
+			self.file.flush()
+			os.fsync(self.file.fileno())
+			self.file.close()
+			self.num += 1
+			self.file = open(self.path(self.num), "ab")
+
+		offset = self.file.tell() + self.RECORD.size
+		self.file.write(self.RECORD.pack(config.magic, len(data)))
+		self.file.write(data)
+		# readers map the file, they must see the bytes
+		self.file.flush()
+		(batch if batch is not None else self).add(BLOCK_PREFIX + hash, self.LOCATION.pack(self.num, offset, len(data)))
+
+	# mmap of file num covering at least size bytes
+	def map(self, num, size):
+		m = self.maps.get(num)
+		if m is None or len(m) < size:
+			# an older, shorter map may still be referenced by views
+			# handed out earlier, it's closed once they are gone
+			with open(self.path(num), "rb") as f:
+				m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+			self.maps[num] = m
+		return m
+
+	# block data must be on disk before the locations pointing at it
+	def flush(self):
+		if self.pending:
+			self.file.flush()
+			os.fsync(self.file.fileno())
+		DataBase.flush(self)
+
+	def close(self):
+		DataBase.close(self)
+		self.file.close()
+
+def open_database(db_name):
+	if config.db_backend == "flatfile":
+		return FlatFileDataBase(db_name, config.blocks_dir)
+	return DataBase(db_name)
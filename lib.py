@@ -1,6 +1,7 @@
 import random
 import config
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 def printb(bs):
     col = 0
@@ -53,17 +54,48 @@ def double_hash(v):
 def single_hash(v):
 	return hashlib.sha256(v).digest()
 
+def hash160(v):
+	return hashlib.new("ripemd160", hashlib.sha256(v).digest()).digest()
+
+_hash_pool = None
+
+def _double_hash_list(datas):
+	sha256 = hashlib.sha256
+	return [sha256(sha256(v).digest()).digest() for v in datas]
+
+# double_hash of every item. hashlib only drops the GIL for inputs of 2KB and
+# up, so big batches of large items (serialized txs) are split across
+# config.hash_threads threads; small items are always hashed inline.
+def double_hash_many(datas):
+	global _hash_pool
+	if config.hash_threads <= 1 or len(datas) < 2 * config.hash_threads:
+		return _double_hash_list(datas)
+	if sum(len(v) for v in datas) < config.hash_parallel_bytes:
+		return _double_hash_list(datas)
+
+	if not _hash_pool:
+		_hash_pool = ThreadPoolExecutor(config.hash_threads)
+	step = (len(datas) + config.hash_threads - 1) // config.hash_threads
+	ret = []
+	for part in _hash_pool.map(_double_hash_list, [datas[i:i + step] for i in range(0, len(datas), step)]):
+		ret.extend(part)
+	return ret
+
+# nodes: leaf hashes in internal byte order.
+# Pairs come from zipping one iterator with itself and are hashed inline,
+# without indexing or a double_hash call per pair. Slicing a joined level
+# buffer, through memoryviews or not, measured slower (bench.py merkle_root).
 def _merkle_root(nodes):
-	nodes = [double_hash(node)[::-1] for node in nodes]
+	sha256 = hashlib.sha256
 	while len(nodes) > 1:
 		if len(nodes) % 2 != 0:
 			nodes.append(nodes[-1])
-		nodes = [double_hash(nodes[2 * i] + nodes[2 * i + 1]) for i in range(len(nodes) // 2)]
-	return nodes[0][::-1]
+		pairs = iter(nodes)
+		nodes = [sha256(sha256(left + right).digest()).digest() for left, right in zip(pairs, pairs)]
+	return nodes[0]
 
 def merkle_root(txs):
 	if len(txs) <= 0:
 		return b""
 
-	nodes = [tx.tobytes() for tx in txs]
-	return _merkle_root(nodes)
+	return _merkle_root([tx.txid for tx in txs])
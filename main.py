@@ -1,5 +1,10 @@
+import config
 from bitcoin import BitCoin
 
 if __name__ == "__main__":
-    bc = BitCoin()
-    bc.run()
\ No newline at end of file
+    if config.engine == "asyncio":
+        from asyncbitcoin import AsyncBitCoin
+        bc = AsyncBitCoin()
+    else:
+        bc = BitCoin()
+    bc.run()
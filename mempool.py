@@ -0,0 +1,232 @@
+import heapq
+import itertools
+import time
+import codec
+import config
+import lib
+from bloom import RollingBloomFilter
+from structs import Tx
+from coins import Coin
+
+# Memory is estimated, not measured: fixed per object costs, taken from
+# tracemalloc on 64 bit CPython, on top of the raw tx bytes.
+# per entry: the entry, its dict slot, txid and wtxid
+ENTRY_OVERHEAD = 270
+# per input, the spends index key and slot
+SPEND_OVERHEAD = 140
+# per heap item, live or stale: the tuple, its ints and the list slot
+HEAP_ITEM = 136
+
+# check() reasons that prove a tx invalid. The others (in the pool,
+# conflicts, missing inputs, fee rate) may pass later
+INVALID = ("coinbase", "duplicate inputs", "outputs exceed inputs")
+
+def outpoint_key(hash, index):
+    return hash + codec.U32.pack(index)
+
+class MempoolEntry:
+    __slots__ = ("txid", "wtxid", "raw", "vsize", "fee", "feerate", "spends", "n_out", "time", "usage", "seq")
+
+    def __init__(self, tx, fee, spends):
+        self.txid = tx.txid
+        self.wtxid = tx.wtxid # for compact block short ids
+        self.raw = tx.tobytes() # the Tx itself isn't kept, it's several times larger
+        base = len(tx.tobytes(False))
+        self.vsize = (base * 3 + len(self.raw) + 3) // 4
+        self.fee = fee
+        self.feerate = fee * 1000 // self.vsize # satoshis per 1000 vbytes
+        self.spends = spends # outpoint keys of the inputs
+        self.n_out = len(tx.txout)
+        self.time = time.time()
+        self.usage = ENTRY_OVERHEAD + len(self.raw) + SPEND_OVERHEAD * len(spends)
+        self.seq = 0 # of its heap item
+
+    def tx(self):
+        return Tx.load(self.raw)[0]
+
+# Unconfirmed txs by txid, with the outpoints they spend for conflict
+# checks and a heap by fee rate for eviction. Every entry is charged its
+# usage, heap items too until the heap is rebuilt, and once the total
+# passes config.mempool_bytes the lowest fee rate txs go first, with their
+# descendants. Evicting raises a fee rate floor for new txs that halves
+# every config.mempool_floor_halflife seconds.
+# Txids found invalid or confirmed lately are kept in a rolling bloom
+# filter so announcements of them aren't fetched again.
+# Scripts are checked on the validator's workers: begin() runs the cheap
+# checks and starts them, finish() takes the result and runs the cheap
+# checks again, a block or another tx may have spent the inputs meanwhile.
+class Mempool:
+    def __init__(self, coins, validator):
+        self.coins = coins
+        self.validator = validator
+        self.txs = {} # txid -> MempoolEntry
+        self.spends = {} # outpoint key -> txid of the spender
+        self.heap = [] # (feerate, seq, txid), removed entries are skipped lazily
+        self.seq = itertools.count()
+        self.usage = 0
+        self.floor = 0
+        self.floor_time = 0
+        self.recent = RollingBloomFilter(config.recent_txs, config.recent_txs_fp)
+        self.checking = set() # txids whose scripts are being checked
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, txid):
+        return txid in self.txs
+
+    def get(self, txid):
+        return self.txs.get(txid)
+
+    # ret: True if txid is in the pool, being checked, or was rejected or
+    # confirmed lately
+    def known(self, txid):
+        return txid in self.txs or txid in self.checking or txid in self.recent
+
+    def min_feerate(self):
+        floor = self.floor >> int((time.time() - self.floor_time) // config.mempool_floor_halflife)
+        if floor < config.min_relay_feerate // 2:
+            floor = 0
+        return max(config.min_relay_feerate, floor)
+
+    # waits for the script check
+    # ret: (entry, None) if tx was added, (None, reason) if not
+    def add(self, tx):
+        (future, reason) = self.begin(tx)
+        if not future:
+            return (None, reason)
+        return self.finish(tx, future.result())
+
+    # ret: (future, None), the future of the script check error to pass
+    # to finish(), or (None, reason) if tx is rejected already
+    def begin(self, tx):
+        (entry, spent, reason) = self.check(tx)
+        if not entry:
+            self.reject(tx, reason)
+            return (None, reason)
+        self.checking.add(tx.txid)
+        return (self.validator.check_tx(tx, spent), None)
+
+    # error: of the script check, None if it passed
+    # ret: (entry, None) if tx was added, (None, reason) if not
+    def finish(self, tx, error):
+        self.checking.discard(tx.txid)
+        if error:
+            self.recent.add(tx.txid)
+            return (None, "script check failed: {}".format(error))
+        (entry, spent, reason) = self.check(tx)
+        if not entry:
+            self.reject(tx, reason)
+            return (None, reason)
+
+        txid = tx.txid
+        self.txs[txid] = entry
+        for key in entry.spends:
+            self.spends[key] = txid
+        self.usage += entry.usage + HEAP_ITEM
+        entry.seq = next(self.seq)
+        heapq.heappush(self.heap, (entry.feerate, entry.seq, txid))
+        self.trim()
+        if txid not in self.txs:
+            return (None, "mempool full")
+        return (entry, None)
+
+    # reason: of check(). Only invalid txs are remembered, the others stay
+    # fetchable
+    def reject(self, tx, reason):
+        if reason in INVALID:
+            self.recent.add(tx.txid)
+
+    # everything but the scripts
+    # ret: (entry, spent coins, None) if tx fits, (None, None, reason) if not
+    def check(self, tx):
+        txid = tx.txid
+        if txid in self.txs:
+            return (None, None, "already in mempool")
+        if txid in self.checking:
+            return (None, None, "already being checked")
+        if any(txin.prev.index == 0xFFFFFFFF and txin.prev.hash == bytes(32) for txin in tx.txin):
+            return (None, None, "coinbase")
+
+        spends = []
+        spent = []
+        for txin in tx.txin:
+            key = outpoint_key(txin.prev.hash, txin.prev.index)
+            if key in self.spends:
+                return (None, None, "conflicts with {}".format(self.spends[key][::-1].hex()))
+            coin = self.coins.get_coin(txin.prev.hash, txin.prev.index)
+            if coin is None:
+                parent = self.txs.get(txin.prev.hash)
+                if not parent or txin.prev.index >= parent.n_out:
+                    return (None, None, "missing inputs")
+                out = parent.tx().txout[txin.prev.index]
+                coin = Coin(out.value, out.script.string, 0, False)
+            spends.append(key)
+            spent.append(coin)
+        if len(set(spends)) != len(spends):
+            return (None, None, "duplicate inputs")
+
+        fee = sum(coin.value for coin in spent) - sum(out.value for out in tx.txout)
+        if fee < 0:
+            return (None, None, "outputs exceed inputs")
+        entry = MempoolEntry(tx, fee, spends)
+        if entry.feerate < self.min_feerate():
+            return (None, None, "fee rate {} below {}".format(entry.feerate, self.min_feerate()))
+        return (entry, spent, None)
+
+    # remove txid and everything spending its outputs
+    def remove(self, txid):
+        stack = [txid]
+        while stack:
+            txid = stack.pop()
+            entry = self.txs.pop(txid, None)
+            if not entry:
+                continue
+            for key in entry.spends:
+                del self.spends[key]
+            self.usage -= entry.usage
+            for n in range(entry.n_out):
+                child = self.spends.get(outpoint_key(txid, n))
+                if child:
+                    stack.append(child)
+
+    def trim(self):
+        while self.usage > config.mempool_bytes and self.heap:
+            (feerate, seq, txid) = heapq.heappop(self.heap)
+            self.usage -= HEAP_ITEM
+            entry = self.txs.get(txid)
+            if not entry or entry.seq != seq:
+                continue
+            self.remove(txid)
+            self.floor = max(self.min_feerate(), feerate + config.min_relay_feerate)
+            self.floor_time = time.time()
+        # drop the stale heap items once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.txs) + 1000:
+            self.usage -= HEAP_ITEM * (len(self.heap) - len(self.txs))
+            self.heap = [(e.feerate, e.seq, e.txid) for e in self.txs.values()]
+            heapq.heapify(self.heap)
+
+    # drop txs confirmed by block and those double spending them
+    def remove_for_block(self, block):
+        # nobody announces the txs of old blocks anymore, and skipping
+        # them keeps the initial sync fast
+        recent = block.header.timestamp > time.time() - 24 * 60 * 60
+        for tx in block.txs:
+            txid = tx.txid
+            if recent:
+                self.recent.add(txid)
+            entry = self.txs.pop(txid, None)
+            if entry:
+                # its children stay, they spend confirmed outputs now
+                for key in entry.spends:
+                    del self.spends[key]
+                self.usage -= entry.usage
+            for txin in tx.txin:
+                spender = self.spends.get(outpoint_key(txin.prev.hash, txin.prev.index))
+                if spender:
+                    lib.debug("mempool: {} conflicts with block tx {}", spender[::-1].hex(), txid[::-1].hex())
+                    self.remove(spender)
+
+    # txids with a fee rate of at least feerate, for answering mempool
+    def txids(self, feerate = 0):
+        return [txid for txid, entry in self.txs.items() if entry.feerate >= feerate]
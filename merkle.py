@@ -0,0 +1,147 @@
+import bisect
+import hashlib
+import codec
+from structs import VarInt
+
+def _pair_hash(left, right):
+    return hashlib.sha256(hashlib.sha256(left + right).digest()).digest()
+
+# Merkle tree of one block that keeps every level.
+# levels[0] are the txids (internal byte order), levels[-1] == [root].
+# A level with an odd count pairs its last node with itself.
+class MerkleTree:
+    def __init__(self, leaves = None):
+        self.levels = [[]]
+        if leaves:
+            self.build(leaves)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def build(self, leaves):
+        sha256 = hashlib.sha256
+        nodes = list(leaves)
+        self.levels = [nodes]
+        while len(nodes) > 1:
+            level = nodes
+            if len(level) % 2 != 0:
+                level = level + level[-1:]
+            level = memoryview(b"".join(level))
+            nodes = [sha256(sha256(level[i:i + 64]).digest()).digest() for i in range(0, len(level), 64)]
+            self.levels.append(nodes)
+
+    # only the path from the new leaf to the root is rehashed: O(log n)
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+        pos = len(self.levels[0]) - 1
+        height = 0
+        while len(self.levels[height]) > 1:
+            level = self.levels[height]
+            parent = pos // 2
+            left = level[parent * 2]
+            right = level[parent * 2 + 1] if parent * 2 + 1 < len(level) else left
+            if height + 1 == len(self.levels):
+                self.levels.append([])
+            up = self.levels[height + 1]
+            if parent < len(up):
+                up[parent] = _pair_hash(left, right)
+            else:
+                up.append(_pair_hash(left, right))
+            pos = parent
+            height += 1
+
+    def root(self):
+        if not self.levels[0]:
+            return b""
+        return self.levels[-1][0]
+
+    def height(self):
+        return len(self.levels) - 1
+
+    # BIP37 partial merkle tree proving the txids at the given leaf indexes
+    def partial(self, matches):
+        matches = sorted(matches)
+        pmt = PartialMerkleTree(len(self), [], [])
+        if len(self) > 0:
+            self.traverse(pmt, matches, self.height(), 0)
+        return pmt
+
+    def traverse(self, pmt, matches, height, pos):
+        # does the subtree below (height, pos) contain a matched leaf
+        first = pos << height
+        i = bisect.bisect_left(matches, first)
+        parent_of_match = i < len(matches) and matches[i] < (pos + 1) << height
+        pmt.bits.append(parent_of_match)
+        if height == 0 or not parent_of_match:
+            pmt.hashes.append(self.levels[height][pos])
+            return
+        self.traverse(pmt, matches, height - 1, pos * 2)
+        if pos * 2 + 1 < len(self.levels[height - 1]):
+            self.traverse(pmt, matches, height - 1, pos * 2 + 1)
+
+# The hashes/flags part of a merkleblock message
+class PartialMerkleTree:
+    def __init__(self, total, hashes, bits):
+        self.total = total
+        self.hashes = hashes
+        self.bits = bits # list of bools, packed LSB first on the wire
+
+    @staticmethod
+    def load_from(buf, offset):
+        (total, ) = codec.U32.unpack_from(buf, offset)
+        count, offset = VarInt.read_from(buf, offset + 4)
+        hashes = []
+        for _ in range(count):
+            hashes.append(bytes(buf[offset:offset + 32]))
+            offset += 32
+        size, offset = VarInt.read_from(buf, offset)
+        bits = []
+        for byte in buf[offset:offset + size]:
+            for i in range(8):
+                bits.append((byte >> i) & 1 == 1)
+        return (PartialMerkleTree(total, hashes, bits), offset + size)
+
+    def tobytes(self):
+        flags = bytearray((len(self.bits) + 7) // 8)
+        for i, bit in enumerate(self.bits):
+            if bit:
+                flags[i // 8] |= 1 << (i % 8)
+        return (codec.U32.pack(self.total) + VarInt(len(self.hashes)).tobytes() + b"".join(self.hashes) +
+            VarInt(len(flags)).tobytes() + bytes(flags))
+
+    def width(self, height):
+        return (self.total + (1 << height) - 1) >> height
+
+    # ret: (root, [(index, txid)]) of the matched txs, (None, None) if malformed
+    def extract(self):
+        if self.total == 0 or len(self.hashes) > self.total:
+            return (None, None)
+        height = 0
+        while self.width(height) > 1:
+            height += 1
+        matched = []
+        state = [0, 0] # bits used, hashes used
+        try:
+            root = self.extract_node(height, 0, state, matched)
+        except (IndexError, ValueError):
+            return (None, None)
+        if state[1] != len(self.hashes) or (state[0] + 7) // 8 != (len(self.bits) + 7) // 8:
+            return (None, None)
+        return (root, matched)
+
+    def extract_node(self, height, pos, state, matched):
+        parent_of_match = self.bits[state[0]]
+        state[0] += 1
+        if height == 0 or not parent_of_match:
+            h = self.hashes[state[1]]
+            state[1] += 1
+            if height == 0 and parent_of_match:
+                matched.append((pos, h))
+            return h
+        left = self.extract_node(height - 1, pos * 2, state, matched)
+        right = left
+        if pos * 2 + 1 < self.width(height - 1):
+            right = self.extract_node(height - 1, pos * 2 + 1, state, matched)
+            if right == left:
+                raise ValueError("duplicated merkle branch") # CVE-2012-2459
+        return _pair_hash(left, right)
@@ -1,9 +1,10 @@
 import socket
-import struct
 import time
+import codec
 import config
 import lib
 from structs import *
+from merkle import PartialMerkleTree
 
 class Version:
     def __init__(self, start_height):
@@ -18,22 +19,23 @@ class Version:
         self.relay = config.relay
 
     def tobytes(self):
-        return struct.pack("<iQq26s26sQ16pi?", self.version, self.services, self.timestamp, self.addr_recv, self.addr_from, 
-            self.nonce, self.user_agent, self.start_height, self.relay)
+        return (codec.VERSION.pack(self.version, self.services, self.timestamp, self.addr_recv) +
+            codec.VERSION_FROM.pack(self.addr_from, self.nonce) + VarStr(self.user_agent).tobytes() +
+            codec.I32.pack(self.start_height) + codec.BOOL.pack(self.relay))
 
     @staticmethod
     def load(data):
         ret = Version(0)
-        common = data[:46]
-        data = data[46:]
-        (ret.version, ret.services, ret.timestamp, ret.addr_recv) = struct.unpack("<iQq26s", common)
+        ret.relay = True # BIP37: absent means relay
+        buf = memoryview(data)
+        (ret.version, ret.services, ret.timestamp, ret.addr_recv) = codec.VERSION.unpack_from(buf, 0)
         if ret.version >= 106:
-            if ret.version >= 70001:
-                strlen = len(data) - 26 - 8 - 4 - 1
-                (ret.addr_from, ret.nonce, ret.user_agent, ret.start_height, ret.relay) = struct.unpack("<26sQ{}pi?".format(strlen), data)
-            else:
-                strlen = len(data) - 26 - 8 - 4
-                (ret.addr_from, ret.nonce, ret.user_agent, ret.start_height) = struct.unpack("<26sQ{}pi".format(strlen), data)
+            (ret.addr_from, ret.nonce) = codec.VERSION_FROM.unpack_from(buf, 46)
+            (user_agent, offset) = VarStr.load_from(buf, 80)
+            ret.user_agent = user_agent.string
+            (ret.start_height, ) = codec.I32.unpack_from(buf, offset)
+            if ret.version >= 70001 and len(buf) > offset + 4:
+                ret.relay = buf[offset + 4] != 0
         return ret
         
     def debug(self):
@@ -60,13 +62,13 @@ class Ping:
         self.nonce = lib.random64()
 
     def tobytes(self):
-        return struct.pack("<Q", self.nonce)
+        return codec.U64.pack(self.nonce)
 
     @staticmethod
     def load(data):
         ret = Ping()
         if len(data) == 8:
-            (ret.nonce, ) = struct.unpack("<Q", data)
+            (ret.nonce, ) = codec.U64.unpack_from(data, 0)
         return ret
 
     def debug(self):
@@ -77,13 +79,12 @@ class Pong:
         self.nonce = nonce
 
     def tobytes(self):
-        return struct.pack("<Q", self.nonce)
+        return codec.U64.pack(self.nonce)
 
     @staticmethod
     def load(data):
-        ret = Pong()
-        (ret.nonce, ) = struct.unpack("<Q", data)
-        return ret
+        (nonce, ) = codec.U64.unpack_from(data, 0)
+        return Pong(nonce)
 
     def debug(self):
         lib.debug("<pong>\nnonce: {}\n", self.nonce)
@@ -102,6 +103,20 @@ class GetAddr:
     def debug(self):
         lib.debug("<getaddr> no extra data\n")
 
+class MemPool:
+    def __init__(self):
+        pass
+
+    def tobytes(self):
+        return b""
+
+    @staticmethod
+    def load(data):
+        return MemPool()
+
+    def debug(self):
+        lib.debug("<mempool> no extra data\n")
+
 class Addr:
     def __init__(self, addr_list):
         self.addr_list = addr_list
@@ -114,14 +129,13 @@ class Addr:
 
     @staticmethod
     def load(data):
-        varint, size = VarInt.load(data)
-        data = data[size:]
+        buf = memoryview(data)
+        varint, offset = VarInt.load_from(buf, 0)
         count = varint.value
 
         addr_list = []
         for i in range(count):
-            addr, size = NetAddr.load(data)
-            data = data[size:]
+            addr, offset = NetAddr.load_from(buf, offset)
             addr_list.append(addr)
         return Addr(addr_list)
 
@@ -138,22 +152,23 @@ class GetHeaders:
         self.stop = stop
 
     def tobytes(self):
-        pass
+        return (codec.U32.pack(self.version) + VarInt(len(self.locators)).tobytes() + b"".join(self.locators) +
+            self.stop.ljust(32, b"\x00"))
 
     @staticmethod
     def load(data):
-        (version, ) = struct.unpack("<I", data[:4])
-        data = data[4:]
-
-        (varint, size) = VarInt.load(data)
+        buf = memoryview(data)
+        (version, ) = codec.U32.unpack_from(buf, 0)
+        (varint, offset) = VarInt.load_from(buf, 4)
         count = varint.value
-        data = data[size:]
+        if len(buf) < offset + 32 * (count + 1):
+            raise ValueError("getheaders: {} locators, {} bytes".format(count, len(buf)))
 
         locators = []
         for i in range(count):
-            locators.append(data[:32])
-            data = data[32:]
-        return GetHeaders(locators, data[:32])
+            locators.append(bytes(buf[offset:offset + 32]))
+            offset += 32
+        return GetHeaders(locators, bytes(buf[offset:offset + 32]))
 
     def debug(self):
         s = "<getheaders>\nversion:{}\nlocator hash count:{}\n".format(self.version, len(self.locators))
@@ -163,22 +178,52 @@ class GetHeaders:
         s += str(self.stop)
         lib.debug(s)
 
+class GetBlocks(GetHeaders):
+    @staticmethod
+    def load(data):
+        ret = GetHeaders.load(data)
+        return GetBlocks(ret.locators, ret.stop)
+
+    def debug(self):
+        lib.debug("<getblocks>\nlocator hash count:{}\n", len(self.locators))
+
+class Headers:
+    def __init__(self, headers):
+        self.headers = headers
+
+    # every header is followed by an always empty tx count
+    def tobytes(self):
+        return VarInt(len(self.headers)).tobytes() + b"".join(h.tobytes() + b"\x00" for h in self.headers)
+
+    @staticmethod
+    def load(data):
+        buf = memoryview(data)
+        (count, offset) = VarInt.read_from(buf, 0)
+        headers = []
+        for i in range(count):
+            (header, offset) = BlockHeader.load_from(buf, offset)
+            (_, offset) = VarInt.read_from(buf, offset)
+            headers.append(header)
+        return Headers(headers)
+
+    def debug(self):
+        lib.debug("<headers>\ncount:{}\n", len(self.headers))
+
 class Inv:
     def __init__(self, inventory):
         self.inventory = inventory
 
     def tobytes(self):
-        pass
+        return VarInt(len(self.inventory)).tobytes() + b"".join(iv.tobytes() for iv in self.inventory)
 
     @staticmethod
     def load(data):
-        (varint, size) = VarInt.load(data)
-        data = data[size:]
+        buf = memoryview(data)
+        (varint, offset) = VarInt.load_from(buf, 0)
 
         inventory = []
         for i in range(varint.value):
-            (iv, size) = InvVect.load(data)
-            data = data[size:]
+            (iv, offset) = InvVect.load_from(buf, offset)
             inventory.append(iv)
         return Inv(inventory)
 
@@ -188,6 +233,109 @@ class Inv:
             s += "{}:\t{}\t{}\n".format(i, iv.type, iv.hash)
         lib.debug(s)
 
+# A received inv, left undecoded: handle_Inv goes through the (type, hash)
+# pairs and skips the hashes it already knows without an InvVect each.
+# iter_unpack still builds a tuple and a 32 byte hash per entry, about 6x
+# faster than Inv.load. Looking up memoryview slices of the payload
+# instead measured 2x slower than that
+class RawInv:
+    def __init__(self, data):
+        buf = memoryview(data)
+        (self.count, offset) = VarInt.read_from(buf, 0)
+        self.buf = buf[offset:offset + self.count * 36]
+        if len(self.buf) != self.count * 36:
+            raise ValueError("inv: {} entries, {} bytes".format(self.count, len(self.buf)))
+
+    def entries(self):
+        return codec.INVVECT.iter_unpack(self.buf)
+
+    def debug(self):
+        lib.debug("<inv>\ncount:{}\n", self.count)
+
+class GetData(Inv):
+    @staticmethod
+    def load(data):
+        return GetData(Inv.load(data).inventory)
+
+    def debug(self):
+        lib.debug("<getdata>\ncount:{}\n", len(self.inventory))
+
+class NotFound(Inv):
+    @staticmethod
+    def load(data):
+        return NotFound(Inv.load(data).inventory)
+
+    def debug(self):
+        lib.debug("<notfound>\ncount:{}\n", len(self.inventory))
+
+class FilterLoad:
+    def __init__(self, filter, nhashes, tweak, flags):
+        self.filter = filter
+        self.nhashes = nhashes
+        self.tweak = tweak
+        self.flags = flags
+
+    def tobytes(self):
+        return VarStr(self.filter).tobytes() + codec.get("<IIB").pack(self.nhashes, self.tweak, self.flags)
+
+    @staticmethod
+    def load(data):
+        buf = memoryview(data)
+        (filter, offset) = VarStr.load_from(buf, 0)
+        (nhashes, tweak, flags) = codec.get("<IIB").unpack_from(buf, offset)
+        return FilterLoad(bytes(filter.string), nhashes, tweak, flags)
+
+    def debug(self):
+        lib.debug("<filterload>\nsize:{}\nhash funcs:{}\ntweak:{}\nflags:{}\n", len(self.filter), self.nhashes, self.tweak, self.flags)
+
+class FilterAdd:
+    def __init__(self, data):
+        self.data = data
+
+    def tobytes(self):
+        return VarStr(self.data).tobytes()
+
+    @staticmethod
+    def load(data):
+        (item, _) = VarStr.load_from(memoryview(data), 0)
+        return FilterAdd(bytes(item.string))
+
+    def debug(self):
+        lib.debug("<filteradd>\ndata:{}\n", self.data.hex())
+
+class FilterClear:
+    def __init__(self):
+        pass
+
+    def tobytes(self):
+        return b""
+
+    @staticmethod
+    def load(data):
+        return FilterClear()
+
+    def debug(self):
+        lib.debug("<filterclear> no extra data\n")
+
+class MerkleBlock:
+    def __init__(self, header, pmt):
+        self.header = header
+        self.pmt = pmt # PartialMerkleTree
+
+    def tobytes(self):
+        return self.header.tobytes() + self.pmt.tobytes()
+
+    @staticmethod
+    def load(data):
+        buf = memoryview(data)
+        (header, offset) = BlockHeader.load_from(buf, 0)
+        (pmt, offset) = PartialMerkleTree.load_from(buf, offset)
+        return MerkleBlock(header, pmt)
+
+    def debug(self):
+        lib.debug("<merkleblock>\nblock:{}\ntotal txs:{}\nhashes:{}\n", self.header.hash[::-1].hex(),
+            self.pmt.total, len(self.pmt.hashes))
+
 class SendHeaders:
     def __init__(self):
         pass
@@ -203,20 +351,119 @@ class SendHeaders:
         lib.debug("<sendheaders> no extra data\n")
 
 class SendCmpct:
-    def __init__(self, n1, n2):
-        self.n1 = n1
-        self.n2 = n2
+    def __init__(self, announce, version):
+        self.announce = announce # 1: announce new blocks with cmpctblock right away (high-bandwidth)
+        self.version = version # 2: short ids of wtxids
 
     def tobytes(self):
-        pass
+        return codec.SENDCMPCT.pack(self.announce, self.version)
+
+    @staticmethod
+    def load(data):
+        (announce, version) = codec.SENDCMPCT.unpack_from(data, 0)
+        return SendCmpct(announce, version)
+
+    def debug(self):
+        lib.debug("<sendcmpct>\nannounce: {}\nversion:{}\n", self.announce, self.version)
+
+# BIP152 HeaderAndShortIDs. prefilled: [(index in the block, Tx)], the
+# indexes are sent differentially encoded
+class CmpctBlock:
+    def __init__(self, header, nonce, shortids, prefilled):
+        self.header = header
+        self.nonce = nonce
+        self.shortids = shortids # 48 bit ints
+        self.prefilled = prefilled
+
+    def tobytes(self):
+        parts = [self.header.tobytes(), codec.U64.pack(self.nonce), VarInt(len(self.shortids)).tobytes(),
+            b"".join(id.to_bytes(6, "little") for id in self.shortids), VarInt(len(self.prefilled)).tobytes()]
+        last = -1
+        for index, tx in self.prefilled:
+            parts += [VarInt(index - last - 1).tobytes(), tx.tobytes()]
+            last = index
+        return b"".join(parts)
 
     @staticmethod
     def load(data):
-        (n1, n2) = struct.unpack("<BQ", data)
-        return SendCmpct(n1, n2)
+        buf = memoryview(data)
+        (header, offset) = BlockHeader.load_from(buf, 0)
+        (nonce, ) = codec.U64.unpack_from(buf, offset)
+        (count, offset) = VarInt.read_from(buf, offset + 8)
+        raw = bytes(buf[offset:offset + count * 6])
+        if len(raw) != count * 6:
+            raise ValueError("cmpctblock: {} short ids, {} bytes".format(count, len(raw)))
+        shortids = [int.from_bytes(raw[i:i + 6], "little") for i in range(0, len(raw), 6)]
+        (count, offset) = VarInt.read_from(buf, offset + len(raw))
+        prefilled = []
+        index = -1
+        for _ in range(count):
+            (diff, offset) = VarInt.read_from(buf, offset)
+            index += diff + 1
+            if index >= len(shortids) + count:
+                raise ValueError("cmpctblock: prefilled index {} of {} txs".format(index, len(shortids) + count))
+            (tx, offset) = Tx.load_from(buf, offset)
+            prefilled.append((index, tx))
+        return CmpctBlock(header, nonce, shortids, prefilled)
 
     def debug(self):
-        lib.debug("<sendcmpct>\nn1: {}\nn2:{}\n", self.n1, self.n2)
+        lib.debug("<cmpctblock>\nblock:{}\nshort ids:{}\nprefilled:{}\n", self.header.hash[::-1].hex(),
+            len(self.shortids), len(self.prefilled))
+
+# BIP152 BlockTransactionsRequest, indexes sent differentially encoded
+class GetBlockTxn:
+    def __init__(self, hash, indexes):
+        self.hash = hash
+        self.indexes = indexes
+
+    def tobytes(self):
+        parts = [self.hash, VarInt(len(self.indexes)).tobytes()]
+        last = -1
+        for index in self.indexes:
+            parts.append(VarInt(index - last - 1).tobytes())
+            last = index
+        return b"".join(parts)
+
+    @staticmethod
+    def load(data):
+        buf = memoryview(data)
+        hash = bytes(buf[:32])
+        (count, offset) = VarInt.read_from(buf, 32)
+        indexes = []
+        index = -1
+        for _ in range(count):
+            (diff, offset) = VarInt.read_from(buf, offset)
+            index += diff + 1
+            if index > 0xFFFF:
+                raise ValueError("getblocktxn: index {} overflows 16 bits".format(index))
+            indexes.append(index)
+        return GetBlockTxn(hash, indexes)
+
+    def debug(self):
+        lib.debug("<getblocktxn>\nblock:{}\ncount:{}\n", self.hash[::-1].hex(), len(self.indexes))
+
+# BIP152 BlockTransactions. txs: serialized txs when sending, Tx objects
+# when loaded
+class BlockTxn:
+    def __init__(self, hash, txs):
+        self.hash = hash
+        self.txs = txs
+
+    def tobytes(self):
+        return self.hash + VarInt(len(self.txs)).tobytes() + b"".join(self.txs)
+
+    @staticmethod
+    def load(data):
+        buf = memoryview(data)
+        (count, offset) = VarInt.read_from(buf, 32)
+        txs = []
+        for _ in range(count):
+            (tx, offset) = Tx.load_from(buf, offset)
+            txs.append(tx)
+        return BlockTxn(bytes(buf[:32]), txs)
+
+    def debug(self):
+        lib.debug("<blocktxn>\nblock:{}\ncount:{}\n", self.hash[::-1].hex(), len(self.txs))
 
 class Reject:
     def __init__(self, message, ccode, reason, data):
@@ -230,104 +477,26 @@ class Reject:
 
     @staticmethod
     def load(data):
-        (message, size) = VarStr.load(data)
-        data = data[size:]
-
-        (ccode, ) = struct.unpack("<B", data[:1])
-
-        (reason, size) = VarStr.load(data)
-        data = data[size:]
-        return Reject(message, ccode, reason, data)
+        buf = memoryview(data)
+        (message, offset) = VarStr.load_from(buf, 0)
+        ccode = buf[offset]
+        (reason, offset) = VarStr.load_from(buf, offset + 1)
+        return Reject(message, ccode, reason, bytes(buf[offset:]))
 
     def debug(self):
         lib.debug("<reject>\nmessage:{}\nccode:{}\nreason:{}\ndata:{}\n", self.message, self.ccode, self.reason, self.data)
 
 class FeeFilter:
     def __init__(self, feerate):
-        self.feerate = feerate
+        self.feerate = feerate # satoshis per 1000 bytes
 
     def tobytes(self):
-        pass
+        return codec.U64.pack(self.feerate)
 
     @staticmethod
     def load(data):
-        (feerate, ) = struct.unpack("<Q", data)
+        (feerate, ) = codec.U64.unpack_from(data, 0)
         return FeeFilter(feerate)
 
     def debug(self):
         lib.debug("<feefilter>\nfeerate:{}\n", self.feerate)
-
-class Tx:
-    def __init__(self, version, flag, txin, txout, witness, locktime):
-        self.version = version
-        self.flag = flag
-        self.txin = txin
-        self.txout = txout
-        self.witness = witness
-        self.locktime = locktime
-
-    @staticmethod
-    def load(data):
-        totalsize = 0
-        (version, ) = struct.unpack("<i", data[:4])
-        totalsize += 4
-        data = data[4:]
-
-        (flag, ) = struct.unpack("<H", data[:2])
-        if flag == 1:
-            totalsize += 2
-            data = data[2:]
-        else:
-            flag = 0
-
-        incount, size = VarInt.load(data)
-        totalsize += size
-        data = data[size:]
-
-        ins = []
-        for _ in range(incount.value):
-            txin, size = TxIn.load(data)
-            totalsize += size
-            data = data[size:]
-            ins.append(txin)
-
-        outcount, size = VarInt.load(data)
-        totalsize += size
-        data = data[size:]
-
-        outs = []
-        for _ in range(outcount.value):
-            txout, size = TxOut.load(data)
-            totalsize += size
-            data = data[size:]
-            outs.append(txout)
-
-        witness = []
-        if flag > 0:
-            for _ in ins:
-                w, size = Witness.load(data)
-                totalsize += size
-                data = data[size:]
-                witness.append(w)
-
-        locktime = struct.unpack("<I", data[:4])
-        totalsize += 4
-        return (Tx(version, flag, ins, outs, witness, locktime), totalsize)
-
-    def tobytes(self):
-        ret = struct.pack("<i", self.version)
-        if self.flag > 0:
-            ret += struct.pack("<H", self.flag)
-        ret += VarInt(len(self.txin)).tobytes()
-        for tx in self.txin:
-            ret += tx.tobytes()
-        ret += VarInt(len(self.txout)).tobytes()
-        for tx in self.txout:
-            ret += tx.tobytes()
-        for w in self.witness:
-            ret += w.tobytes()
-        ret += struct.pack("<I", self.locktime)
-        return ret
-
-    def debug(self):
-        lib.debug("<tx>\nversion: {}\nflag: {}\nlocktime: {}\n", self.version, self.flag, self.locktime)
@@ -0,0 +1,184 @@
+import bisect
+import time
+
+# Counters and histograms of what the node does, kept only when
+# config.metrics_enabled is set. BitCoin.metrics is None otherwise, so every
+# hook costs an attribute test, and handlers aren't wrapped at all.
+# Read through the debug port: debug_metrics for a summary,
+# debug_prometheus for the Prometheus text format. Receive buffer figures
+# are of the selectors engine, the asyncio one reads through StreamReaders.
+
+# seconds, 10us to ~10s in powers of two
+LATENCY_BUCKETS = [0.00001 * 2 ** i for i in range(21)]
+# bytes, 1KB to 64MB
+SIZE_BUCKETS = [1024 * 2 ** i for i in range(17)]
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of the bucket holding the q-th quantile, None if empty
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    # ret: lines of the Prometheus histogram name{labels}
+    def prometheus(self, name, labels = ""):
+        sep = "," if labels else ""
+        lines = []
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            lines.append('{}_bucket{{{}{}le="{:g}"}} {}'.format(name, labels, sep, bound, seen))
+        lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(name, labels, sep, self.count))
+        braces = "{" + labels + "}" if labels else ""
+        lines.append("{}_sum{} {:.6f}".format(name, braces, self.sum))
+        lines.append("{}_count{} {}".format(name, braces, self.count))
+        return lines
+
+# commands are 12 byte keys on the way in, strings on the way out
+def command_name(cmd):
+    if isinstance(cmd, bytes):
+        return cmd.rstrip(b"\x00").decode("ascii", "replace")
+    return cmd
+
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.recv_cmds = {} # command -> [messages, bytes]
+        self.sent_cmds = {}
+        self.peers = {} # fd -> [messages in, bytes in, messages out, bytes out]
+        self.handlers = {} # command -> Histogram of handler seconds
+        self.loop_busy = Histogram(LATENCY_BUCKETS)
+        self.loop_lag = Histogram(LATENCY_BUCKETS)
+        self.recvbuf = Histogram(SIZE_BUCKETS)
+        self.last_tick = None
+
+    # size: of the whole message, header included
+    def recv(self, fd, cmd, size):
+        stats = self.recv_cmds.get(cmd)
+        if stats is None:
+            stats = self.recv_cmds[cmd] = [0, 0]
+        stats[0] += 1
+        stats[1] += size
+        peer = self.peer(fd)
+        peer[0] += 1
+        peer[1] += size
+
+    def sent(self, fd, cmd, size):
+        stats = self.sent_cmds.get(cmd)
+        if stats is None:
+            stats = self.sent_cmds[cmd] = [0, 0]
+        stats[0] += 1
+        stats[1] += size
+        peer = self.peer(fd)
+        peer[2] += 1
+        peer[3] += size
+
+    def peer(self, fd):
+        peer = self.peers.get(fd)
+        if peer is None:
+            peer = self.peers[fd] = [0, 0, 0, 0]
+        return peer
+
+    def remove_peer(self, fd):
+        self.peers.pop(fd, None)
+
+    # ret: handler(fd, payload) timed into the histogram of cmd
+    def timed(self, cmd, handler):
+        histogram = self.handlers.setdefault(command_name(cmd), Histogram(LATENCY_BUCKETS))
+        clock = time.perf_counter
+        def timed_handler(fd, payload):
+            start = clock()
+            try:
+                return handler(fd, payload)
+            finally:
+                histogram.observe(clock() - start)
+        return timed_handler
+
+    # once per tick of the main loop: lag is how late it ran past
+    # config.tick_interval, busy the time the loop spent on work since the
+    # last tick
+    def tick(self, interval, busy):
+        now = time.perf_counter()
+        if self.last_tick is not None:
+            self.loop_lag.observe(max(0, now - self.last_tick - interval))
+        self.last_tick = now
+        self.loop_busy.observe(busy)
+
+    # nodes: fd -> Node, their buffers are read at export time
+    def summary(self, nodes):
+        lines = ["up {:.0f}s".format(time.time() - self.start), "", "command       in msgs    in bytes   out msgs   out bytes"]
+        for cmd in sorted({command_name(c) for c in self.recv_cmds} | {command_name(c) for c in self.sent_cmds}):
+            (rm, rb) = self.recv_cmds.get(cmd.encode("ascii").ljust(12, b"\x00"), (0, 0))
+            (sm, sb) = self.sent_cmds.get(cmd, (0, 0))
+            lines.append("{:<12} {:>8} {:>11} {:>10} {:>11}".format(cmd, rm, rb, sm, sb))
+        lines += ["", "peer   in msgs    in bytes   out msgs   out bytes   recvbuf"]
+        for fd, (rm, rb, sm, sb) in sorted(self.peers.items()):
+            node = nodes.get(fd)
+            buf = "{}/{}".format(len(node.recvbuf), node.recvbuf.capacity()) if node else "-"
+            lines.append("{:<5} {:>8} {:>11} {:>10} {:>11}   {}".format(fd, rm, rb, sm, sb, buf))
+        lines += ["", "handler           count    total ms     p50 ms     p99 ms"]
+        for cmd, h in sorted(self.handlers.items()):
+            if h.count:
+                lines.append("{:<14} {:>8} {:>11.1f} {:>10.3f} {:>10.3f}".format(cmd, h.count, h.sum * 1e3, h.quantile(0.5) * 1e3, h.quantile(0.99) * 1e3))
+        lines.append("")
+        for name, h, scale, unit in (("loop busy", self.loop_busy, 1e3, "ms"), ("loop lag", self.loop_lag, 1e3, "ms"), ("recvbuf", self.recvbuf, 1, "bytes")):
+            if h.count:
+                lines.append("{}: {} samples, p50 {:g} {}, p99 {:g} {}".format(name, h.count, h.quantile(0.5) * scale, unit, h.quantile(0.99) * scale, unit))
+        return "\n".join(lines) + "\n"
+
+    # Prometheus text exposition format
+    def prometheus(self, nodes):
+        lines = []
+        def metric(name, type, help, samples):
+            lines.append("# HELP bcpy_{} {}".format(name, help))
+            lines.append("# TYPE bcpy_{} {}".format(name, type))
+            for labels, value in samples:
+                lines.append("bcpy_{}{} {}".format(name, "{" + labels + "}" if labels else "", value))
+
+        for direction, cmds in (("received", self.recv_cmds), ("sent", self.sent_cmds)):
+            metric("messages_{}_total".format(direction), "counter", "messages {} by command".format(direction),
+                [('command="{}"'.format(command_name(cmd)), stats[0]) for cmd, stats in cmds.items()])
+            metric("bytes_{}_total".format(direction), "counter", "bytes {} by command, headers included".format(direction),
+                [('command="{}"'.format(command_name(cmd)), stats[1]) for cmd, stats in cmds.items()])
+        for i, (name, help) in enumerate((("messages_received", "messages received"), ("bytes_received", "bytes received"),
+                ("messages_sent", "messages sent"), ("bytes_sent", "bytes sent"))):
+            metric("peer_{}_total".format(name), "counter", "{} by peer".format(help),
+                [('peer="{}"'.format(fd), stats[i]) for fd, stats in self.peers.items()])
+
+        metric("peers", "gauge", "connected peers", [("", sum(1 for node in nodes.values() if not node.debug))])
+        metric("recvbuf_pending_bytes", "gauge", "bytes received and not framed yet",
+            [('peer="{}"'.format(fd), len(node.recvbuf)) for fd, node in nodes.items() if not node.debug])
+        metric("recvbuf_capacity_bytes", "gauge", "receive buffer size",
+            [('peer="{}"'.format(fd), node.recvbuf.capacity()) for fd, node in nodes.items() if not node.debug])
+
+        for name, type, help, h in (("recvbuf_read_bytes", "histogram", "bytes pending in a receive buffer after a read", self.recvbuf),
+                ("loop_busy_seconds", "histogram", "time the main loop worked between ticks", self.loop_busy),
+                ("loop_lag_seconds", "histogram", "how late ticks ran past tick_interval", self.loop_lag)):
+            metric(name, type, help, [])
+            lines.extend("bcpy_" + line for line in h.prometheus(name))
+        metric("handler_seconds", "histogram", "message handler run time by command", [])
+        for cmd, h in sorted(self.handlers.items()):
+            lines.extend("bcpy_" + line for line in h.prometheus("handler_seconds", 'command="{}"'.format(cmd)))
+        return "\n".join(lines) + "\n"
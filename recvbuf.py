@@ -0,0 +1,73 @@
+import config
+
+# Growable per-node receive buffer.
+#
+#   [0, rpos)       consumed, free to be reused by compaction
+#   [rpos, wpos)    received but not yet framed
+#   [wpos, len)     free space for the next recv_into
+#
+# Views returned by view() are only valid until the next recv_into/reserve:
+# compaction moves the unread bytes to the front of the same bytearray, so
+# anything that must outlive a handler has to be copied with bytes().
+class RecvBuffer:
+    def __init__(self, size = config.recvbuf_size):
+        self.size = size
+        self.buf = bytearray(size)
+        self.rpos = 0
+        self.wpos = 0
+
+    def __len__(self):
+        return self.wpos - self.rpos
+
+    def capacity(self):
+        return len(self.buf)
+
+    # make room for at least n more bytes after wpos
+    def reserve(self, n):
+        if len(self.buf) - self.wpos >= n:
+            return
+
+        pending = self.wpos - self.rpos
+        if len(self.buf) - pending >= n:
+            # same-size slice assignment never resizes, so it is safe even
+            # while views into the bytearray are still alive
+            self.buf[:pending] = self.buf[self.rpos:self.wpos]
+        else:
+            # views may still be exported, so grow into a new bytearray
+            # instead of resizing this one in place
+            size = len(self.buf) * 2
+            while size - pending < n:
+                size *= 2
+            buf = bytearray(size)
+            buf[:pending] = self.buf[self.rpos:self.wpos]
+            self.buf = buf
+        self.rpos = 0
+        self.wpos = pending
+
+    # ret: bytes received, 0 on disconnect
+    def recv_into(self, sock):
+        self.reserve(config.recv_chunk)
+        with memoryview(self.buf) as view:
+            n = sock.recv_into(view[self.wpos:])
+        self.wpos += n
+        return n
+
+    def write(self, data):
+        n = len(data)
+        self.reserve(n)
+        self.buf[self.wpos:self.wpos + n] = data
+        self.wpos += n
+
+    def view(self):
+        return memoryview(self.buf)[self.rpos:self.wpos]
+
+    def consume(self, n):
+        self.rpos += n
+        if self.rpos < self.wpos:
+            return
+
+        self.rpos = 0
+        self.wpos = 0
+        # drop the storage a large message grew us to
+        if len(self.buf) > self.size:
+            self.buf = bytearray(self.size)
@@ -0,0 +1,136 @@
+# ECDSA signature verification on secp256k1, pure python.
+# Points are in jacobian coordinates (X, Y, Z) -> (X/Z^2, Y/Z^3),
+# None is the point at infinity.
+
+P = 2 ** 256 - 2 ** 32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+    0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
+
+def double(p):
+    if p is None:
+        return None
+    (x, y, z) = p
+    if y == 0:
+        return None
+    yy = y * y % P
+    s = 4 * x * yy % P
+    m = 3 * x * x % P
+    x3 = (m * m - 2 * s) % P
+    y3 = (m * (s - x3) - 8 * yy * yy) % P
+    return (x3, y3, 2 * y * z % P)
+
+def add(p, q):
+    if p is None:
+        return q
+    if q is None:
+        return p
+    (x1, y1, z1) = p
+    (x2, y2, z2) = q
+    z1z1 = z1 * z1 % P
+    if z2 == 1:
+        # q affine, the common case in mul_add
+        u1 = x1
+        s1 = y1
+    else:
+        z2z2 = z2 * z2 % P
+        u1 = x1 * z2z2 % P
+        s1 = y1 * z2 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s2 = y2 * z1 * z1z1 % P
+    if u1 == u2:
+        return double(p) if s1 == s2 else None
+    h = u2 - u1
+    r = s2 - s1
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - s1 * hhh) % P
+    return (x3, y3, h * z1 * z2 % P)
+
+def affine(p):
+    (x, y, z) = p
+    zinv = pow(z, -1, P)
+    zinv2 = zinv * zinv % P
+    return (x * zinv2 % P, y * zinv2 * zinv % P)
+
+# a * p + b * q with one shared run of doublings (Shamir's trick)
+def mul_add(a, p, b, q):
+    pq = add(p, q)
+    if pq is not None:
+        pq = affine(pq) + (1, )
+    ret = None
+    for i in range(max(a.bit_length(), b.bit_length()) - 1, -1, -1):
+        ret = double(ret)
+        bits = ((a >> i) & 1) | (((b >> i) & 1) << 1)
+        if bits == 1:
+            ret = add(ret, p)
+        elif bits == 2:
+            ret = add(ret, q)
+        elif bits == 3:
+            ret = add(ret, pq)
+    return ret
+
+# ret: public key point, None if data isn't a valid encoding
+def load_pubkey(data):
+    if len(data) == 33 and data[0] in (2, 3):
+        x = int.from_bytes(data[1:], "big")
+        if x >= P:
+            return None
+        yy = (x * x * x + 7) % P
+        y = pow(yy, (P + 1) // 4, P)
+        if y * y % P != yy:
+            return None
+        if y & 1 != data[0] & 1:
+            y = P - y
+        return (x, y, 1)
+    # 06/07 are "hybrid" keys, old blocks use them and openssl accepted them
+    if len(data) == 65 and data[0] in (4, 6, 7):
+        x = int.from_bytes(data[1:33], "big")
+        y = int.from_bytes(data[33:], "big")
+        if x >= P or y >= P or (y * y - x * x * x - 7) % P != 0:
+            return None
+        if data[0] != 4 and y & 1 != data[0] & 1:
+            return None
+        return (x, y, 1)
+    return None
+
+def _der_length(sig, pos):
+    n = sig[pos]
+    pos += 1
+    if n < 0x80:
+        return (n, pos)
+    size = n & 0x7F
+    return (int.from_bytes(sig[pos:pos + size], "big"), pos + size)
+
+# DER signature -> (r, s), None if malformed. Lax like openssl was before
+# BIP66: excess padding and a wrong outer length are tolerated.
+def load_signature(sig):
+    try:
+        if sig[0] != 0x30:
+            return None
+        (_, pos) = _der_length(sig, 1)
+        ints = []
+        for _ in range(2):
+            if sig[pos] != 0x02:
+                return None
+            (size, pos) = _der_length(sig, pos + 1)
+            if size == 0 or pos + size > len(sig):
+                return None
+            ints.append(int.from_bytes(sig[pos:pos + size], "big"))
+            pos += size
+    except IndexError:
+        return None
+    (r, s) = ints
+    if not 0 < r < N or not 0 < s < N:
+        return None
+    return (r, s)
+
+# z: the signed hash as an integer
+def verify(pubkey, r, s, z):
+    w = pow(s, -1, N)
+    point = mul_add(z * w % N, G, r * w % N, pubkey)
+    if point is None:
+        return False
+    return affine(point)[0] % N == r
@@ -0,0 +1,94 @@
+from array import array
+
+# SipHash-2-4, as used for BIP152 short ids. siphash_many() hashes a list
+# of 32 byte values at once: value i's 64 bit words sit in bits
+# 128 * i .. 128 * i + 63 of one python int, so xor, shifts and additions
+# work on every lane per operation. Sums stay below 2^65 and what spills
+# past bit 63 is masked off.
+
+M64 = 0xFFFFFFFFFFFFFFFF
+
+def _init(k0, k1):
+    return (k0 ^ 0x736F6D6570736575, k1 ^ 0x646F72616E646F6D, k0 ^ 0x6C7967656E657261, k1 ^ 0x7465646279746573)
+
+def _rounds(v0, v1, v2, v3, n):
+    for _ in range(n):
+        v0 = (v0 + v1) & M64
+        v1 = (v1 << 13 | v1 >> 51) & M64
+        v1 ^= v0
+        v0 = (v0 << 32 | v0 >> 32) & M64
+        v2 = (v2 + v3) & M64
+        v3 = (v3 << 16 | v3 >> 48) & M64
+        v3 ^= v2
+        v0 = (v0 + v3) & M64
+        v3 = (v3 << 21 | v3 >> 43) & M64
+        v3 ^= v0
+        v2 = (v2 + v1) & M64
+        v1 = (v1 << 17 | v1 >> 47) & M64
+        v1 ^= v2
+        v2 = (v2 << 32 | v2 >> 32) & M64
+    return (v0, v1, v2, v3)
+
+def siphash(k0, k1, data):
+    (v0, v1, v2, v3) = _init(k0, k1)
+    n = len(data) // 8
+    tail = int.from_bytes(data[n * 8:], "little") | (len(data) & 0xFF) << 56
+    for i in range(n + 1):
+        m = int.from_bytes(data[i * 8:i * 8 + 8], "little") if i < n else tail
+        v3 ^= m
+        (v0, v1, v2, v3) = _rounds(v0, v1, v2, v3, 2)
+        v0 ^= m
+    v2 ^= 0xFF
+    (v0, v1, v2, v3) = _rounds(v0, v1, v2, v3, 4)
+    return v0 ^ v1 ^ v2 ^ v3
+
+# the same rounds on lanes, mask covers the low 64 bits of every lane
+def _lane_rounds(v0, v1, v2, v3, n, mask):
+    for _ in range(n):
+        v0 = (v0 + v1) & mask
+        v1 = (v1 << 13 | v1 >> 51) & mask
+        v1 ^= v0
+        v0 = (v0 << 32 | v0 >> 32) & mask
+        v2 = (v2 + v3) & mask
+        v3 = (v3 << 16 | v3 >> 48) & mask
+        v3 ^= v2
+        v0 = (v0 + v3) & mask
+        v3 = (v3 << 21 | v3 >> 43) & mask
+        v3 ^= v0
+        v2 = (v2 + v1) & mask
+        v1 = (v1 << 17 | v1 >> 47) & mask
+        v1 ^= v2
+        v2 = (v2 << 32 | v2 >> 32) & mask
+    return (v0, v1, v2, v3)
+
+# values per lane pass, bigger ints fall out of the cpu caches
+LANES = 4096
+
+# ret: siphash of every 32 byte value in hashes, as an array('Q')
+def siphash_many(k0, k1, hashes):
+    ret = array("Q")
+    for i in range(0, len(hashes), LANES):
+        ret += _siphash_lanes(k0, k1, hashes[i:i + LANES])
+    return ret
+
+def _siphash_lanes(k0, k1, hashes):
+    count = len(hashes)
+    words = array("Q", b"".join(hashes))
+    lanes = array("Q", bytes(16 * count))
+    ones = int.from_bytes((b"\x01" + bytes(15)) * count, "little")
+    mask = M64 * ones
+    (v0, v1, v2, v3) = (v * ones for v in _init(k0, k1))
+    for j in range(4):
+        lanes[0::2] = words[j::4]
+        m = int.from_bytes(lanes.tobytes(), "little")
+        v3 ^= m
+        (v0, v1, v2, v3) = _lane_rounds(v0, v1, v2, v3, 2, mask)
+        v0 ^= m
+    m = (32 << 56) * ones
+    v3 ^= m
+    (v0, v1, v2, v3) = _lane_rounds(v0, v1, v2, v3, 2, mask)
+    v0 ^= m
+    v2 ^= 0xFF * ones
+    (v0, v1, v2, v3) = _lane_rounds(v0, v1, v2, v3, 4, mask)
+    lanes = array("Q", (v0 ^ v1 ^ v2 ^ v3).to_bytes(16 * count, "little"))
+    return lanes[0::2]
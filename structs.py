@@ -1,7 +1,13 @@
 import config
 import lib
-import struct
-import hashlib
+import codec
+from array import array
+
+# Every struct can be parsed in two ways:
+#   load(data)              -> (obj, size)      data: bytes-like, parsed from 0
+#   load_from(buf, offset)  -> (obj, offset)    buf: memoryview, offset after obj
+# load_from never slices the remaining buffer, so a whole block is parsed in
+# one linear pass. Only the bytes fields themselves are copied out of buf.
 
 class Message:
     def __init__(self, command, payload, magic = config.magic):
@@ -14,27 +20,51 @@ class Message:
     @staticmethod
     # ret: (msg, data, slicedmsg)
     def load(data):
-        datalen = len(data)
-        if datalen < 24:
+        buf = memoryview(data)
+        msg, offset = Message.load_from(buf, 0)
+        if not msg:
             return (None, None, data)
-        (magic, command, length, checksum) = struct.unpack("<I12sI4s", data[:24])
+        return (msg, bytes(buf[offset:]), None)
+
+    @staticmethod
+    # ret: (msg, offset), msg is None if buf doesn't hold a full message yet.
+    # msg.payload is a view into buf, not a copy.
+    def load_from(buf, offset):
+        datalen = len(buf) - offset
+        if datalen < 24:
+            return (None, offset)
+        (magic, command, length, checksum) = codec.MSGHEADER.unpack_from(buf, offset)
         if length + 24 > datalen:
-            return (None, None, data)
+            return (None, offset)
 
-        data = data[24:]
-        payload = data[:length]
-        data = data[length:]
+        offset += 24
+        payload = buf[offset:offset + length]
+        offset += length
 
         command = command.decode("utf-8").rstrip("\x00")
         msg = Message(command, payload, magic)
         if checksum != msg.checksum:
             lib.err("<{}> checksum failed: {}, {}", command, checksum, msg.checksum)
 
-        return (msg, data, None)
+        return (msg, offset)
+
+    @staticmethod
+    # ret: size of the whole message starting at offset, None if the header is incomplete
+    def size_from(buf, offset):
+        if len(buf) - offset < 24:
+            return None
+        (length, ) = codec.U32.unpack_from(buf, offset + 16)
+        return 24 + length
 
+    def header(self):
+        return codec.MSGHEADER.pack(self.magic, self.command.encode("utf-8"), self.length, self.checksum)
+
+    # header packed into a preallocated frame, the payload copied in once
     def tobytes(self):
-        return struct.pack("<I12sI4s{}s".format(self.length), self.magic, self.command.encode("utf-8"),
-            self.length, self.checksum, self.payload)
+        buf = bytearray(24 + self.length)
+        codec.MSGHEADER.pack_into(buf, 0, self.magic, self.command.encode("utf-8"), self.length, self.checksum)
+        buf[24:] = self.payload
+        return buf
 
 # 1st byte: size
 class CompressInt:
@@ -43,76 +73,93 @@ class CompressInt:
 
     @staticmethod
     def load(data):
-        (n, ) = struct.unpack("<B", data[:1])
+        return CompressInt.load_from(memoryview(data), 0)
+
+    @staticmethod
+    def load_from(buf, offset):
+        n = buf[offset]
         value = 0
         size = 0
         if n == 1:
-            (value, ) = struct.unpack("<B", data[1:2])
+            value = buf[offset + 1]
             size = 2
         elif n == 2:
-            (value, ) = struct.unpack("<H", data[1:3])
+            (value, ) = codec.U16.unpack_from(buf, offset + 1)
             size = 3
         elif n == 4:
-            (value, ) = struct.unpack("<I", data[1:5])
+            (value, ) = codec.U32.unpack_from(buf, offset + 1)
             size = 5
         elif n == 8:
-            (value, ) = struct.unpack("<Q", data[1:9])
+            (value, ) = codec.U64.unpack_from(buf, offset + 1)
             size = 9
-        return (CompressInt(value), size)
+        return (CompressInt(value), offset + size)
 
     def tobytes(self):
         if self.value < 0xFD:
-            return b'\x01' + struct.pack("<B", self.value)
+            return b'\x01' + codec.U8.pack(self.value)
         elif self.value <= 0xFFFF:
-            return b'\x02' + struct.pack("<H", self.value)
+            return b'\x02' + codec.U16.pack(self.value)
         elif self.value <= 0xFFFFFFFF:
-            return b'\x04' + struct.pack("<I", self.value)
+            return b'\x04' + codec.U32.pack(self.value)
         else:
-            return b'\x08' + struct.pack("<Q", self.value)
+            return b'\x08' + codec.U64.pack(self.value)
 
 class VarInt:
+    __slots__ = ("value", )
+
     def __init__(self, value):
         self.value = value
 
     @staticmethod
     def load(data):
-        (n, ) = struct.unpack("<B", data[:1])
-        value = 0
-        size = 0
+        return VarInt.load_from(memoryview(data), 0)
+
+    @staticmethod
+    def load_from(buf, offset):
+        value, offset = VarInt.read_from(buf, offset)
+        return (VarInt(value), offset)
+
+    @staticmethod
+    # ret: (value, offset), without building a VarInt
+    def read_from(buf, offset):
+        n = buf[offset]
         if n < 0xFD:
-            value = n
-            size = 1
+            return (n, offset + 1)
         elif n == 0xFD:
-            (value, ) = struct.unpack("<H", data[1:3])
-            size = 3
+            (value, ) = codec.U16.unpack_from(buf, offset + 1)
+            return (value, offset + 3)
         elif n == 0xFE:
-            (value, ) = struct.unpack("<I", data[1:5])
-            size = 5
-        elif n == 0xFF:
-            (value, ) = struct.unpack("<Q", data[1:9])
-            size = 9
-        return (VarInt(value), size)
+            (value, ) = codec.U32.unpack_from(buf, offset + 1)
+            return (value, offset + 5)
+        else:
+            (value, ) = codec.U64.unpack_from(buf, offset + 1)
+            return (value, offset + 9)
 
     def tobytes(self):
         if self.value < 0xFD:
-            return struct.pack("<B", self.value)
+            return codec.U8.pack(self.value)
         elif self.value <= 0xFFFF:
-            return b'\xFD' + struct.pack("<H", self.value)
+            return b'\xFD' + codec.U16.pack(self.value)
         elif self.value <= 0xFFFFFFFF:
-            return b'\xFE' + struct.pack("<I", self.value)
+            return b'\xFE' + codec.U32.pack(self.value)
         else:
-            return b'\xFF' + struct.pack("<Q", self.value)
+            return b'\xFF' + codec.U64.pack(self.value)
 
 class VarStr:
+    __slots__ = ("string", )
+
     def __init__(self, string):
         self.string = string # bytes
 
     @staticmethod
     def load(data):
-        varint, size = VarInt.load(data)
-        data = data[size:]
-        string = data[:varint.value]
-        return (VarStr(string), size + varint.value)
+        return VarStr.load_from(memoryview(data), 0)
+
+    @staticmethod
+    def load_from(buf, offset):
+        varint, offset = VarInt.load_from(buf, offset)
+        end = offset + varint.value
+        return (VarStr(bytes(buf[offset:end])), end)
 
     def tobytes(self):
         vi = VarInt(len(self.string))
@@ -123,6 +170,8 @@ class VarStr:
         return "{}({})".format(self.string, len(self.string))
 
 class NetAddr:
+    __slots__ = ("time", "services", "ip", "port")
+
     def __init__(self, time, services, ip, port):
         self.time = time
         self.services = services
@@ -131,36 +180,71 @@ class NetAddr:
 
     @staticmethod
     def load(data, from_version = False):
-        size = 30
+        return NetAddr.load_from(memoryview(data), 0, from_version)
+
+    @staticmethod
+    def load_from(buf, offset, from_version = False):
         time = 0
         if from_version:
-            size = 26
-            (services, ip, port) = struct.unpack("<Q16sH", data[:size])
-        else:
-            (time, services, ip, port) = struct.unpack("<IQ16sH", data[:size])
-        return (NetAddr(time, services, ip, port), size)
+            (services, ip) = codec.VERSION_NETADDR.unpack_from(buf, offset)
+            (port, ) = codec.PORT.unpack_from(buf, offset + 24)
+            return (NetAddr(time, services, ip, port), offset + 26)
+        (time, services, ip) = codec.NETADDR.unpack_from(buf, offset)
+        (port, ) = codec.PORT.unpack_from(buf, offset + 28)
+        return (NetAddr(time, services, ip, port), offset + 30)
 
     def tobytes(self, to_version = False):
         if to_version:
-            return struct.pack("<Q16sH", self.services, self.ip, self.port)
+            return codec.VERSION_NETADDR.pack(self.services, self.ip) + codec.PORT.pack(self.port)
         else:
-            return struct.pack("<IQ16sH", self.time, self.services, self.ip, self.port)
+            return codec.NETADDR.pack(self.time, self.services, self.ip) + codec.PORT.pack(self.port)
+
+MSG_TX = 1
+MSG_BLOCK = 2
+MSG_FILTERED_BLOCK = 3
+MSG_CMPCT_BLOCK = 4
+MSG_WITNESS_FLAG = 1 << 30
 
 class InvVect:
+    __slots__ = ("type", "hash")
+
     def __init__(self, type, hash):
         self.type = type
         self.hash = hash
 
     @staticmethod
     def load(data):
-        size = 36
-        type, hash = struct.unpack("<I32s", data[:size])
-        return (InvVect(type, hash), size)
+        return InvVect.load_from(memoryview(data), 0)
+
+    @staticmethod
+    def load_from(buf, offset):
+        type, hash = codec.INVVECT.unpack_from(buf, offset)
+        return (InvVect(type, hash), offset + 36)
 
     def tobytes(self):
-        pass
+        return codec.INVVECT.pack(self.type, self.hash)
+
+# Hashes (hash, txid, wtxid) are in internal byte order, reverse them for display.
+# They are computed once and cached together with the serialization; setting
+# any public field drops the cache. Objects loaded from an immutable buffer
+# keep offsets into it instead of a copy of their bytes.
+
+# bytes and read-only views can be kept, a RecvBuffer is reused
+def immutable(buf):
+    return isinstance(buf, bytes) or (isinstance(buf, memoryview) and buf.readonly)
+
+# data as a memoryview that loaded objects may keep
+def shared_view(data):
+    buf = memoryview(data)
+    if not buf.readonly:
+        buf = memoryview(bytes(buf))
+    return buf
 
 class BlockHeader:
+    _raw = None # serialization, or the buffer it was loaded from
+    _start = 0 # where it starts in _raw
+    _hash = None
+
     def __init__(self, version, prev, merkle, timestamp, bits, nonce):
         self.version = version
         self.prev = prev
@@ -169,53 +253,339 @@ class BlockHeader:
         self.bits = bits
         self.nonce = nonce
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # ids are derived from _raw, nothing is cached while it's unset
+        if self._raw is not None and name[0] != "_":
+            self.invalidate()
+
+    def invalidate(self):
+        self._raw = None
+        self._start = 0
+        self._hash = None
+
     @staticmethod
     def load(data):
-        version, prev, merkle, timestamp, bits, nonce = struct.unpack("<i32s32sIII", data[:80])
-        data = data[80:]
-        return (BlockHeader(version, prev, merkle, timestamp, bits, nonce), 80)
+        return BlockHeader.load_from(memoryview(data), 0)
+
+    @staticmethod
+    def load_from(buf, offset):
+        version, prev, merkle, timestamp, bits, nonce = codec.BLOCKHEADER.unpack_from(buf, offset)
+        header = BlockHeader(version, prev, merkle, timestamp, bits, nonce)
+        if immutable(buf):
+            header._raw = buf
+            header._start = offset
+        else:
+            header._raw = bytes(buf[offset:offset + 80])
+        return (header, offset + 80)
 
     def tobytes(self):
-        return struct.pack("<i32s32sIII", self.version, self.prev, self.merkle, self.timestamp, 
-            self.bits, self.nonce)
+        if self._raw is None:
+            self._raw = codec.BLOCKHEADER.pack(self.version, self.prev, self.merkle, self.timestamp,
+                self.bits, self.nonce)
+        if type(self._raw) is bytes and len(self._raw) == 80:
+            return self._raw
+        return bytes(self._raw[self._start:self._start + 80])
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = lib.double_hash(self.tobytes())
+        return self._hash
 
 class Block:
     def __init__(self, header, txs):
         self.header = header
         self.txs = txs
 
-    @staticmethod
-    def load(data):
-        totalsize = 0
-        (size, ) = struct.unpack("<I", data[:4])
-        totalsize += 4
-        data = data[4:]
+    @property
+    def hash(self):
+        return self.header.hash
+
+    # txids of all txs, the uncached ones are hashed in one batch
+    def txids(self):
+        pending = [tx for tx in self.txs if tx._txid is None]
+        if pending:
+            hashes = lib.double_hash_many([tx.tobytes(False) for tx in pending])
+            for tx, h in zip(pending, hashes):
+                tx._txid = h
+        return [tx.txid for tx in self.txs]
+
+    def merkle_root(self):
+        if not self.txs:
+            return b""
+        return lib._merkle_root(self.txids())
 
-        header, size = BlockHeader.load(data)
-        totalsize += size
-        data = data[size:]
+    def debug(self):
+        lib.debug("<block>\nhash: {}\ntxs: {}\n", self.hash[::-1].hex(), len(self.txs))
 
-        vi, size = VarInt.load(data)
-        totalsize += size
-        data = data[size:]
+    @staticmethod
+    def load(data, columnar = False):
+        return Block.load_from(shared_view(data), 0, columnar)
+
+    @staticmethod
+    # columnar: keep all outputs of the block in one TxOutColumns
+    def load_from(buf, offset, columnar = False):
+        header, offset = BlockHeader.load_from(buf, offset)
+        vi, offset = VarInt.load_from(buf, offset)
 
+        columns = TxOutColumns() if columnar else None
         txs = []
         for _ in range(vi.value):
-            tx, size = Tx.load(data)
-            totalsize += size
-            data = data[size:]
+            tx, offset = Tx.load_from(buf, offset, columns)
             txs.append(tx)
 
-        return (Block(header, txs), totalsize)
+        return (Block(header, txs), offset)
+
+    def tobytes(self):
+        parts = [self.header.tobytes(), VarInt(len(self.txs)).tobytes()]
+        parts.extend(tx.tobytes() for tx in self.txs)
+        return b"".join(parts)
+
+# Block that keeps its raw payload and only decodes what is asked for.
+# The header is parsed up front, transactions are located on first access
+# (one scan, no objects) and decoded one by one through tx(i).
+# As long as txs is never touched, tobytes() returns the original bytes.
+class LazyBlock:
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.header, offset = BlockHeader.load_from(self.data, 0)
+        self.count, self.txstart = VarInt.read_from(self.data, offset)
+        self.offsets = None # array('I'), start of every tx plus the end of the last
+        self.cache = {}
+        self._txs = None
+
+    def __len__(self):
+        return self.count
+
+    def index(self):
+        if self.offsets is not None:
+            return self.offsets
+        buf = memoryview(self.data)
+        offsets = array("I", [self.txstart])
+        offset = self.txstart
+        for _ in range(self.count):
+            offset = Tx.skip_from(buf, offset)
+            offsets.append(offset)
+        self.offsets = offsets
+        return offsets
+
+    # raw bytes of the i-th tx, as a view into data
+    def tx_bytes(self, i):
+        offsets = self.index()
+        return memoryview(self.data)[offsets[i]:offsets[i + 1]]
+
+    # txid of the i-th tx, legacy txs are hashed straight from data
+    def txid(self, i):
+        if self._txs is not None or i in self.cache:
+            return self.tx(i).txid
+        raw = self.tx_bytes(i)
+        if raw[4] == 0:
+            return self.tx(i).txid
+        return lib.double_hash(raw)
+
+    def txids(self):
+        return [self.txid(i) for i in range(self.count)]
+
+    # wtxid of the i-th tx, the hash of its full serialisation
+    def wtxid(self, i):
+        if self._txs is not None or i in self.cache:
+            return self.tx(i).wtxid
+        return lib.double_hash(self.tx_bytes(i))
+
+    # decoded i-th tx, treat as read-only (use txs to modify the block)
+    def tx(self, i):
+        if self._txs is not None:
+            return self._txs[i]
+        tx = self.cache.get(i)
+        if not tx:
+            tx, _ = Tx.load(self.tx_bytes(i))
+            self.cache[i] = tx
+        return tx
+
+    # fully decoded, mutable list of txs. Once taken, tobytes() re-serialises.
+    @property
+    def txs(self):
+        if self._txs is None:
+            self._txs = [self.tx(i) for i in range(self.count)]
+            self.cache = {}
+        return self._txs
 
     def tobytes(self):
-        ret = self.header.tobytes()
-        ret += VarInt(len(self.txs)).tobytes()
-        for tx in self.txs:
+        header = self.header.tobytes()
+        if self._txs is None and header == self.data[:80]:
+            return self.data
+        if self._txs is None:
+            return header + self.data[80:]
+        return Block(self.header, self._txs).tobytes()
+
+# Changing txin/txout/witness in place isn't seen by __setattr__,
+# call invalidate() afterwards.
+class Tx:
+    _raw = None # serialization, or the buffer it was loaded from
+    _start = 0 # where it starts in _raw
+    _end = 0
+    _wstart = 0 # where the witnesses start, from _start
+    _txid = None
+    _wtxid = None
+
+    def __init__(self, version, flag, txin, txout, witness, locktime):
+        self.version = version
+        self.flag = flag
+        self.txin = txin
+        self.txout = txout
+        self.witness = witness
+        self.locktime = locktime
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # ids are derived from _raw, nothing is cached while it's unset
+        if self._raw is not None and name[0] != "_":
+            self.invalidate()
+
+    def invalidate(self):
+        self._raw = None
+        self._start = 0
+        self._end = 0
+        self._wstart = 0
+        self._txid = None
+        self._wtxid = None
+
+    @staticmethod
+    def load(data):
+        return Tx.load_from(shared_view(data), 0)
+
+    @staticmethod
+    # columns: TxOutColumns to append the outputs to, txout is then a TxOutRange
+    def load_from(buf, offset, columns = None):
+        start = offset
+        (version, ) = codec.I32.unpack_from(buf, offset)
+        offset += 4
+
+        # segwit: 0x00 marker followed by a non-zero flag byte
+        flag = 0
+        if buf[offset] == 0:
+            flag = buf[offset + 1]
+            offset += 2
+
+        incount, offset = VarInt.load_from(buf, offset)
+        ins = []
+        for _ in range(incount.value):
+            txin, offset = TxIn.load_from(buf, offset)
+            ins.append(txin)
+
+        outcount, offset = VarInt.load_from(buf, offset)
+        if columns is None:
+            outs = []
+            for _ in range(outcount.value):
+                txout, offset = TxOut.load_from(buf, offset)
+                outs.append(txout)
+        else:
+            first = len(columns)
+            for _ in range(outcount.value):
+                offset = columns.load_from(buf, offset)
+            outs = TxOutRange(columns, first, len(columns))
+
+        wstart = offset - start
+        witness = []
+        if flag > 0:
+            for _ in ins:
+                w, offset = Witness.load_from(buf, offset)
+                witness.append(w)
+
+        (locktime, ) = codec.U32.unpack_from(buf, offset)
+        offset += 4
+        tx = Tx(version, flag, ins, outs, witness, locktime)
+        if immutable(buf):
+            tx._raw = buf
+            tx._start = start
+            tx._end = offset
+        else:
+            tx._raw = bytes(buf[start:offset])
+            tx._end = offset - start
+        tx._wstart = wstart
+        return (tx, offset)
+
+    @staticmethod
+    # ret: offset after the tx at offset, nothing is decoded
+    def skip_from(buf, offset):
+        offset += 4
+        flag = 0
+        if buf[offset] == 0:
+            flag = buf[offset + 1]
+            offset += 2
+
+        n_in, offset = VarInt.read_from(buf, offset)
+        for _ in range(n_in):
+            size, offset = VarInt.read_from(buf, offset + 36)
+            offset += size + 4
+
+        n, offset = VarInt.read_from(buf, offset)
+        for _ in range(n):
+            size, offset = VarInt.read_from(buf, offset + 8)
+            offset += size
+
+        if flag > 0:
+            for _ in range(n_in):
+                items, offset = VarInt.read_from(buf, offset)
+                for _ in range(items):
+                    size, offset = VarInt.read_from(buf, offset)
+                    offset += size
+
+        if offset + 4 > len(buf):
+            raise IndexError("tx out of range")
+        return offset + 4
+
+    # witness: False gives the legacy serialization the txid is computed from
+    def tobytes(self, witness = True):
+        if self._raw is None:
+            self.serialize()
+        (raw, start, end) = (self._raw, self._start, self._end)
+        if witness or self.flag == 0:
+            if type(raw) is bytes and start == 0 and end == len(raw):
+                return raw
+            return bytes(raw[start:end])
+        return b"".join((raw[start:start + 4], raw[start + 6:start + self._wstart], raw[end - 4:end]))
+
+    def serialize(self):
+        ret = codec.I32.pack(self.version)
+        if self.flag > 0:
+            ret += b'\x00' + codec.U8.pack(self.flag)
+        ret += VarInt(len(self.txin)).tobytes()
+        for tx in self.txin:
             ret += tx.tobytes()
-        return ret
+        ret += VarInt(len(self.txout)).tobytes()
+        for tx in self.txout:
+            ret += tx.tobytes()
+        wstart = len(ret)
+        for w in self.witness:
+            ret += w.tobytes()
+        ret += codec.U32.pack(self.locktime)
+        self._raw = ret
+        self._start = 0
+        self._end = len(ret)
+        self._wstart = wstart
+
+    @property
+    def txid(self):
+        if self._txid is None:
+            self._txid = lib.double_hash(self.tobytes(False))
+        return self._txid
+
+    @property
+    def wtxid(self):
+        if self.flag == 0:
+            return self.txid
+        if self._wtxid is None:
+            self._wtxid = lib.double_hash(self.tobytes())
+        return self._wtxid
+
+    def debug(self):
+        lib.debug("<tx>\nversion: {}\nflag: {}\nlocktime: {}\n", self.version, self.flag, self.locktime)
 
 class TxIn:
+    __slots__ = ("prev", "script", "sequence")
+
     def __init__(self, prev, script, sequence):
         self.prev = prev
         self.script = script
@@ -223,50 +593,111 @@ class TxIn:
 
     @staticmethod
     def load(data):
-        totalsize = 0
-        prev, size = OutPoint.load(data)
-        totalsize += size
-        data = data[size:]
-
-        script, size = VarStr.load(data)
-        totalsize += size
-        data = data[size:]
+        return TxIn.load_from(memoryview(data), 0)
 
-        sequence = struct.unpack("<I", data[:4])
-        totalsize += 4
-        return (TxIn(prev, script, sequence), totalsize)
+    @staticmethod
+    def load_from(buf, offset):
+        prev, offset = OutPoint.load_from(buf, offset)
+        script, offset = VarStr.load_from(buf, offset)
+        (sequence, ) = codec.U32.unpack_from(buf, offset)
+        return (TxIn(prev, script, sequence), offset + 4)
 
     def tobytes(self):
-        return self.prev.tobytes() + self.script.tobytes() + struct.pack("<I", self.sequence)
+        return self.prev.tobytes() + self.script.tobytes() + codec.U32.pack(self.sequence)
 
 class TxOut:
+    __slots__ = ("value", "script")
+
     def __init__(self, value, script):
         self.value = value
         self.script = script
 
     @staticmethod
     def load(data):
-        (value, ) = struct.unpack("<Q", data[:8])
-        data = data[8:]
+        return TxOut.load_from(memoryview(data), 0)
 
-        vs, size = VarStr.load(data)
-        return (TxOut(value, vs), 8 + size)
+    @staticmethod
+    def load_from(buf, offset):
+        (value, ) = codec.U64.unpack_from(buf, offset)
+        vs, offset = VarStr.load_from(buf, offset + 8)
+        return (TxOut(value, vs), offset)
 
     def tobytes(self):
-        return struct.pack("<Q", self.value) + self.script.tobytes()
+        return codec.U64.pack(self.value) + self.script.tobytes()
+
+# Columnar storage for many TxOuts: one array of values and one script blob.
+# ends[i] is where the i-th script stops in scripts.
+class TxOutColumns:
+    __slots__ = ("values", "scripts", "ends")
+
+    def __init__(self):
+        self.values = array("Q")
+        self.scripts = bytearray()
+        self.ends = array("I")
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return TxOut(self.values[i], VarStr(self.script(i)))
+
+    def append(self, value, script):
+        self.values.append(value)
+        self.scripts += script
+        self.ends.append(len(self.scripts))
+
+    # parse one TxOut at offset straight into the columns, ret: offset after it
+    def load_from(self, buf, offset):
+        (value, ) = codec.U64.unpack_from(buf, offset)
+        size, offset = VarInt.read_from(buf, offset + 8)
+        self.append(value, buf[offset:offset + size])
+        return offset + size
+
+    def script(self, i):
+        start = self.ends[i - 1] if i > 0 else 0
+        return bytes(self.scripts[start:self.ends[i]])
+
+# The outputs of one tx inside a TxOutColumns, behaves like a list of TxOut
+class TxOutRange:
+    __slots__ = ("columns", "start", "end")
+
+    def __init__(self, columns, start, end):
+        self.columns = columns
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("txout index out of range")
+        return self.columns[self.start + i]
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield self.columns[i]
 
 class OutPoint:
+    __slots__ = ("hash", "index")
+
     def __init__(self, hash, index):
         self.hash = hash
         self.index = index
 
     @staticmethod
     def load(data):
-        hash, index = struct.unpack("<32sI", data[:36])
-        return (OutPoint(hash, index), 36)
+        return OutPoint.load_from(memoryview(data), 0)
+
+    @staticmethod
+    def load_from(buf, offset):
+        hash, index = codec.OUTPOINT.unpack_from(buf, offset)
+        return (OutPoint(hash, index), offset + 36)
 
     def tobytes(self):
-        return struct.pack("<32sI", self.hash, self.index)
+        return codec.OUTPOINT.pack(self.hash, self.index)
 
 class Witness:
     def __init__(self, witnesses):
@@ -274,18 +705,16 @@ class Witness:
 
     @staticmethod
     def load(data):
-        totalsize = 0
-        (vi, size) = VarInt.load(data)
-        totalsize += size
-        data = data[size:]
+        return Witness.load_from(memoryview(data), 0)
 
+    @staticmethod
+    def load_from(buf, offset):
+        (vi, offset) = VarInt.load_from(buf, offset)
         witnesses = []
         for _ in range(vi.value):
-            (vs, size) = VarStr.load(data)
-            totalsize += size
-            data = data[size:]
+            (vs, offset) = VarStr.load_from(buf, offset)
             witnesses.append(vs)
-        return (Witness(witnesses), totalsize)
+        return (Witness(witnesses), offset)
 
     def tobytes(self):
         ret = VarInt(len(self.witnesses)).tobytes()
@@ -0,0 +1,260 @@
+import time
+import config
+import lib
+from structs import *
+from messages import *
+from blockindex import *
+
+POW_LIMIT = bits_to_target(0x1d00ffff)
+RETARGET_INTERVAL = 2016
+RETARGET_TIMESPAN = RETARGET_INTERVAL * 600
+MAX_HEADERS = 2000
+
+# bits the block after prev must have
+def next_bits(prev):
+    height = prev.height + 1
+    if height % RETARGET_INTERVAL != 0:
+        return prev.bits()
+    first = prev.ancestor(height - RETARGET_INTERVAL)
+    timespan = prev.timestamp() - first.timestamp()
+    timespan = min(max(timespan, RETARGET_TIMESPAN // 4), RETARGET_TIMESPAN * 4)
+    target = bits_to_target(prev.bits()) * timespan // RETARGET_TIMESPAN
+    return target_to_bits(min(target, POW_LIMIT))
+
+# ret: error string, None if header may follow prev
+def check_header(header, prev):
+    target = bits_to_target(header.bits)
+    if target <= 0 or target > POW_LIMIT:
+        return "bad target"
+    if int.from_bytes(header.hash, "little") > target:
+        return "insufficient proof of work"
+    if header.bits != next_bits(prev):
+        return "unexpected bits"
+    if header.timestamp <= prev.median_time():
+        return "timestamp too early"
+    if header.timestamp > time.time() + 2 * 60 * 60:
+        return "timestamp too far in the future"
+    return None
+
+# Headers-first sync.
+# One peer at a time is asked for headers. The next getheaders goes out as
+# soon as a full batch arrives, before that batch is validated, so the
+# round trip overlaps with the processing. Blocks on the best header chain
+# are then requested from every ready peer, at most
+# config.max_blocks_in_flight per peer and no further than
+# config.download_window past the tip. Blocks that arrive before their
+# parent is connected wait in self.blocks.
+class SyncManager:
+    def __init__(self, bc):
+        self.bc = bc
+        self.index = bc.index
+        self.peers = {} # fd -> set of block hashes in flight
+        self.header_peer = None
+        self.header_time = 0
+        self.inflight = {} # hash -> (fd, time requested)
+        self.blocks = {} # hash -> Block waiting to be connected
+
+    def add_peer(self, fd):
+        self.peers[fd] = set()
+        if self.header_peer is None:
+            self.request_headers(fd, self.index.best_header)
+        self.schedule()
+
+    def remove_peer(self, fd):
+        hashes = self.peers.pop(fd, None)
+        if hashes is None:
+            return
+        for hash in hashes:
+            self.inflight.pop(hash, None)
+        if self.header_peer == fd:
+            self.header_peer = None
+            for other in self.peers:
+                self.request_headers(other, self.index.best_header)
+                break
+        self.schedule()
+
+    def request_headers(self, fd, entry):
+        self.header_peer = fd
+        self.header_time = time.time()
+        msg = GetHeaders(self.index.locator(entry), b"")
+        self.bc.send_msg(fd, Message("getheaders", msg.tobytes()))
+
+    def on_headers(self, fd, headers):
+        if not headers:
+            if fd == self.header_peer:
+                self.header_peer = None
+                lib.info("headers synced to {}", self.index.best_header.height)
+            return
+
+        last = headers[-1]
+        # pipeline: ask for the next batch before working on this one
+        if len(headers) == MAX_HEADERS and fd == self.header_peer:
+            self.header_time = time.time()
+            msg = GetHeaders([last.hash], b"")
+            self.bc.send_msg(fd, Message("getheaders", msg.tobytes()))
+
+        batch = self.bc.db.batch()
+        for header in headers:
+            prev = self.index.get(header.prev)
+            if not prev:
+                lib.err("headers from {} don't connect: {}", fd, header.hash[::-1].hex())
+                # ask from our best header, the peer fills the gap
+                self.request_headers(fd, self.index.best_header)
+                break
+            if prev.status & BLOCK_FAILED:
+                lib.err("header {} builds on an invalid block", header.hash[::-1].hex())
+                break
+            if not self.index.get(header.hash):
+                err = check_header(header, prev)
+                if err:
+                    lib.err("invalid header {} from {}: {}", header.hash[::-1].hex(), fd, err)
+                    break
+            self.index.add(header, BLOCK_VALID_HEADER, batch)
+        self.bc.db.write(batch)
+
+        if len(headers) < MAX_HEADERS and fd == self.header_peer:
+            self.header_peer = None
+            lib.info("headers synced to {}", self.index.best_header.height)
+        self.schedule()
+
+    # a peer announced a block we don't know, fetch the headers leading to it
+    def on_announce(self, fd, hash):
+        if self.index.get(hash) or self.header_peer is not None:
+            return
+        self.request_headers(fd, self.index.best_header)
+
+    # send getdata for the next blocks of the best header chain
+    def schedule(self):
+        tip = self.index.tip()
+        best = self.index.best_header
+        if not tip or not best or not self.peers:
+            return
+        if best.chainwork <= tip.chainwork:
+            return
+
+        fork = self.index.find_fork(best)
+        if fork is not tip:
+            # drop the branch and go on with the best header off it
+            lib.err("best header chain {} forks at {} below the tip, reorgs aren't supported, marking it stale",
+                best.hash[::-1].hex(), fork.height)
+            batch = self.bc.db.batch()
+            self.index.mark_stale(best.ancestor(fork.height + 1), batch)
+            self.bc.db.write(batch)
+            self.evict()
+            self.schedule()
+            return
+
+        requests = {}
+        end = min(best.height, tip.height + config.download_window)
+        for height in range(tip.height + 1, end + 1):
+            entry = best.ancestor(height)
+            if entry.hash in self.inflight or entry.hash in self.blocks:
+                continue
+            fd = self.pick_peer()
+            if fd is None:
+                break
+            self.peers[fd].add(entry.hash)
+            self.inflight[entry.hash] = (fd, time.time())
+            type = MSG_BLOCK | MSG_WITNESS_FLAG
+            if entry is best and entry.prev is tip and self.bc.nodes[fd].cmpct:
+                # a new block on top of our tip, most of its txs are in the mempool
+                type = MSG_CMPCT_BLOCK
+            requests.setdefault(fd, []).append(InvVect(type, entry.hash))
+
+        for fd, inventory in requests.items():
+            self.bc.send_msg(fd, Message("getdata", GetData(inventory).tobytes()))
+
+    # peer with the fewest blocks in flight, None if all are full
+    def pick_peer(self):
+        fd = None
+        for peer, hashes in self.peers.items():
+            if len(hashes) >= config.max_blocks_in_flight:
+                continue
+            if fd is None or len(hashes) < len(self.peers[fd]):
+                fd = peer
+        return fd
+
+    def on_block(self, fd, block):
+        hash = block.hash
+        request = self.inflight.pop(hash, None)
+        if request:
+            self.peers.get(request[0], set()).discard(hash)
+
+        entry = self.index.get(hash)
+        if not entry:
+            prev = self.index.get(block.header.prev)
+            if not prev or check_header(block.header, prev):
+                lib.err("unrequested block {} from {}", hash[::-1].hex(), fd)
+                return
+            entry = self.index.add(block.header)
+        if entry.status & (BLOCK_CONNECTED | BLOCK_FAILED | BLOCK_STALE):
+            return
+        if block.merkle_root() != block.header.merkle:
+            lib.err("block {} from {}: bad merkle root", hash[::-1].hex(), fd)
+            self.schedule()
+            return
+
+        self.blocks[hash] = block
+        self.connect()
+        self.evict()
+        self.schedule()
+
+    # connect buffered blocks for as long as the next one is there
+    def connect(self):
+        best = self.index.best_header
+        while True:
+            tip = self.index.tip()
+            if tip.height >= best.height:
+                return
+            entry = best.ancestor(tip.height + 1)
+            if entry.prev is not tip:
+                return
+            block = self.blocks.pop(entry.hash, None)
+            if not block:
+                return
+
+            batch = self.bc.db.batch()
+            undo = self.bc.coins.connect_block(block, entry.height, self.bc.validator.check_block)
+            if undo is None:
+                lib.err("block {} at {} failed to connect", entry.hash[::-1].hex(), entry.height)
+                self.index.mark_failed(entry, batch)
+                self.bc.db.write(batch)
+                return
+
+            self.bc.db.add_block(entry.hash, block.tobytes(), batch)
+            self.index.raise_status(entry, BLOCK_HAVE_DATA | BLOCK_CONNECTED, batch)
+            self.index.set_tip(entry, batch = batch)
+            self.bc.mempool.remove_for_block(block)
+            self.bc.coins.trim(batch)
+            self.bc.db.write(batch)
+            if entry is self.index.best_header:
+                self.bc.announce_block(block)
+            if entry.height % 1000 == 0:
+                lib.info("tip: {} {}", entry.height, entry.hash[::-1].hex())
+
+    # drop waiting blocks that won't connect: at or below the tip, or off
+    # the best header chain
+    def evict(self):
+        tip = self.index.tip()
+        best = self.index.best_header
+        for hash in list(self.blocks):
+            entry = self.index.get(hash)
+            if entry.height <= tip.height or best.ancestor(entry.height) is not entry:
+                del self.blocks[hash]
+
+    # re-request blocks that timed out, restart a stalled header sync
+    def tick(self):
+        now = time.time()
+        expired = [hash for hash, (fd, t) in self.inflight.items() if now - t > config.block_timeout]
+        for hash in expired:
+            fd, _ = self.inflight.pop(hash)
+            self.peers.get(fd, set()).discard(hash)
+        if self.header_peer is not None and now - self.header_time > config.block_timeout:
+            self.header_peer = None
+        if (self.header_peer is None and now - self.header_time > config.block_timeout and
+                self.index.best_header.timestamp() < now - 60 * 60):
+            for fd in self.peers:
+                self.request_headers(fd, self.index.best_header)
+                break
+        if expired:
+            self.schedule()
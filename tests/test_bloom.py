@@ -0,0 +1,71 @@
+import copy
+import random
+import time
+import pytest
+import bloom
+import codec
+from merkle import MerkleTree
+from structs import BlockHeader, LazyBlock, OutPoint, Tx, TxIn, TxOut, VarInt, VarStr
+
+def p2pkh(keyhash):
+    return VarStr(b"\x76\xa9\x14" + keyhash + b"\x88\xac")
+
+def sigscript(rnd):
+    return VarStr(b"\x47" + rnd.randbytes(71) + b"\x21" + rnd.randbytes(33))
+
+# txs paying to a few key hashes, tx 200 spends an output of tx 10
+def make_block(rnd, keyhashes, count = 300):
+    txs = [Tx(1, 0, [TxIn(OutPoint(bytes(32), 0xFFFFFFFF), VarStr(b"\x03abc"), 0)], [TxOut(50, p2pkh(keyhashes[0]))], [], 0)]
+    for _ in range(1, count):
+        ins = [TxIn(OutPoint(rnd.randbytes(32), rnd.randrange(3)), sigscript(rnd), 0xFFFFFFFF) for _ in range(rnd.randint(1, 3))]
+        outs = [TxOut(1000, p2pkh(rnd.choice(keyhashes))) for _ in range(rnd.randint(1, 4))]
+        txs.append(Tx(1, 0, ins, outs, [], 0))
+    txs[200].txin[0] = TxIn(OutPoint(txs[10].txid, 0), sigscript(rnd), 0xFFFFFFFF)
+    header = BlockHeader(1, bytes(32), MerkleTree([tx.txid for tx in txs]).root(), int(time.time()), 0x1D00FFFF, 0)
+    return LazyBlock(header.tobytes() + VarInt(len(txs)).tobytes() + b"".join(tx.tobytes() for tx in txs))
+
+# BIP37 as written: every element of every tx through contains(), in order
+def reference_match(f, block):
+    matches = []
+    for n in range(len(block)):
+        tx = block.tx(n)
+        found = f.contains(tx.txid)
+        for index, out in enumerate(tx.txout):
+            script = out.script.string
+            if any(f.contains(item) for item in bloom.script_pushes(script)):
+                found = True
+                if f.flags == bloom.BLOOM_UPDATE_ALL or (f.flags == bloom.BLOOM_UPDATE_P2PUBKEY_ONLY and bloom.is_pubkey_script(script)):
+                    f.insert(codec.OUTPOINT.pack(tx.txid, index))
+        if not found:
+            found = any(f.contains(txin.prev.tobytes()) or any(f.contains(item) for item in bloom.script_pushes(txin.script.string))
+                for txin in tx.txin)
+        if found:
+            matches.append(n)
+    return matches
+
+@pytest.mark.parametrize("seed", range(4))
+def test_match_parity(seed):
+    rnd = random.Random(seed)
+    keyhashes = [rnd.randbytes(20) for _ in range(500)]
+    block = make_block(rnd, keyhashes)
+    elements = bloom.block_elements(block)
+    filters = [(size, rnd.randint(1, 30), rnd.choice((1, 5, 50))) for size in (100, 1000)]
+    # small filters match most elements: the outpoint added for one output
+    # often matches the later elements of the same tx
+    filters += [(rnd.choice((2, 4, 8, 16)), rnd.randint(1, 12), rnd.randint(1, 3)) for _ in range(25)]
+    for size, nhashes, keys in filters:
+        f = bloom.BloomFilter(bytes(size), nhashes, rnd.randrange(2 ** 32), rnd.randrange(3))
+        for _ in range(keys):
+            f.insert(rnd.choice(keyhashes))
+        expected = copy.deepcopy(f)
+        assert f.match(elements) == reference_match(expected, block)
+        assert f.data == expected.data
+
+def test_spend_of_matched_output():
+    rnd = random.Random(100)
+    keyhashes = [rnd.randbytes(20) for _ in range(500)]
+    block = make_block(rnd, keyhashes)
+    f = bloom.BloomFilter(bytes(1000), 10, 12345, bloom.BLOOM_UPDATE_ALL)
+    f.insert(block.tx(10).txout[0].script.string[3:23])
+    matches = f.match(bloom.block_elements(block))
+    assert 10 in matches and 200 in matches
@@ -0,0 +1,21 @@
+import random
+import pytest
+import lib
+from merkle import MerkleTree
+
+# each pair concatenated and double hashed, the last node of an odd level
+# paired with itself
+def reference_root(nodes):
+    while len(nodes) > 1:
+        if len(nodes) % 2 != 0:
+            nodes = nodes + nodes[-1:]
+        nodes = [lib.double_hash(nodes[i] + nodes[i + 1]) for i in range(0, len(nodes), 2)]
+    return nodes[0]
+
+@pytest.mark.parametrize("count", list(range(1, 18)) + [1000, 5001])
+def test_root(count):
+    rnd = random.Random(count)
+    leaves = [rnd.randbytes(32) for _ in range(count)]
+    root = reference_root(leaves)
+    assert lib._merkle_root(list(leaves)) == root
+    assert MerkleTree(leaves).root() == root
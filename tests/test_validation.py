@@ -0,0 +1,69 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+from coins import Coin
+from structs import OutPoint, Tx, TxIn, TxOut, VarStr, Witness
+from validation import FAILED, SKIPPED, ScriptValidator, check_batch, check_input, check_tx_inputs, pushes, result_of
+
+P2PKH = b"\x76\xa9\x14" + bytes(20) + b"\x88\xac"
+P2PK = b"\x21" + b"\x02" + bytes(32) + b"\xac"
+P2WPKH = b"\x00\x14" + bytes(20)
+P2SH = b"\xa9\x14" + bytes(20) + b"\x87"
+
+def spend(script_sig, witness = None):
+    return Tx(2, 1 if witness else 0, [TxIn(OutPoint(bytes(32), 0), VarStr(script_sig), 0xFFFFFFFF)],
+        [TxOut(1000, VarStr(b"\x51"))], [Witness([VarStr(w) for w in witness])] if witness else [], 0)
+
+# spends of the types we verify that don't fit their template
+@pytest.mark.parametrize("script, script_sig", [
+    (P2PKH, b""),
+    (P2PKH, b"\x01\x02"), # one push
+    (P2PKH, b"\x01\x02\x01\x03\x01\x04"), # three
+    (P2PKH, b"\x51\x51"), # not pushes
+    (P2PK, b""),
+    (P2PK, b"\x01\x02\x01\x03"),
+    (P2PK, b"\x76"),
+    (P2WPKH, b"\x01\x02"), # scriptSig instead of witness
+])
+def test_template_mismatch_fails(script, script_sig):
+    assert check_input(spend(script_sig), 0, 2000, script, {}) == FAILED
+
+def test_wrong_pubkey_fails():
+    assert check_input(spend(b"\x01\x02\x21" + b"\x02" + bytes(32)), 0, 2000, P2PKH, {}) == FAILED
+    assert check_input(spend(b"", [b"\x30", b"\x02" + bytes(32)]), 0, 2000, P2WPKH, {}) == FAILED
+
+def test_unverified_types_skipped():
+    assert check_input(spend(b"\x51"), 0, 2000, P2SH, {}) == SKIPPED
+    assert check_input(spend(b""), 0, 2000, b"\x51", {}) == SKIPPED
+
+# pushdata opcodes whose length or data runs past the end of the script
+TRUNCATED = [b"\x4c", b"\x4d\x01", b"\x4e", b"\x4e\x01\x00", b"\x4c\x05\x01", b"\x01\x02\x4d"]
+
+@pytest.mark.parametrize("script_sig", TRUNCATED)
+def test_truncated_push(script_sig):
+    assert pushes(script_sig) is None
+    assert check_input(spend(script_sig), 0, 2000, P2PKH, {}) == FAILED
+    assert check_input(spend(script_sig), 0, 2000, P2PK, {}) == FAILED
+    assert check_input(spend(script_sig), 0, 2000, P2SH, {}) == SKIPPED
+
+def test_raising_check_fails_tx():
+    tx = spend(b"\x4c")
+    ok = spend(b"\x01\x02\x21" + b"\x02" + bytes(32))
+    # a script the checks can't handle fails its tx, it doesn't raise
+    (_, _, error) = check_batch([(tx.tobytes(), [(0, 2000, None)])])
+    assert error and tx.txid[::-1].hex() in error
+    assert check_tx_inputs(ok.tobytes(), [(0, 2000, P2SH)]) is None
+
+def test_pool_error_fails():
+    future = Future()
+    future.set_exception(BrokenProcessPool("gone"))
+    assert "gone" in result_of(future, lambda error: error)
+    assert result_of(future, lambda error: (0, 0, error))[2]
+
+def test_check_tx_on_the_pool():
+    validator = ScriptValidator(1)
+    try:
+        assert "input 0" in validator.check_tx(spend(b"\x4c"), [Coin(2000, P2PKH, 1, False)]).result(30)
+        assert validator.check_tx(spend(b"\x4c"), [Coin(2000, P2SH, 1, False)]).result(30) is None
+    finally:
+        validator.close()
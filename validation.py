@@ -0,0 +1,274 @@
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+import codec
+import config
+import lib
+import secp256k1
+from structs import Tx, VarInt, VarStr
+
+SIGHASH_ALL = 1
+SIGHASH_NONE = 2
+SIGHASH_SINGLE = 3
+SIGHASH_ANYONECANPAY = 0x80
+
+# check_input results
+VERIFIED = 0
+SKIPPED = 1 # script type we don't verify
+FAILED = 2
+
+OP_CHECKSIG = 0xAC
+
+# ret: data pushed by a push-only script, None if it has other opcodes
+# or a push runs past the end
+def pushes(script):
+    items = []
+    i = 0
+    while i < len(script):
+        op = script[i]
+        i += 1
+        if op == 0:
+            items.append(b"")
+            continue
+        if op <= 75:
+            size = op
+        elif op == 76:
+            if i + 1 > len(script):
+                return None
+            size = script[i]
+            i += 1
+        elif op == 77:
+            if i + 2 > len(script):
+                return None
+            (size, ) = codec.U16.unpack_from(script, i)
+            i += 2
+        elif op == 78:
+            if i + 4 > len(script):
+                return None
+            (size, ) = codec.U32.unpack_from(script, i)
+            i += 4
+        else:
+            return None
+        if i + size > len(script):
+            return None
+        items.append(bytes(script[i:i + size]))
+        i += size
+    return items
+
+def is_p2pk(script):
+    return len(script) in (35, 67) and script[0] == len(script) - 2 and script[-1] == OP_CHECKSIG
+
+def is_p2pkh(script):
+    return len(script) == 25 and script[:3] == b"\x76\xa9\x14" and script[23:] == b"\x88\xac"
+
+def is_p2wpkh(script):
+    return len(script) == 22 and script[:2] == b"\x00\x14"
+
+def legacy_sighash(tx, index, script_code, hashtype):
+    base = hashtype & 0x1F
+    if base == SIGHASH_SINGLE and index >= len(tx.txout):
+        # historic bug, the "hash" is 1
+        return (1).to_bytes(32, "little")
+
+    inputs = [index] if hashtype & SIGHASH_ANYONECANPAY else range(len(tx.txin))
+    parts = [codec.I32.pack(tx.version), VarInt(len(inputs)).tobytes()]
+    for i in inputs:
+        txin = tx.txin[i]
+        script = script_code if i == index else b""
+        sequence = txin.sequence
+        if i != index and base in (SIGHASH_NONE, SIGHASH_SINGLE):
+            sequence = 0
+        parts += [txin.prev.tobytes(), VarStr(script).tobytes(), codec.U32.pack(sequence)]
+
+    if base == SIGHASH_NONE:
+        parts.append(VarInt(0).tobytes())
+    elif base == SIGHASH_SINGLE:
+        parts.append(VarInt(index + 1).tobytes())
+        parts += [b"\xff" * 8 + b"\x00"] * index
+        parts.append(tx.txout[index].tobytes())
+    else:
+        parts.append(VarInt(len(tx.txout)).tobytes())
+        parts += [out.tobytes() for out in tx.txout]
+    parts.append(codec.U32.pack(tx.locktime))
+    parts.append(codec.U32.pack(hashtype))
+    return lib.double_hash(b"".join(parts))
+
+# BIP143, cache: dict shared by the inputs of one tx
+def witness_sighash(tx, index, script_code, value, hashtype, cache):
+    base = hashtype & 0x1F
+    anyone = hashtype & SIGHASH_ANYONECANPAY
+    if "prevouts" not in cache:
+        cache["prevouts"] = lib.double_hash(b"".join(txin.prev.tobytes() for txin in tx.txin))
+        cache["sequences"] = lib.double_hash(b"".join(codec.U32.pack(txin.sequence) for txin in tx.txin))
+        cache["outputs"] = lib.double_hash(b"".join(out.tobytes() for out in tx.txout))
+
+    zero = bytes(32)
+    prevouts = zero if anyone else cache["prevouts"]
+    sequences = zero if anyone or base in (SIGHASH_NONE, SIGHASH_SINGLE) else cache["sequences"]
+    if base not in (SIGHASH_NONE, SIGHASH_SINGLE):
+        outputs = cache["outputs"]
+    elif base == SIGHASH_SINGLE and index < len(tx.txout):
+        outputs = lib.double_hash(tx.txout[index].tobytes())
+    else:
+        outputs = zero
+
+    txin = tx.txin[index]
+    return lib.double_hash(codec.I32.pack(tx.version) + prevouts + sequences + txin.prev.tobytes() +
+        VarStr(script_code).tobytes() + codec.U64.pack(value) + codec.U32.pack(txin.sequence) +
+        outputs + codec.U32.pack(tx.locktime) + codec.U32.pack(hashtype))
+
+def check_sig(sig, pubkey, sighash):
+    if not sig:
+        return False
+    point = secp256k1.load_pubkey(pubkey)
+    rs = secp256k1.load_signature(sig[:-1])
+    if point is None or rs is None:
+        return False
+    z = int.from_bytes(sighash(sig[-1]), "big")
+    return secp256k1.verify(point, rs[0], rs[1], z)
+
+# Verifies the scripts we understand: P2PK, P2PKH and P2WPKH spends.
+# Everything else (P2SH, bare multisig, P2WSH, taproot, non-standard) is
+# SKIPPED, not FAILED. A spend of one we understand that doesn't fit its
+# template (pushes only, as many as expected) FAILED.
+def check_input(tx, index, value, script, cache):
+    txin = tx.txin[index]
+    if is_p2wpkh(script):
+        if txin.script.string or index >= len(tx.witness):
+            return FAILED
+        items = [w.string for w in tx.witness[index].witnesses]
+        if len(items) != 2 or lib.hash160(items[1]) != script[2:]:
+            return FAILED
+        script_code = b"\x76\xa9\x14" + script[2:] + b"\x88\xac"
+        ok = check_sig(items[0], items[1], lambda hashtype: witness_sighash(tx, index, script_code, value, hashtype, cache))
+        return VERIFIED if ok else FAILED
+
+    if is_p2pkh(script):
+        items = pushes(txin.script.string)
+        if items is None or len(items) != 2 or lib.hash160(items[1]) != script[3:23]:
+            return FAILED
+        ok = check_sig(items[0], items[1], lambda hashtype: legacy_sighash(tx, index, script, hashtype))
+        return VERIFIED if ok else FAILED
+
+    if is_p2pk(script):
+        items = pushes(txin.script.string)
+        if items is None or len(items) != 1:
+            return FAILED
+        ok = check_sig(items[0], script[1:-1], lambda hashtype: legacy_sighash(tx, index, script, hashtype))
+        return VERIFIED if ok else FAILED
+    return SKIPPED
+
+# Runs in the worker processes. jobs: [(raw tx, [(input index, value, script)])]
+# ret: (verified, skipped, error), error is None if every input passed
+def check_batch(jobs):
+    verified = skipped = 0
+    for raw, inputs in jobs:
+        tx, _ = Tx.load(raw)
+        cache = {}
+        for index, value, script in inputs:
+            try:
+                ret = check_input(tx, index, value, script, cache)
+            except Exception as e:
+                # scripts that trip up the checks fail, they don't kill the caller
+                return (verified, skipped, "{} input {}: {!r}".format(tx.txid[::-1].hex(), index, e))
+            if ret == FAILED:
+                return (verified, skipped, "{} input {}".format(tx.txid[::-1].hex(), index))
+            if ret == VERIFIED:
+                verified += 1
+            else:
+                skipped += 1
+    return (verified, skipped, None)
+
+# Runs in the worker processes. ret: the error of check_batch, None if
+# the tx passed
+def check_tx_inputs(raw, inputs):
+    return check_batch([(raw, inputs)])[2]
+
+# ret: result of a finished future of the pool, failed(error) if it raised
+# (a broken or shut down pool), so the tx or block fails instead of the loop
+def result_of(future, failed):
+    try:
+        return future.result()
+    except Exception as e:
+        lib.err("script check raised {!r}", e)
+        return failed("script check raised {!r}".format(e))
+
+# Splits the inputs of a block into batches of config.script_batch and
+# verifies them on config.script_workers processes. Workers get the raw
+# txs and the spent (value, script) pairs only. Small blocks, and
+# everything when script_workers is 0, are checked inline. Single txs
+# go to the workers on their own, the caller waits for the future.
+class ScriptValidator:
+    def __init__(self, workers = config.script_workers):
+        self.workers = workers
+        self.pool = None
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(cancel_futures = True)
+            self.pool = None
+
+    # spent: coins spent by the block in input order, as from connect_block
+    # ret: True if no input failed
+    def check_block(self, block, spent):
+        batches = []
+        jobs = []
+        count = 0
+        coins = iter(spent)
+        for tx in block.txs[1:]:
+            inputs = [(i, coin.value, coin.script) for i, coin in zip(range(len(tx.txin)), coins)]
+            start = 0
+            while start < len(inputs):
+                part = inputs[start:start + config.script_batch - count]
+                jobs.append((tx.tobytes(), part))
+                count += len(part)
+                start += len(part)
+                if count >= config.script_batch:
+                    batches.append(jobs)
+                    jobs = []
+                    count = 0
+        if jobs:
+            batches.append(jobs)
+
+        if self.workers == 0 or len(batches) < 2:
+            results = [check_batch(jobs) for jobs in batches]
+        else:
+            results = self.run(batches)
+
+        verified = skipped = 0
+        for v, s, error in results:
+            if error:
+                lib.err("block {}: script check failed: {}", block.hash[::-1].hex(), error)
+                return False
+            verified += v
+            skipped += s
+        lib.debug("block {}: {} signatures verified, {} inputs skipped", block.hash[::-1].hex(), verified, skipped)
+        return True
+
+    # spent: coins spent by tx in input order
+    # ret: concurrent.futures.Future of the error, None if every input
+    # passed. Already done when checked inline
+    def check_tx(self, tx, spent):
+        inputs = [(i, coin.value, coin.script) for i, coin in enumerate(spent)]
+        if self.workers == 0:
+            future = Future()
+            future.set_result(check_tx_inputs(tx.tobytes(), inputs))
+            return future
+        if not self.pool:
+            self.pool = ProcessPoolExecutor(self.workers)
+        future = Future()
+        self.pool.submit(check_tx_inputs, tx.tobytes(), inputs).add_done_callback(
+            lambda done: future.set_result(result_of(done, lambda error: error)))
+        return future
+
+    # ret: results of the batches, stops at the first failed one
+    def run(self, batches):
+        if not self.pool:
+            self.pool = ProcessPoolExecutor(self.workers)
+        futures = [self.pool.submit(check_batch, jobs) for jobs in batches]
+        results = []
+        for future in as_completed(futures):
+            results.append(result_of(future, lambda error: (0, 0, error)))
+            if results[-1][2]:
+                for f in futures:
+                    f.cancel()
+                break
+        return results